@@ -1,29 +1,59 @@
 # app/afip_connector.py
 import tempfile
 import os
+import datetime
+import logging
 import ssl
+import threading
+import weakref
+from typing import List, Optional
 from pysimplesoap.transport import Httplib2Transport
 from pyafipws.wsaa import WSAA
 from pyafipws.wsfev1 import WSFEv1
-from app.config import URL_WSAA_PROD, URL_WSAA_HOMO, URL_WSFEv1_PROD, URL_WSFEv1_HOMO, CACHE
+from app.config import URL_WSAA_PROD, URL_WSAA_HOMO, URL_WSFEv1_PROD, URL_WSFEv1_HOMO, CACHE, AFIP_HTTP_POOL
 from app.logger_setup import logger
+from app.perfilado import fase
+from app.plazos import PlazoAgotado, verificar, puede_reintentar
+from app.soap_transport import instalar_transporte
+from app.tenants import CredencialesTenant
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.serialization import load_pem_private_key
 from cryptography.hazmat.primitives.serialization import load_pem_public_key
 from cryptography.hazmat.backends import default_backend
 
-# --- BLOQUE COMPLETO Y SEGURO PARA FORZAR TLSv1.2 ---
+# --- TRANSPORTE SOAP: CONEXIONES PERSISTENTES FORZANDO TLSv1.2 ---
 # Esto se ejecuta una sola vez cuando el módulo es importado.
-try:
-    context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
-    context.verify_mode = ssl.CERT_REQUIRED
-    context.check_hostname = True
-    context.load_default_certs()
+if AFIP_HTTP_POOL:
+    try:
+        instalar_transporte()
+    except Exception as e:
+        logger.warning("No se pudo instalar el transporte SOAP persistente; se usará httplib2. Error: %s", e)
+else:
+    try:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
+        context.verify_mode = ssl.CERT_REQUIRED
+        context.check_hostname = True
+        context.load_default_certs()
 
-    Httplib2Transport.SSL_CONTEXT = context
-    logger.info("Contexto SSL forzado a TLSv1.2 exitosamente.")
-except Exception as e:
-    logger.warning(f"No se pudo forzar el contexto SSL a TLSv1.2. Error: {e}")
+        Httplib2Transport.SSL_CONTEXT = context
+        logger.info("Contexto SSL forzado a TLSv1.2 exitosamente.")
+    except Exception as e:
+        logger.warning("No se pudo forzar el contexto SSL a TLSv1.2. Error: %s", e)
+
+
+def _vencimiento_ta(origen) -> Optional[float]:
+    """Vencimiento (epoch) del TA, desde el objeto WSAA o el texto de expirationTime."""
+    try:
+        texto = origen if isinstance(origen, str) else (
+            getattr(origen, "ExpirationTime", None) or origen.ObtenerTagXml("expirationTime"))
+        return datetime.datetime.fromisoformat(str(texto).strip()).timestamp() if texto else None
+    except Exception:
+        return None
+
+
+# Conectores vivos del proceso, para informar la vigencia de sus TA (ver app/salud.py).
+_activos = weakref.WeakSet()
+_lock_activos = threading.Lock()
 
 
 class AfipConnector:
@@ -31,6 +61,16 @@ class AfipConnector:
         self.wsfev1 = None
         self.cuit = None
         self.is_production = None
+        self.vencimiento_ta: Optional[float] = None
+        # El objeto WSFEv1 guarda el comprobante en curso: una emisión a la vez.
+        self.lock = threading.RLock()
+        with _lock_activos:
+            _activos.add(self)
+
+    @staticmethod
+    def activos() -> List["AfipConnector"]:
+        with _lock_activos:
+            return list(_activos)
 
     def conectar(self, credenciales, production=True, force_reconnect=False):
         cuit = credenciales.get('cuit')
@@ -39,14 +79,15 @@ class AfipConnector:
 
         if (self.wsfev1 and self.cuit == cuit and self.is_production == production 
             and not force_reconnect):
-            logger.info(f"Reutilizando conexión para CUIT {cuit} en entorno {'PROD' if production else 'HOMO'}")
+            logger.info("Reutilizando conexión para CUIT %s en entorno %s", cuit, 'PROD' if production else 'HOMO')
             return self.wsfev1
 
         if force_reconnect:
-            logger.info(f"Forzando reconexión para CUIT {cuit}")
+            logger.info("Forzando reconexión para CUIT %s", cuit)
         else:
-            logger.info(f"Creando nueva conexión para CUIT {cuit} en entorno {'PROD' if production else 'HOMO'}")
+            logger.info("Creando nueva conexión para CUIT %s en entorno %s", cuit, 'PROD' if production else 'HOMO')
         
+        verificar("conectar con AFIP")
         self.cuit = cuit
         self.is_production = production
         cert_str = credenciales.get('certificado')
@@ -55,15 +96,21 @@ class AfipConnector:
         if not cert_str or not key_str:
             raise ValueError("Certificado o clave privada no proporcionados.")
 
-        cert_file = tempfile.NamedTemporaryFile(mode='w+', delete=False, suffix='.crt', encoding='utf-8')
-        key_file = tempfile.NamedTemporaryFile(mode='w+', delete=False, suffix='.key', encoding='utf-8')
+        with fase("archivos_temp"):
+            cert_file = tempfile.NamedTemporaryFile(mode='w+', delete=False, suffix='.crt', encoding='utf-8')
+            key_file = tempfile.NamedTemporaryFile(mode='w+', delete=False, suffix='.key', encoding='utf-8')
+
+        # Las credenciales del registro de tenants ya se validaron al registrarse.
+        ya_validadas = isinstance(credenciales, CredencialesTenant)
 
         # Validar rápidamente el contenido PEM antes de escribir y llamar a WSAA
         try:
             # Intentamos cargar la clave privada PEM para validar formato
-            load_pem_private_key(key_str.encode('utf-8'), password=None, backend=default_backend())
+            if not ya_validadas:
+                with fase("pem"):
+                    load_pem_private_key(key_str.encode('utf-8'), password=None, backend=default_backend())
         except Exception as pem_err:
-            logger.warning(f"Clave privada inválida o en formato no soportado: {pem_err}")
+            logger.warning("Clave privada inválida o en formato no soportado: %s", pem_err)
             raise ValueError("Clave privada en formato PEM inválida o no soportada")
 
         try:
@@ -71,53 +118,63 @@ class AfipConnector:
             # Cargamos el certificado como una clave pública para validar formato PEM básico.
             # Si esto falla no necesariamente es fatal (puede ser certificado x509), pero lo intentamos.
             try:
-                load_pem_public_key(cert_str.encode('utf-8'), backend=default_backend())
+                if not ya_validadas:
+                    with fase("pem"):
+                        load_pem_public_key(cert_str.encode('utf-8'), backend=default_backend())
             except Exception:
                 # No es una clave pública PEM; no forzamos fallo porque algunos CRTs contienen certificados X.509
                 # y la validación estricta se delegará a la librería que firma.
                 logger.debug("Advertencia: no se pudo parsear certificado como clave pública PEM — se continuará y dejará que WSAA valide.")
 
-            cert_file.write(cert_str)
-            cert_file.close()
-            key_file.write(key_str)
-            key_file.close()
+            with fase("archivos_temp"):
+                cert_file.write(cert_str)
+                cert_file.close()
+                key_file.write(key_str)
+                key_file.close()
 
             wsaa = WSAA()
             URL_WSAA = URL_WSAA_PROD if production else URL_WSAA_HOMO
+            URL_WSFEv1 = URL_WSFEv1_PROD if production else URL_WSFEv1_HOMO
 
             # Forma correcta de autenticar: el resultado se guarda en el objeto wsaa
-            wsaa.Autenticar(
-                service="wsfe",
-                crt=cert_file.name,
-                key=key_file.name,
-                wsdl=URL_WSAA,
-                cache=CACHE,
-                debug=True
-            )
+            with fase("wsaa"):
+                wsaa.Autenticar(
+                    service="wsfe",
+                    crt=cert_file.name,
+                    key=key_file.name,
+                    wsdl=URL_WSAA,
+                    cache=CACHE,
+                    debug=logger.isEnabledFor(logging.DEBUG)
+                )
 
             self.wsfev1 = WSFEv1()
             self.wsfev1.Cuit = cuit
             # Forma correcta de asignar Token y Sign
             self.wsfev1.Token = wsaa.Token
             self.wsfev1.Sign = wsaa.Sign
+            self.vencimiento_ta = _vencimiento_ta(wsaa)
 
-            URL_WSFEv1 = URL_WSFEv1_PROD if production else URL_WSFEv1_HOMO
-            self.wsfev1.Conectar(wsdl=URL_WSFEv1, cache=CACHE)
+            verificar("conectar a WSFEv1")
+            with fase("wsdl"):
+                self.wsfev1.Conectar(wsdl=URL_WSFEv1, cache=CACHE)
 
-            logger.info(f"Conexión exitosa al endpoint del WSDL: {URL_WSFEv1}")
+            logger.info("Conexión exitosa al endpoint del WSDL: %s", URL_WSFEv1)
             return self.wsfev1
         
         except Exception as auth_error:
             # Si la excepción es por formato/entrada inválida (ValueError) la re-lanzamos
             # para que la capa de negocio y de rutas puedan devolver un 400 al cliente.
             if isinstance(auth_error, ValueError):
-                logger.warning(f"Error de entrada detectado al autenticar: {auth_error}")
+                logger.warning("Error de entrada detectado al autenticar: %s", auth_error)
+                raise
+            # Sin plazo restante no se intenta ninguna recuperación.
+            if isinstance(auth_error, PlazoAgotado):
                 raise
             # Manejo robusto de errores de autenticación
             error_str = str(auth_error).lower()
             error_type = type(auth_error).__name__
 
-            logger.warning(f"Error de autenticación {error_type}: {auth_error}")
+            logger.warning("Error de autenticación %s: %s", error_type, auth_error)
 
             # Caso especial: AFIP indica que el CEE ya posee un TA válido.
             # En esa situación preferimos reutilizar el TA más reciente que esté
@@ -131,7 +188,7 @@ class AfipConnector:
                     if ta_files:
                         ta_files.sort(key=os.path.getmtime, reverse=True)
                         latest_ta = ta_files[0]
-                        logger.info(f"Reutilizando TA existente desde cache: {latest_ta}")
+                        logger.info("Reutilizando TA existente desde cache: %s", latest_ta)
                         tree = ET.parse(latest_ta)
                         root = tree.getroot()
                         # Intentar extraer token y sign desde la estructura estándar
@@ -139,13 +196,16 @@ class AfipConnector:
                         sign_el = root.find('.//sign')
                         token_text = token_el.text.strip() if token_el is not None and token_el.text else None
                         sign_text = sign_el.text.strip() if sign_el is not None and sign_el.text else None
+                        vencimiento_el = root.find('.//expirationTime')
 
                         if token_text and sign_text:
                             self.wsfev1 = WSFEv1()
                             self.wsfev1.Cuit = cuit
                             self.wsfev1.Token = token_text
                             self.wsfev1.Sign = sign_text
-                            self.wsfev1.Conectar(wsdl=URL_WSFEv1, cache=CACHE)
+                            self.vencimiento_ta = _vencimiento_ta(vencimiento_el.text if vencimiento_el is not None else None)
+                            with fase("wsdl"):
+                                self.wsfev1.Conectar(wsdl=URL_WSFEv1, cache=CACHE)
                             logger.info("Conexión exitosa reutilizando TA existente")
                             return self.wsfev1
                         else:
@@ -153,7 +213,7 @@ class AfipConnector:
                     else:
                         logger.info("No se encontró TA en cache para reutilizar")
                 except Exception as e:
-                    logger.warning(f"Fallo al intentar reutilizar TA existente: {e}")
+                    logger.warning("Fallo al intentar reutilizar TA existente: %s", e)
 
             # Detectar diferentes tipos de errores
             is_token_error = any(keyword in error_str for keyword in
@@ -173,8 +233,8 @@ class AfipConnector:
             )
 
             # Intentar recuperación según el tipo de error
-            if is_token_error or is_ssl_error or is_connection_error:
-                logger.info(f"Detectado error recuperable: {error_type}. Limpiando cache...")
+            if (is_token_error or is_ssl_error or is_connection_error) and puede_reintentar("autenticación WSAA"):
+                logger.info("Detectado error recuperable: %s. Limpiando cache...", error_type)
                 try:
                     import glob
                     cache_files = glob.glob(f"{CACHE}/*")
@@ -183,25 +243,28 @@ class AfipConnector:
                     logger.info("Cache limpiado exitosamente")
 
                     # Reintentar autenticación después de limpiar cache
-                    wsaa.Autenticar(
-                        service="wsfe",
-                        crt=cert_file.name,
-                        key=key_file.name,
-                        wsdl=URL_WSAA,
-                        cache=CACHE,
-                        debug=True
-                    )
+                    with fase("wsaa"):
+                        wsaa.Autenticar(
+                            service="wsfe",
+                            crt=cert_file.name,
+                            key=key_file.name,
+                            wsdl=URL_WSAA,
+                            cache=CACHE,
+                            debug=logger.isEnabledFor(logging.DEBUG)
+                        )
 
                     self.wsfev1 = WSFEv1()
                     self.wsfev1.Cuit = cuit
                     self.wsfev1.Token = wsaa.Token
                     self.wsfev1.Sign = wsaa.Sign
-                    self.wsfev1.Conectar(wsdl=URL_WSFEv1, cache=CACHE)
+                    self.vencimiento_ta = _vencimiento_ta(wsaa)
+                    with fase("wsdl"):
+                        self.wsfev1.Conectar(wsdl=URL_WSFEv1, cache=CACHE)
                     logger.info("Reconexión exitosa después de limpiar cache")
 
                 except Exception as retry_error:
                     retry_error_msg = str(retry_error)
-                    logger.error(f"Error en reintento después de limpiar cache: {retry_error_msg}")
+                    logger.error("Error en reintento después de limpiar cache: %s", retry_error_msg)
                     # No usar indexación de errores, solo el mensaje string
                     if is_connection_error:
                         raise ConnectionError(f"Fallo de conexión en reintento: {retry_error_msg}")
@@ -209,12 +272,13 @@ class AfipConnector:
                         raise auth_error
             else:
                 # Error no recuperable
-                logger.error(f"Error no recuperable: {error_type}")
+                logger.error("Error no recuperable: %s", error_type)
                 raise auth_error
                 
         finally:
-            os.remove(cert_file.name)
-            os.remove(key_file.name)
+            with fase("archivos_temp"):
+                os.remove(cert_file.name)
+                os.remove(key_file.name)
 
 # Instancia única que importarán otros archivos
 afip_conector = AfipConnector()
\ No newline at end of file
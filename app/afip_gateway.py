@@ -0,0 +1,303 @@
+# app/afip_gateway.py
+"""
+Gateway AFIP: un único proceso por contenedor dueño de las sesiones con AFIP.
+
+Sin gateway cada worker de gunicorn mantiene su propio conector, TA y sockets,
+por lo que los logins a WSAA se multiplican por la cantidad de workers. Con
+`AFIP_GATEWAY_SOCKET` definido, los workers envían cada comprobante por un
+Unix socket local a este proceso, que conserva un conector por CUIT.
+
+Protocolo: cada mensaje es un entero de 4 bytes (big-endian) con el largo
+seguido del JSON en UTF-8. Una conexión transporta una solicitud y su respuesta.
+
+Ejecución como sidecar:
+    AFIP_GATEWAY_SOCKET=/tmp/afip_gateway.sock python -m app.afip_gateway
+"""
+import json
+import os
+import socket
+import socketserver
+import struct
+import threading
+import time
+from contextlib import nullcontext
+from typing import Any, Dict, Optional
+
+from app.config import AFIP_GATEWAY_SOCKET, AFIP_GATEWAY_TIMEOUT, AFIP_GATEWAY_SUPERVISION
+from app.limitador import LimiteExcedido
+from app.logger_setup import logger
+from app.perfilado import fase, perfil_activo, perfilar
+from app.plazos import EnvioIncierto, PlazoAgotado, acotar, plazo, restante
+from app.tenants import AccesoDenegado
+
+_CABECERA = struct.Struct(">I")
+
+# Excepciones que se reconstruyen del lado del worker para que las rutas
+# devuelvan el mismo código HTTP que sin gateway (ValueError -> 400).
+_EXCEPCIONES = {
+    "ValueError": ValueError,
+    "ConnectionError": ConnectionError,
+    "RuntimeError": RuntimeError,
+    "PlazoAgotado": PlazoAgotado,
+    "EnvioIncierto": EnvioIncierto,
+    "AccesoDenegado": AccesoDenegado,
+}
+
+# Margen para que el gateway alcance a responder PlazoAgotado antes de que el worker corte.
+_MARGEN_PLAZO = 1.0
+
+
+def _enviar_mensaje(sock: socket.socket, mensaje: Dict[str, Any]) -> None:
+    datos = json.dumps(mensaje).encode("utf-8")
+    sock.sendall(_CABECERA.pack(len(datos)) + datos)
+
+
+def _recibir_exacto(sock: socket.socket, cantidad: int) -> bytes:
+    partes = []
+    while cantidad:
+        parte = sock.recv(cantidad)
+        if not parte:
+            raise ConnectionError("El gateway AFIP cerró la conexión")
+        partes.append(parte)
+        cantidad -= len(parte)
+    return b"".join(partes)
+
+
+def _recibir_mensaje(sock: socket.socket) -> Dict[str, Any]:
+    (largo,) = _CABECERA.unpack(_recibir_exacto(sock, _CABECERA.size))
+    return json.loads(_recibir_exacto(sock, largo).decode("utf-8"))
+
+
+class GatewayClient:
+    """Cliente usado por los workers de Flask para delegar en el gateway."""
+
+    def __init__(self, socket_path: str, timeout: float = AFIP_GATEWAY_TIMEOUT):
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    def solicitar(self, operacion: str, **parametros) -> Any:
+        perfil = perfil_activo()
+        segundos = acotar(self.timeout, "delegar en el gateway AFIP")
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(segundos if segundos == self.timeout else segundos + _MARGEN_PLAZO)
+        try:
+            try:
+                sock.connect(self.socket_path)
+            except socket.timeout:
+                raise
+            except OSError as e:
+                raise ConnectionError(f"Gateway AFIP no disponible en {self.socket_path}: {e}")
+            with fase("gateway"):
+                _enviar_mensaje(sock, {"op": operacion, "perfilar": perfil is not None,
+                                       "plazo": restante(), **parametros})
+                try:
+                    respuesta = _recibir_mensaje(sock)
+                except socket.timeout as e:
+                    # Como en facturar(): con el comprobante ya enviado, el plazo
+                    # agotado no dice si hubo CAE. Las consultas sí son PlazoAgotado.
+                    if operacion == "facturar":
+                        raise EnvioIncierto("Plazo agotado esperando al gateway AFIP tras enviar "
+                                            "el comprobante; verificar en AFIP antes de reenviar") from e
+                    raise
+                except (OSError, ValueError) as e:
+                    # El comprobante ya está en manos del gateway: puede haber obtenido el CAE.
+                    if operacion != "facturar":
+                        raise
+                    raise EnvioIncierto(f"Sin respuesta del gateway AFIP tras enviar el comprobante: {e}") from e
+        except socket.timeout as e:
+            # Conexión, envío o consulta: nada quedó a medias en AFIP.
+            if restante() is not None:
+                raise PlazoAgotado("Plazo de la solicitud agotado esperando al gateway AFIP") from e
+            raise
+        finally:
+            sock.close()
+
+        # Las fases medidas en el gateway se suman al perfil de la solicitud.
+        if perfil is not None:
+            for nombre, segundos in (respuesta.get("fases") or {}).items():
+                if nombre != "total":
+                    perfil.registrar(nombre, segundos)
+
+        if respuesta.get("ok"):
+            return respuesta.get("resultado")
+        mensaje = respuesta.get("mensaje", "Error desconocido en el gateway AFIP")
+        if respuesta.get("tipo") == "LimiteExcedido":
+            raise LimiteExcedido(mensaje, retry_after=respuesta.get("retry_after", 1))
+        excepcion = _EXCEPCIONES.get(respuesta.get("tipo"), RuntimeError)
+        raise excepcion(mensaje)
+
+    def facturar(self, credenciales: Dict[str, str], datos_factura: Dict[str, Any]) -> Dict[str, Any]:
+        return self.solicitar("facturar", credenciales=credenciales, datos_factura=datos_factura)
+
+
+class _GatewayHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        try:
+            mensaje = _recibir_mensaje(self.request)
+        except Exception as e:
+            logger.warning("Gateway AFIP: mensaje inválido descartado: %s", e)
+            return
+
+        with (perfilar("gateway") if mensaje.get("perfilar") else nullcontext()) as perfil, \
+                plazo(mensaje.get("plazo")):
+            try:
+                resultado = self.server.despachar(mensaje)
+                respuesta = {"ok": True, "resultado": resultado}
+            except Exception as e:
+                respuesta = {"ok": False, "tipo": type(e).__name__, "mensaje": str(e)}
+                if isinstance(e, LimiteExcedido):
+                    respuesta["retry_after"] = e.retry_after
+        if perfil is not None:
+            respuesta["fases"] = perfil.fases
+
+        try:
+            _enviar_mensaje(self.request, respuesta)
+        except OSError as e:
+            # El worker dejó de esperar; el comprobante ya quedó procesado.
+            logger.warning("Gateway AFIP: no se pudo responder al worker: %s", e)
+
+
+class GatewayServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Servidor del gateway. Atiende a todos los workers y mantiene un conector
+    AFIP por CUIT (o por punto de venta, si el CUIT los reparte; ver
+    `app/puntos_venta.py`). La limitación de tasa y la serialización por
+    conector (pyafipws no es seguro entre hilos) las aplica `emitir_local`.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path: str):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        super().__init__(socket_path, _GatewayHandler)
+        os.chmod(socket_path, 0o660)
+        self._conectores = {}
+        self._lock = threading.Lock()
+
+    def _conector_para(self, cuit: str):
+        from app.afip_connector import AfipConnector
+
+        with self._lock:
+            if cuit not in self._conectores:
+                self._conectores[cuit] = AfipConnector()
+            return self._conectores[cuit]
+
+    def despachar(self, mensaje: Dict[str, Any]) -> Any:
+        operacion = mensaje.get("op")
+        if operacion == "facturar":
+            from app.emision import emitir_local
+            from app.tenants import resolver_credenciales
+
+            credenciales = resolver_credenciales(mensaje.get("credenciales") or {})
+            cuit = credenciales.get("cuit")
+            if not cuit:
+                raise ValueError("El CUIT no fue proporcionado en las credenciales.")
+            return emitir_local(credenciales, mensaje.get("datos_factura") or {},
+                                conector=self._conector_para(cuit))
+        if operacion == "estado":
+            # Para /salud/listo: vigencia de los TA que mantiene el gateway.
+            from app.salud import estado_tas
+
+            return {"tas": estado_tas()}
+        raise ValueError(f"Operación de gateway desconocida: {operacion}")
+
+
+def servir(socket_path: Optional[str] = None) -> None:
+    """Inicia el gateway y atiende solicitudes hasta que el proceso termine."""
+    socket_path = socket_path or AFIP_GATEWAY_SOCKET
+    if not socket_path:
+        raise RuntimeError("AFIP_GATEWAY_SOCKET no está definido")
+    servidor = GatewayServer(socket_path)
+    logger.info("Gateway AFIP escuchando en %s (pid %s)", socket_path, os.getpid())
+    try:
+        servidor.serve_forever()
+    finally:
+        servidor.server_close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+def iniciar_proceso_gateway(socket_path: Optional[str] = None):
+    """
+    Lanza el gateway en un proceso hijo. Pensado para el hook `on_starting`
+    de gunicorn, de modo que exista un único gateway por contenedor.
+    """
+    import multiprocessing
+
+    proceso = multiprocessing.Process(target=servir, args=(socket_path,), name="afip-gateway", daemon=True)
+    proceso.start()
+    return proceso
+
+
+class SupervisorGateway:
+    """
+    Mantiene vivo el gateway lanzado por el master de gunicorn. Un hilo del
+    master revisa el proceso cada AFIP_GATEWAY_SUPERVISION segundos y lo
+    relanza si murió; si vuelve a morir antes de ESTABLE segundos, la espera
+    entre relanzamientos se duplica hasta ESPERA_MAX para no girar en falso.
+    """
+    ESTABLE = 30.0
+    ESPERA_MAX = 60.0
+
+    def __init__(self, socket_path: Optional[str] = None, intervalo: float = AFIP_GATEWAY_SUPERVISION):
+        self.socket_path = socket_path or AFIP_GATEWAY_SOCKET
+        self.intervalo = intervalo
+        self.proceso = None
+        self.reinicios = 0
+        self._iniciado = 0.0
+        self._espera = 0.0
+        self._detener = threading.Event()
+        self._hilo: Optional[threading.Thread] = None
+
+    def _lanzar(self) -> None:
+        self.proceso = iniciar_proceso_gateway(self.socket_path)
+        self._iniciado = time.monotonic()
+
+    def iniciar(self):
+        """Lanza el gateway y el hilo que lo vigila. Devuelve el proceso lanzado."""
+        self._lanzar()
+        self._hilo = threading.Thread(target=self._vigilar, name="afip-gateway-supervisor", daemon=True)
+        self._hilo.start()
+        return self.proceso
+
+    def revisar(self) -> bool:
+        """Relanza el gateway si murió. Devuelve True si lo relanzó."""
+        if self._detener.is_set() or self.proceso.is_alive():
+            return False
+        codigo = self.proceso.exitcode
+        if time.monotonic() - self._iniciado < self.ESTABLE:
+            self._espera = min(self.ESPERA_MAX, max(self.intervalo, self._espera * 2))
+        else:
+            self._espera = 0.0
+        logger.error("Gateway AFIP (pid %s) terminó con código %s; se relanza en %.1fs",
+                     self.proceso.pid, codigo, self._espera)
+        if self._espera and self._detener.wait(self._espera):
+            return False
+        self._lanzar()
+        self.reinicios += 1
+        logger.info("Gateway AFIP relanzado (pid %s, reinicio %s)", self.proceso.pid, self.reinicios)
+        return True
+
+    def _vigilar(self) -> None:
+        while not self._detener.wait(self.intervalo):
+            try:
+                self.revisar()
+            except Exception as e:
+                logger.error("Error al supervisar el gateway AFIP: %s", e, exc_info=True)
+
+    def detener(self, timeout: float = 5) -> None:
+        """Detiene la supervisión y termina el gateway (hook `on_exit`)."""
+        self._detener.set()
+        if self._hilo is not None:
+            self._hilo.join(timeout=timeout)
+        if self.proceso is not None and self.proceso.is_alive():
+            self.proceso.terminate()
+            self.proceso.join(timeout=timeout)
+
+
+# Cliente que usan las rutas; None cuando el modo gateway está deshabilitado.
+gateway_cliente = GatewayClient(AFIP_GATEWAY_SOCKET) if AFIP_GATEWAY_SOCKET else None
+
+
+if __name__ == "__main__":
+    servir()
@@ -0,0 +1,223 @@
+# app/comprobante_pdf.py
+"""
+Código QR de AFIP y PDF de un comprobante autorizado.
+
+Este módulo solo depende de la biblioteca estándar, fpdf y qrcode para que
+los procesos del pool de impresión (ver `app/impresion.py`) lo importen
+rápido y sin arrastrar la app Flask ni pyafipws.
+"""
+import base64
+import datetime
+import json
+import os
+import re
+import tempfile
+import weakref
+from functools import lru_cache
+from typing import Any, Dict, Optional
+
+import qrcode
+from fpdf import FPDF
+
+URL_QR_AFIP = "https://www.afip.gob.ar/fe/qr/?p="
+
+TIPOS_COMPROBANTE = {
+    1: ("A", "FACTURA"), 2: ("A", "NOTA DE DÉBITO"), 3: ("A", "NOTA DE CRÉDITO"),
+    6: ("B", "FACTURA"), 7: ("B", "NOTA DE DÉBITO"), 8: ("B", "NOTA DE CRÉDITO"),
+    11: ("C", "FACTURA"), 12: ("C", "NOTA DE DÉBITO"), 13: ("C", "NOTA DE CRÉDITO"),
+}
+TIPOS_DOCUMENTO = {80: "CUIT", 86: "CUIL", 87: "CDI", 89: "LE", 90: "LC", 94: "Pasaporte", 96: "DNI", 99: "Sin identificar"}
+CONDICIONES_IVA = {
+    1: "IVA Responsable Inscripto", 4: "IVA Sujeto Exento", 5: "Consumidor Final",
+    6: "Responsable Monotributo", 7: "Sujeto No Categorizado", 8: "Proveedor del Exterior",
+    9: "Cliente del Exterior", 10: "IVA Liberado", 13: "Monotributista Social", 15: "IVA No Alcanzado",
+}
+
+
+def _numero(valor: Any) -> int:
+    """CUIT o documento como entero, aunque venga con guiones o puntos ("20-12345678-9")."""
+    digitos = re.sub(r"\D", "", str(valor if valor is not None else ""))
+    return int(digitos) if digitos else 0
+
+
+def datos_qr(cuit: Any, comprobante: Dict[str, Any]) -> Dict[str, Any]:
+    """Contenido del QR según la especificación de AFIP (versión 1)."""
+    return {
+        "ver": 1,
+        "fecha": comprobante.get("fecha_comprobante") or datetime.date.today().strftime("%Y-%m-%d"),
+        "cuit": _numero(cuit),
+        "ptoVta": int(comprobante.get("punto_venta") or 0),
+        "tipoCmp": int(comprobante.get("tipo_afip") or 0),
+        "nroCmp": int(comprobante.get("numero_comprobante") or 0),
+        "importe": round(float(comprobante.get("total") or 0.0), 2),
+        "moneda": "PES",
+        "ctz": 1,
+        "tipoDocRec": int(comprobante.get("tipo_documento") or 99),
+        "nroDocRec": _numero(comprobante.get("documento")),
+        "tipoCodAut": "E",
+        "codAut": _numero(comprobante.get("cae")),
+    }
+
+
+def url_qr(cuit: Any, comprobante: Dict[str, Any]) -> str:
+    """URL que se codifica en el QR: base64 del JSON de `datos_qr`."""
+    contenido = json.dumps(datos_qr(cuit, comprobante), separators=(",", ":")).encode("utf-8")
+    return URL_QR_AFIP + base64.b64encode(contenido).decode("ascii")
+
+
+def _borrar_archivo(ruta: str) -> None:
+    try:
+        os.remove(ruta)
+    except FileNotFoundError:
+        pass
+
+
+class _Plantilla:
+    """Partes fijas del PDF de un emisor: textos del encabezado y logo ya decodificado."""
+
+    def __init__(self, emisor: Dict[str, Any]):
+        self.razon_social = str(emisor.get("razon_social") or "")
+        self.cuit = str(emisor.get("cuit") or "")
+        self.lineas = [texto for texto in (
+            emisor.get("domicilio"),
+            emisor.get("condicion_iva"),
+            f"CUIT: {self.cuit}",
+            f"Ingresos Brutos: {emisor['ingresos_brutos']}" if emisor.get("ingresos_brutos") else None,
+            f"Inicio de actividades: {emisor['inicio_actividades']}" if emisor.get("inicio_actividades") else None,
+        ) if texto]
+        self.logo: Optional[str] = None
+        if emisor.get("logo"):
+            # fpdf 1.7 solo lee imágenes desde archivo. El archivo se borra cuando la
+            # plantilla sale de la caché o al terminar el proceso.
+            contenido = base64.b64decode(emisor["logo"])
+            with tempfile.NamedTemporaryFile(delete=False, suffix=".png", prefix="afip-logo-") as archivo:
+                archivo.write(contenido)
+            self.logo = archivo.name
+            weakref.finalize(self, _borrar_archivo, archivo.name)
+
+
+@lru_cache(maxsize=64)
+def _plantilla(emisor_json: str) -> _Plantilla:
+    return _Plantilla(json.loads(emisor_json))
+
+
+def _texto(valor: Any) -> str:
+    # fpdf 1.7 escribe en latin-1: reemplazar lo que no se pueda representar.
+    return str(valor if valor is not None else "").encode("latin-1", "replace").decode("latin-1")
+
+
+def _importe(valor: Any) -> str:
+    return f"$ {float(valor or 0.0):,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
+
+
+def _dibujar_qr(pdf: FPDF, contenido: str, x: float, y: float, lado: float) -> None:
+    """
+    Dibuja el QR como rectángulos vectoriales, sin pasar por una imagen PNG.
+    La máscara es fija: elegir la óptima evalúa las ocho y cuadruplica el costo,
+    y cualquiera es válida para los lectores.
+    """
+    codigo = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_M, border=0, mask_pattern=0)
+    codigo.add_data(contenido)
+    codigo.make(fit=True)
+    matriz = codigo.get_matrix()
+    modulo = lado / len(matriz)
+    pdf.set_fill_color(0, 0, 0)
+    for fila, celdas in enumerate(matriz):
+        inicio = None
+        # Un rectángulo por tramo horizontal de módulos oscuros.
+        for columna, oscuro in enumerate(celdas + [False]):
+            if oscuro and inicio is None:
+                inicio = columna
+            elif not oscuro and inicio is not None:
+                pdf.rect(x + inicio * modulo, y + fila * modulo, (columna - inicio) * modulo, modulo, "F")
+                inicio = None
+
+
+def renderizar(emisor: Dict[str, Any], comprobante: Dict[str, Any]) -> bytes:
+    """PDF (bytes) de un comprobante con la forma de `factura_response_model`."""
+    plantilla = _plantilla(json.dumps(emisor, sort_keys=True))
+    letra, nombre = TIPOS_COMPROBANTE.get(comprobante.get("tipo_afip"), ("", "COMPROBANTE"))
+    punto_venta = int(comprobante.get("punto_venta") or 0)
+    numero = int(comprobante.get("numero_comprobante") or 0)
+
+    pdf = FPDF(format="A4")
+    pdf.set_auto_page_break(False)
+    pdf.add_page()
+
+    # Encabezado: emisor, letra y datos del comprobante
+    pdf.rect(10, 10, 190, 45)
+    pdf.line(105, 22, 105, 55)
+    if plantilla.logo:
+        pdf.image(plantilla.logo, x=14, y=13, h=14)
+    pdf.set_xy(14, 29 if plantilla.logo else 14)
+    pdf.set_font("Arial", "B", 13)
+    pdf.cell(88, 7, _texto(plantilla.razon_social), ln=2)
+    pdf.set_font("Arial", "", 9)
+    for linea in plantilla.lineas:
+        pdf.cell(88, 5, _texto(linea), ln=2)
+
+    pdf.rect(98, 10, 14, 12)
+    pdf.set_xy(98, 11)
+    pdf.set_font("Arial", "B", 18)
+    pdf.cell(14, 8, letra, align="C")
+    pdf.set_xy(98, 18)
+    pdf.set_font("Arial", "", 6)
+    pdf.cell(14, 3, f"COD. {int(comprobante.get('tipo_afip') or 0):02d}", align="C")
+
+    pdf.set_xy(115, 14)
+    pdf.set_font("Arial", "B", 14)
+    pdf.cell(80, 8, _texto(nombre), ln=2)
+    pdf.set_font("Arial", "", 10)
+    pdf.cell(80, 6, f"Punto de Venta: {punto_venta:05d}   Comp. Nro: {numero:08d}", ln=2)
+    pdf.cell(80, 6, _texto(f"Fecha de Emisión: {comprobante.get('fecha_comprobante') or ''}"), ln=2)
+
+    # Receptor
+    pdf.rect(10, 58, 190, 20)
+    pdf.set_xy(14, 61)
+    tipo_documento = TIPOS_DOCUMENTO.get(comprobante.get("tipo_documento"), str(comprobante.get("tipo_documento") or ""))
+    pdf.cell(180, 6, _texto(f"{tipo_documento}: {comprobante.get('documento') or ''}"), ln=2)
+    condicion = CONDICIONES_IVA.get(comprobante.get("id_condicion_iva"), "")
+    pdf.cell(180, 6, _texto(f"Condición frente al IVA: {condicion}"), ln=2)
+    if comprobante.get("asociado_numero_comprobante"):
+        pdf.set_xy(14, 72)
+        pdf.set_font("Arial", "", 8)
+        pdf.cell(180, 4, _texto(
+            f"Comprobante asociado: tipo {comprobante.get('asociado_tipo_afip')} - "
+            f"{int(comprobante.get('asociado_punto_venta') or 0):05d}-"
+            f"{int(comprobante.get('asociado_numero_comprobante') or 0):08d} "
+            f"del {comprobante.get('asociado_fecha_comprobante') or ''}"))
+
+    # Importes
+    filas = [("Importe Neto Gravado 21%", comprobante.get("neto")), ("IVA 21%", comprobante.get("iva")),
+             ("Importe Neto Gravado 10,5%", comprobante.get("neto105")), ("IVA 10,5%", comprobante.get("iva105")),
+             ("Importe Exento", comprobante.get("exento"))]
+    y = 190
+    pdf.set_font("Arial", "", 10)
+    for etiqueta, valor in filas:
+        if valor:
+            pdf.set_xy(110, y)
+            pdf.cell(55, 6, _texto(etiqueta + ":"), align="R")
+            pdf.cell(30, 6, _importe(valor), align="R")
+            y += 6
+    pdf.set_xy(110, y + 2)
+    pdf.set_font("Arial", "B", 12)
+    pdf.cell(55, 8, "Importe Total:", align="R")
+    pdf.cell(30, 8, _importe(comprobante.get("total")), align="R")
+
+    # Pie: QR de AFIP y CAE
+    pdf.rect(10, 240, 190, 45)
+    _dibujar_qr(pdf, comprobante.get("qr") or url_qr(plantilla.cuit, comprobante), x=14, y=244, lado=37)
+    pdf.set_xy(120, 256)
+    pdf.set_font("Arial", "B", 10)
+    pdf.cell(75, 6, _texto(f"CAE N°: {comprobante.get('cae') or ''}"), ln=2, align="R")
+    pdf.cell(75, 6, _texto(f"Fecha de Vto. de CAE: {comprobante.get('vencimiento_cae') or ''}"), ln=2, align="R")
+    pdf.set_xy(56, 262)
+    pdf.set_font("Arial", "I", 8)
+    pdf.cell(60, 5, "Comprobante Autorizado")
+
+    return pdf.output(dest="S").encode("latin-1")
+
+
+def nombre_archivo(emisor: Dict[str, Any], comprobante: Dict[str, Any]) -> str:
+    return (f"{emisor.get('cuit') or 'comprobante'}_{int(comprobante.get('tipo_afip') or 0):03d}_"
+            f"{int(comprobante.get('punto_venta') or 0):05d}_{int(comprobante.get('numero_comprobante') or 0):08d}.pdf")
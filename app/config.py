@@ -1,4 +1,5 @@
 # app/config.py
+import os
 
 # URLs para el servicio de autenticación (WSAA)
 URL_WSAA_HOMO = "https://wsaahomo.afip.gov.ar/ws/services/LoginCms?wsdl"
@@ -11,4 +12,149 @@ URL_WSFEv1_PROD = "https://servicios1.afip.gov.ar/wsfev1/service.asmx?WSDL"
 # Ruta para el caché de tickets de acceso. Puede ser un directorio temporal.
 CACHE = "/tmp/pyafipws_cache"
 
-# Aquí podrías añadir más configuraciones en el futuro si las necesitas.
+# --- Gateway AFIP (proceso único dueño de las sesiones con AFIP) ---
+# Si se define un socket, los workers de gunicorn no hablan con AFIP: envían
+# cada comprobante al gateway por un Unix socket local.
+AFIP_GATEWAY_SOCKET = os.getenv("AFIP_GATEWAY_SOCKET", "")
+# "master": gunicorn lanza el gateway como proceso hijo del master.
+# "sidecar": el gateway corre aparte con `python -m app.afip_gateway`.
+AFIP_GATEWAY_MODO = os.getenv("AFIP_GATEWAY_MODO", "master").lower()
+# Segundos que un worker espera la respuesta del gateway.
+AFIP_GATEWAY_TIMEOUT = float(os.getenv("AFIP_GATEWAY_TIMEOUT", "120"))
+# Segundos entre revisiones del gateway lanzado por el master (modo "master"),
+# que lo relanza si el proceso murió.
+AFIP_GATEWAY_SUPERVISION = float(os.getenv("AFIP_GATEWAY_SUPERVISION", "5"))
+
+# --- Transporte HTTPS para las llamadas SOAP (pysimplesoap) ---
+# Pool de conexiones persistentes por host con reutilización de sesión TLS.
+# Con AFIP_HTTP_POOL=FALSE se vuelve al transporte httplib2 de pysimplesoap.
+AFIP_HTTP_POOL = os.getenv("AFIP_HTTP_POOL", "TRUE").upper() == "TRUE"
+# Conexiones ociosas que se conservan por host.
+AFIP_HTTP_POOL_SIZE = int(os.getenv("AFIP_HTTP_POOL_SIZE", "4"))
+# Segundos tras los cuales una conexión ociosa se descarta.
+AFIP_HTTP_IDLE_TIMEOUT = float(os.getenv("AFIP_HTTP_IDLE_TIMEOUT", "60"))
+AFIP_HTTP_CONNECT_TIMEOUT = float(os.getenv("AFIP_HTTP_CONNECT_TIMEOUT", "10"))
+# 0 = usar el timeout que indique pyafipws al conectar.
+AFIP_HTTP_READ_TIMEOUT = float(os.getenv("AFIP_HTTP_READ_TIMEOUT", "0"))
+
+# --- Limitación de tasa y control de admisión ---
+# Token bucket por CUIT y límite global de emisiones contra AFIP, compartidos
+# entre workers mediante un archivo SQLite. Sin token disponible se responde
+# 429 de inmediato; los turnos de emisión del proceso se reparten entre
+# tenants con una cola justa ponderada (WFQ) y si la cola de un tenant se
+# llena también se responde 429.
+AFIP_LIMITE_HABILITADO = os.getenv("AFIP_LIMITE_HABILITADO", "TRUE").upper() == "TRUE"
+AFIP_LIMITE_DB = os.getenv("AFIP_LIMITE_DB", "/tmp/afip_limites.sqlite")
+# Emisiones por segundo y ráfaga máxima por CUIT.
+AFIP_LIMITE_TASA_TENANT = float(os.getenv("AFIP_LIMITE_TASA_TENANT", "5"))
+AFIP_LIMITE_RAFAGA_TENANT = float(os.getenv("AFIP_LIMITE_RAFAGA_TENANT", "10"))
+# Emisiones por segundo y ráfaga máxima contra AFIP para todo el servicio.
+AFIP_LIMITE_TASA_GLOBAL = float(os.getenv("AFIP_LIMITE_TASA_GLOBAL", "20"))
+AFIP_LIMITE_RAFAGA_GLOBAL = float(os.getenv("AFIP_LIMITE_RAFAGA_GLOBAL", "40"))
+# Emisiones simultáneas que el proceso deja avanzar hacia AFIP.
+AFIP_LIMITE_CONCURRENCIA = int(os.getenv("AFIP_LIMITE_CONCURRENCIA", "4"))
+# Solicitudes en espera por CUIT antes de responder 429.
+AFIP_LIMITE_COLA_TENANT = int(os.getenv("AFIP_LIMITE_COLA_TENANT", "20"))
+# Segundos máximos que una solicitud espera un turno de emisión (y luego el conector AFIP) antes de responder 429.
+AFIP_LIMITE_ESPERA_MAX = float(os.getenv("AFIP_LIMITE_ESPERA_MAX", "10"))
+# Pesos por CUIT para la cola justa, p. ej. "20123456789:2,30711111111:0.5".
+AFIP_LIMITE_PESOS = os.getenv("AFIP_LIMITE_PESOS", "")
+
+# --- Perfilado bajo demanda de /facturador ---
+# Se activa por solicitud con la cabecera X-Afip-Perfil igual a este token,
+# o al azar según AFIP_PERFIL_MUESTREO (0.0 a 1.0). Sin ambos no tiene costo.
+AFIP_PERFIL_TOKEN = os.getenv("AFIP_PERFIL_TOKEN", "")
+AFIP_PERFIL_MUESTREO = float(os.getenv("AFIP_PERFIL_MUESTREO", "0"))
+# Directorio donde se escriben los perfiles (.prof, formato pstats).
+AFIP_PERFIL_DIR = os.getenv("AFIP_PERFIL_DIR", "/tmp/afip_perfiles")
+
+# --- Micro-lotes automáticos de FECAESolicitar ---
+# Agrupa solicitudes concurrentes del mismo CUIT, tipo y punto de venta en un
+# único FECAESolicitar. Solo tiene efecto con concurrencia real (gateway AFIP
+# o workers con hilos).
+AFIP_LOTE_HABILITADO = os.getenv("AFIP_LOTE_HABILITADO", "FALSE").upper() == "TRUE"
+# Milisegundos que se espera a que lleguen más comprobantes al lote.
+AFIP_LOTE_VENTANA_MS = float(os.getenv("AFIP_LOTE_VENTANA_MS", "5"))
+# Comprobantes máximos por lote.
+AFIP_LOTE_MAX = int(os.getenv("AFIP_LOTE_MAX", "50"))
+
+# --- Registro de credenciales por tenant ---
+# Clave Fernet (base64 urlsafe de 32 bytes) con la que se cifran certificado y
+# clave privada en disco. Sin ella el registro queda deshabilitado y solo se
+# aceptan credenciales en línea.
+AFIP_REGISTRO_CLAVE = os.getenv("AFIP_REGISTRO_CLAVE", "")
+AFIP_REGISTRO_DB = os.getenv("AFIP_REGISTRO_DB", "/tmp/afip_tenants.sqlite")
+# Segundos que un proceso conserva en memoria las credenciales descifradas.
+AFIP_REGISTRO_CACHE_TTL = float(os.getenv("AFIP_REGISTRO_CACHE_TTL", "300"))
+# Token requerido en la cabecera X-Admin-Token por los endpoints de administración.
+AFIP_ADMIN_TOKEN = os.getenv("AFIP_ADMIN_TOKEN", "")
+
+# --- Outbox de comprobantes (store-and-forward) ---
+# Con el outbox habilitado, /facturador/outbox acepta el comprobante, lo
+# guarda en SQLite y responde "pendiente"; un drenador en segundo plano lo
+# emite cuando AFIP responde, en orden por CUIT y punto de venta.
+AFIP_OUTBOX_HABILITADO = os.getenv("AFIP_OUTBOX_HABILITADO", "FALSE").upper() == "TRUE"
+AFIP_OUTBOX_DB = os.getenv("AFIP_OUTBOX_DB", "/tmp/afip_outbox.sqlite")
+# Comprobantes por segundo que emite el drenador de cada proceso.
+AFIP_OUTBOX_TASA = float(os.getenv("AFIP_OUTBOX_TASA", "2"))
+# Segundos entre revisiones del outbox cuando no hay nada listo para emitir.
+AFIP_OUTBOX_INTERVALO = float(os.getenv("AFIP_OUTBOX_INTERVALO", "5"))
+# Espera máxima en segundos entre reintentos de un comprobante (backoff exponencial).
+AFIP_OUTBOX_BACKOFF_MAX = float(os.getenv("AFIP_OUTBOX_BACKOFF_MAX", "300"))
+
+# --- Webhooks de resultados de emisión ---
+# Notifica a la URL registrada por cada CUIT el resultado de los comprobantes
+# emitidos en segundo plano (outbox), en lotes firmados con HMAC-SHA256.
+AFIP_WEBHOOK_HABILITADO = os.getenv("AFIP_WEBHOOK_HABILITADO", "FALSE").upper() == "TRUE"
+AFIP_WEBHOOK_DB = os.getenv("AFIP_WEBHOOK_DB", "/tmp/afip_webhooks.sqlite")
+# Envíos simultáneos por proceso (tamaño del pool de hilos y de conexiones).
+AFIP_WEBHOOK_HILOS = int(os.getenv("AFIP_WEBHOOK_HILOS", "4"))
+# Eventos máximos por POST a un mismo destino.
+AFIP_WEBHOOK_LOTE_MAX = int(os.getenv("AFIP_WEBHOOK_LOTE_MAX", "50"))
+AFIP_WEBHOOK_TIMEOUT = float(os.getenv("AFIP_WEBHOOK_TIMEOUT", "10"))
+# Intentos antes de pasar un evento a la lista de entregas fallidas (dead-letter).
+AFIP_WEBHOOK_INTENTOS_MAX = int(os.getenv("AFIP_WEBHOOK_INTENTOS_MAX", "8"))
+AFIP_WEBHOOK_BACKOFF_MAX = float(os.getenv("AFIP_WEBHOOK_BACKOFF_MAX", "600"))
+
+# --- Plazos de solicitud ---
+# Plazo en segundos para las emisiones que no traen X-Request-Deadline ni
+# X-Request-Timeout (0 = sin plazo, como hasta ahora).
+AFIP_PLAZO_DEFECTO = float(os.getenv("AFIP_PLAZO_DEFECTO", "0"))
+# Segundos mínimos que deben quedar del plazo para intentar un reintento.
+AFIP_PLAZO_MINIMO_REINTENTO = float(os.getenv("AFIP_PLAZO_MINIMO_REINTENTO", "3"))
+
+# --- Reparto de comprobantes entre puntos de venta ---
+# Archivo SQLite con los puntos de venta registrados por CUIT (/tenants/<cuit>/puntos-venta).
+AFIP_PV_DB = os.getenv("AFIP_PV_DB", "/tmp/afip_puntos_venta.sqlite")
+
+# --- Impresión de comprobantes (PDF) ---
+# Procesos del pool que genera los PDF (0 = uno por CPU).
+AFIP_PDF_PROCESOS = int(os.getenv("AFIP_PDF_PROCESOS", "0"))
+# Comprobantes máximos por solicitud a /comprobantes/pdf (cada uno ocupa un proceso del pool).
+AFIP_PDF_MAX_LOTE = int(os.getenv("AFIP_PDF_MAX_LOTE", "500"))
+
+# --- Libro IVA ventas ---
+# Con el libro habilitado cada comprobante autorizado se anota en SQLite y
+# actualiza los totales diarios y mensuales por CUIT, tipo y punto de venta.
+AFIP_LIBRO_IVA_HABILITADO = os.getenv("AFIP_LIBRO_IVA_HABILITADO", "FALSE").upper() == "TRUE"
+AFIP_LIBRO_IVA_DB = os.getenv("AFIP_LIBRO_IVA_DB", "/tmp/afip_libro_iva.sqlite")
+# Filas por bloque (y por row group en Parquet) al exportar comprobantes.
+AFIP_EXPORT_LOTE = int(os.getenv("AFIP_EXPORT_LOTE", "10000"))
+
+# --- Sondas de salud (/salud/vivo y /salud/listo) ---
+# Un hilo por worker sondea AFIP (FEDummy) y el estado interno cada
+# AFIP_SALUD_INTERVALO segundos (0 = sin sondeo); las sondas solo leen el
+# último resultado. El resultado de AFIP se comparte entre los workers por
+# SQLite: un FEDummy por entorno e intervalo en cada contenedor.
+AFIP_SALUD_INTERVALO = float(os.getenv("AFIP_SALUD_INTERVALO", "30"))
+# FEDummy de fondo contra AFIP (tráfico saliente adicional): solo si se habilita.
+AFIP_SALUD_FEDUMMY = os.getenv("AFIP_SALUD_FEDUMMY", "FALSE").upper() == "TRUE"
+# Entornos a sondear, separados por coma: produccion, homologacion. Por omisión
+# produccion, el único contra el que emite facturar().
+AFIP_SALUD_ENTORNOS = os.getenv("AFIP_SALUD_ENTORNOS", "produccion")
+AFIP_SALUD_TIMEOUT = float(os.getenv("AFIP_SALUD_TIMEOUT", "10"))
+# FEDummy fallidos seguidos que abren el circuito de un entorno (la réplica se informa degradada).
+AFIP_SALUD_FALLOS_MAX = int(os.getenv("AFIP_SALUD_FALLOS_MAX", "3"))
+# Segundos de vigencia restante por debajo de los cuales un TA se informa como por vencer.
+AFIP_SALUD_TA_MARGEN = float(os.getenv("AFIP_SALUD_TA_MARGEN", "600"))
+AFIP_SALUD_DB = os.getenv("AFIP_SALUD_DB", "/tmp/afip_salud.sqlite")
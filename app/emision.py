@@ -0,0 +1,123 @@
+# app/emision.py
+"""
+Punto único de emisión de comprobantes usado por las rutas.
+
+Decide si el comprobante se autoriza en este proceso o se delega al gateway
+AFIP (ver `app/afip_gateway.py`) cuando el modo gateway está habilitado.
+"""
+import hashlib
+from contextlib import contextmanager, nullcontext
+from typing import Any, Dict, List, Optional
+
+from app.afip_connector import AfipConnector, afip_conector
+from app.afip_gateway import gateway_cliente
+from app.config import AFIP_LIMITE_ESPERA_MAX
+from app.comprobante_pdf import url_qr
+from app.factura_electronica import facturar, facturar_lote
+from app.libro_iva import libro_iva
+from app.limitador import LimiteExcedido, control_admision
+from app.logger_setup import logger
+from app.lotes import coalescedor
+from app.plazos import esperar
+from app.puntos_venta import reparto_pv
+from app.tenants import resolver_credenciales
+
+
+def emitir(credenciales: Dict[str, str], datos_factura: Dict[str, Any]) -> Dict[str, Any]:
+    """Emite el comprobante, localmente o a través del gateway AFIP."""
+    if gateway_cliente is not None:
+        return gateway_cliente.facturar(credenciales, datos_factura)
+    return emitir_local(credenciales, datos_factura)
+
+
+def _huella_credenciales(credenciales: Dict[str, Any]) -> str:
+    """Identifica certificado y clave sin guardarlos en la clave del micro-lote."""
+    material = "\0".join(str(credenciales.get(campo) or "") for campo in ("certificado", "clave_privada"))
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+def _admision(cuit: Optional[str]):
+    return control_admision.admitir(cuit) if control_admision and cuit else nullcontext()
+
+
+@contextmanager
+def _conector_tomado(conector: AfipConnector, cuit: Optional[str]):
+    """
+    Lock del conector, esperado a lo sumo AFIP_LIMITE_ESPERA_MAX y nunca más
+    allá del plazo de la solicitud. Se toma después de la admisión: si no se
+    consigue, los tokens de la admisión se reintegran porque AFIP no se llamó.
+    """
+    tomado = False
+    try:
+        tomado = esperar(lambda segundos: conector.lock.acquire(timeout=-1 if segundos is None else segundos),
+                         "el conector AFIP", AFIP_LIMITE_ESPERA_MAX)
+        if not tomado:
+            raise LimiteExcedido(f"Conector AFIP ocupado para CUIT {cuit}", retry_after=AFIP_LIMITE_ESPERA_MAX)
+    finally:
+        if not tomado and control_admision and cuit:
+            control_admision.devolver_tokens(cuit)
+    try:
+        yield
+    finally:
+        conector.lock.release()
+
+
+def emitir_local(credenciales: Dict[str, str], datos_factura: Dict[str, Any],
+                 conector: Optional[AfipConnector] = None) -> Dict[str, Any]:
+    """
+    Emite el comprobante hablando directamente con AFIP desde este proceso,
+    previa admisión por el limitador de tasa (puede lanzar `LimiteExcedido`).
+    Si las credenciales no traen certificado y clave se toman del registro
+    de tenants; si los datos no traen `punto_venta` y el CUIT tiene puntos de
+    venta registrados, se asigna uno de ellos.
+
+    Con micro-lotes habilitados, las solicitudes concurrentes del mismo CUIT,
+    tipo, punto de venta y credenciales se agrupan en un único FECAESolicitar; el lote
+    completo pasa una sola vez por el limitador.
+
+    La respuesta incluye en `qr` la URL del código QR de AFIP del comprobante.
+    Con el libro IVA habilitado, el comprobante autorizado se suma a sus totales.
+    """
+    credenciales = resolver_credenciales(credenciales)
+    cuit = credenciales.get("cuit")
+
+    with (reparto_pv.carril(cuit, datos_factura) if reparto_pv else nullcontext(datos_factura)) as datos_factura:
+        # Los puntos de venta repartidos tienen su propio conector: emiten en paralelo.
+        carril = reparto_pv.conector(cuit, datos_factura.get("punto_venta")) if reparto_pv else None
+        conector = carril or conector or afip_conector
+
+        if coalescedor is not None and cuit:
+            def ejecutar_lote(lote: List[Dict[str, Any]]) -> List[Any]:
+                with _admision(cuit), _conector_tomado(conector, cuit):
+                    return facturar_lote(credenciales, lote, conector=conector)
+
+            # Con las credenciales en la clave, nadie se autoriza con el certificado de otro.
+            clave = (cuit, datos_factura.get("tipo_afip"), datos_factura.get("punto_venta"),
+                     _huella_credenciales(credenciales))
+            return _autorizado(cuit, coalescedor.enviar(clave, datos_factura, ejecutar_lote))
+
+        # Primero la admisión: la cola justa decide el orden y luego se espera el conector.
+        with _admision(cuit), _conector_tomado(conector, cuit):
+            resultado = facturar(credenciales, datos_factura, conector=conector)
+        return _autorizado(cuit, resultado)
+
+
+def _autorizado(cuit: Optional[str], resultado: Dict[str, Any]) -> Dict[str, Any]:
+    """Completa la respuesta de un comprobante con CAE: QR y libro IVA."""
+    if not (cuit and isinstance(resultado, dict) and resultado.get("cae")):
+        return resultado
+    try:
+        resultado["qr"] = url_qr(cuit, resultado)
+    except Exception as e:
+        # Igual que con el libro: un QR que no se pudo armar no invalida el CAE.
+        logger.error("No se pudo generar el QR del comprobante %s-%s de CUIT %s: %s",
+                     resultado.get("punto_venta"), resultado.get("numero_comprobante"), cuit, e)
+        resultado["qr"] = None
+    if libro_iva is not None:
+        try:
+            libro_iva.anotar(cuit, resultado)
+        except Exception as e:
+            # El CAE ya fue otorgado: no se pierde la respuesta por un fallo del libro.
+            logger.error("No se pudo anotar en el libro IVA el comprobante %s-%s de CUIT %s: %s",
+                         resultado.get("punto_venta"), resultado.get("numero_comprobante"), cuit, e)
+    return resultado
@@ -0,0 +1,157 @@
+# app/exportacion.py
+"""
+Exportación en flujo de los comprobantes autorizados de un CUIT (CSV o Parquet).
+
+Los comprobantes salen del registro del libro IVA (ver `app/libro_iva.py`)
+en bloques de AFIP_EXPORT_LOTE filas. Cada bloque se escribe y se entrega
+antes de leer el siguiente: en CSV como líneas de texto, en Parquet como un
+row group. La memoria depende del tamaño del bloque y no del total de filas.
+
+Las columnas son las de `factura_response_model`, en el mismo orden.
+
+Desde la línea de comandos:
+
+    python -m app.exportacion CUIT DESDE HASTA [--formato parquet] [--salida archivo|-]
+"""
+import argparse
+import csv
+import io
+import sys
+from typing import Any, Dict, Iterator, List, Optional
+
+from app.config import AFIP_EXPORT_LOTE, AFIP_LIBRO_IVA_DB
+from app.libro_iva import LibroIva, libro_iva
+from app.logger_setup import logger
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet es opcional; CSV funciona sin pyarrow.
+    pa = pq = None
+
+FORMATOS = {"csv": ("text/csv", "csv"), "parquet": ("application/vnd.apache.parquet", "parquet")}
+
+# Columnas de factura_response_model, en su orden, con su tipo.
+COLUMNAS = (
+    ("tipo_documento", int), ("documento", str), ("tipo_afip", int), ("punto_venta", int),
+    ("total", float), ("exento", float), ("neto", float), ("neto105", float), ("iva", float), ("iva105", float),
+    ("resultado", str), ("cae", str), ("vencimiento_cae", str), ("numero_comprobante", int),
+    ("fecha_comprobante", str), ("asociado_tipo_afip", int), ("asociado_punto_venta", int),
+    ("asociado_numero_comprobante", int), ("asociado_fecha_comprobante", str), ("id_condicion_iva", int),
+    ("qr", str),
+)
+
+
+class _Salida(io.RawIOBase):
+    """Destino de escritura que acumula lo escrito hasta que se lo vacía."""
+
+    def __init__(self):
+        super().__init__()
+        self._partes: List[bytes] = []
+        self._posicion = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, datos) -> int:
+        datos = bytes(datos)
+        self._partes.append(datos)
+        self._posicion += len(datos)
+        return len(datos)
+
+    def tell(self) -> int:
+        return self._posicion
+
+    def vaciar(self) -> bytes:
+        datos = b"".join(self._partes)
+        self._partes.clear()
+        return datos
+
+
+def _valor(valor: Any, tipo: type) -> Any:
+    # El documento puede haberse enviado como número: se respeta el tipo de la columna.
+    return None if valor is None else tipo(valor)
+
+
+def _csv(bloques: Iterator[List[Dict[str, Any]]]) -> Iterator[bytes]:
+    texto = io.StringIO()
+    escritor = csv.writer(texto)
+    escritor.writerow([columna for columna, _ in COLUMNAS])
+    for bloque in bloques:
+        escritor.writerows([[comprobante.get(columna) for columna, _ in COLUMNAS] for comprobante in bloque])
+        yield texto.getvalue().encode("utf-8")
+        texto.seek(0)
+        texto.truncate()
+    yield texto.getvalue().encode("utf-8")
+
+
+def _parquet(bloques: Iterator[List[Dict[str, Any]]]) -> Iterator[bytes]:
+    tipos = {int: pa.int64(), float: pa.float64(), str: pa.string()}
+    esquema = pa.schema([(columna, tipos[tipo]) for columna, tipo in COLUMNAS])
+    salida = _Salida()
+    escritor = pq.ParquetWriter(pa.PythonFile(salida, mode="w"), esquema, compression="snappy")
+    try:
+        for bloque in bloques:
+            columnas = [pa.array([_valor(comprobante.get(columna), tipo) for comprobante in bloque], type=tipos[tipo])
+                        for columna, tipo in COLUMNAS]
+            # Un row group por bloque: se escribe entero y se entrega.
+            escritor.write_table(pa.Table.from_arrays(columnas, schema=esquema))
+            yield salida.vaciar()
+    finally:
+        escritor.close()
+    yield salida.vaciar()
+
+
+def exportar(cuit: str, desde: Any, hasta: Any, formato: str = "csv", tipo_afip: Optional[int] = None,
+             punto_venta: Optional[int] = None, libro: Optional[LibroIva] = None) -> Iterator[bytes]:
+    """
+    Archivo CSV o Parquet con los comprobantes autorizados del período,
+    entregado en partes. Valida los parámetros antes de devolver el generador.
+    """
+    libro = libro or libro_iva
+    if libro is None:
+        raise ValueError("La exportación requiere el libro IVA habilitado (AFIP_LIBRO_IVA_HABILITADO)")
+    if formato not in FORMATOS:
+        raise ValueError(f"Formato inválido: {formato} (valores admitidos: {', '.join(FORMATOS)})")
+    if formato == "parquet" and pq is None:
+        raise ValueError("El formato parquet requiere pyarrow instalado")
+    bloques = libro.recorrer(cuit, desde, hasta, tipo_afip=tipo_afip, punto_venta=punto_venta, tamano=AFIP_EXPORT_LOTE)
+    # La primera lectura valida las fechas antes de empezar a responder.
+    primero = next(bloques, [])
+
+    def todos() -> Iterator[List[Dict[str, Any]]]:
+        if primero:
+            yield primero
+            yield from bloques
+
+    logger.info("Exportando comprobantes de CUIT %s (%s a %s) en %s", cuit, desde, hasta, formato)
+    return _parquet(todos()) if formato == "parquet" else _csv(todos())
+
+
+def nombre_archivo(cuit: str, desde: Any, hasta: Any, formato: str) -> str:
+    return f"comprobantes_{cuit}_{desde}_{hasta}.{FORMATOS[formato][1]}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Exporta los comprobantes autorizados de un CUIT")
+    parser.add_argument("cuit")
+    parser.add_argument("desde", help="Fecha inicial AAAA-MM-DD (inclusive)")
+    parser.add_argument("hasta", help="Fecha final AAAA-MM-DD (inclusive)")
+    parser.add_argument("--formato", choices=tuple(FORMATOS), default="csv")
+    parser.add_argument("--tipo-afip", type=int, help="Solo este tipo de comprobante")
+    parser.add_argument("--punto-venta", type=int, help="Solo este punto de venta")
+    parser.add_argument("--salida", help="Archivo de salida (por omisión, comprobantes_<cuit>_<desde>_<hasta>.<formato>; "
+                                         "'-' para la salida estándar)")
+    argumentos = parser.parse_args()
+    # Igual que la reconstrucción del libro: se usa aunque el servicio no lo tenga habilitado.
+    partes = exportar(argumentos.cuit, argumentos.desde, argumentos.hasta, argumentos.formato,
+                      tipo_afip=argumentos.tipo_afip, punto_venta=argumentos.punto_venta,
+                      libro=libro_iva or LibroIva(AFIP_LIBRO_IVA_DB))
+    salida = argumentos.salida or nombre_archivo(argumentos.cuit, argumentos.desde, argumentos.hasta, argumentos.formato)
+    destino = sys.stdout.buffer if salida == "-" else open(salida, "wb")
+    try:
+        for parte in partes:
+            destino.write(parte)
+    finally:
+        if destino is not sys.stdout.buffer:
+            destino.close()
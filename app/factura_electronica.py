@@ -1,58 +1,148 @@
 # app/factura_electronica.py
 import datetime
 import ssl
-from typing import Dict, Any
-import logging
+from typing import Dict, Any, List, Optional
 from app.logger_setup import logger
-from app.afip_connector import afip_conector
-
-def facturar(credenciales: Dict[str, str], datos_factura: Dict[str, Any], production: bool = True) -> Dict[str, Any]:
-    """
-    Emite facturas electrónicas con CAE AFIP utilizando un conector dinámico.
-    """
-    logger.debug(f"Iniciando facturación para CUIT: {credenciales.get('cuit')}")
-    logging.basicConfig(level=logging.DEBUG)
+from app.perfilado import fase
+from app.plazos import EnvioIncierto, PlazoAgotado, verificar, puede_reintentar
+from app.afip_connector import AfipConnector, afip_conector
 
+def _conectar_con_reintentos(conector: AfipConnector, credenciales: Dict[str, str]):
+    """Conecta con AFIP reintentando una vez con reconexión forzada."""
     # Intentar conectar con reintentos en caso de problemas de conexión
     max_reintentos = 2
     for intento in range(max_reintentos):
         try:
             force_reconnect = intento > 0  # Forzar reconexión en reintentos
-            wsfev1 = afip_conector.conectar(credenciales, production=True, force_reconnect=force_reconnect)
-            break
+            return conector.conectar(credenciales, production=True, force_reconnect=force_reconnect)
         except Exception as e:
             # Si la excepción es ValueError (p. ej. PEM inválido), considerarla error de entrada
-            logger.error(f"Intento {intento + 1}/{max_reintentos} - Fallo al conectar/autenticar con AFIP: {e}")
-            if isinstance(e, ValueError):
-                # Propagar ValueError para que la capa de rutas retorne 400
+            logger.error("Intento %s/%s - Fallo al conectar/autenticar con AFIP: %s", intento + 1, max_reintentos, e)
+            if isinstance(e, (ValueError, PlazoAgotado)):
+                # Propagar ValueError para que la capa de rutas retorne 400 (y PlazoAgotado, 504)
                 raise
-            if intento == max_reintentos - 1:  # Último intento
-                logger.error(f"Fallo definitivo de autenticación AFIP después de {max_reintentos} intentos", exc_info=True)
+            if intento == max_reintentos - 1 or not puede_reintentar("la conexión con AFIP"):  # Último intento
+                logger.error("Fallo definitivo de autenticación AFIP después de %s intentos", max_reintentos, exc_info=True)
                 raise RuntimeError(f"Fallo de autenticación AFIP: {e}")
 
+
+def _es_error_de_conexion(error: Exception) -> bool:
+    """Errores de conexión/SSL (o de pyafipws al indexar excepciones internas) que se resuelven reconectando."""
+    error_msg = str(error)
+    return (
+        isinstance(error, (ConnectionResetError, ConnectionError)) or
+        "Connection reset by peer" in error_msg or
+        "SSL" in error_msg or
+        "ssl" in error_msg.lower() or
+        "not subscriptable" in error_msg
+    )
+
+
+def _es_error_de_token(errores: str) -> bool:
+    """Rechazo de AFIP por un TA vencido o inválido."""
+    error_str = str(errores).lower()
+    return any(keyword in error_str for keyword in ["token", "validacion", "fechas", "gentime", "exptime"])
+
+
+def _limpiar_cache_tokens() -> None:
+    try:
+        import glob, os
+        from app.config import CACHE
+        cache_files = glob.glob(f"{CACHE}/*")
+        for cache_file in cache_files:
+            os.remove(cache_file)
+        logger.info("Cache de tokens limpiado exitosamente. Reintentando facturación...")
+    except Exception as cache_err:
+        logger.error("Error al limpiar cache de tokens: %s", cache_err)
+
+
+def _llamar_con_reconexion(conector: AfipConnector, credenciales: Dict[str, str], wsfev1, operacion,
+                           paso: str, nombre_fase: str):
+    """
+    Ejecuta `operacion(wsfev1)` con la recuperación de `facturar`: ante un
+    TypeError de pyafipws o un error de conexión/SSL fuerza la reconexión y
+    reintenta una vez con el cliente nuevo. Devuelve el resultado y el
+    cliente con el que se obtuvo.
+    """
+    max_reintentos = 2
+    for intento in range(max_reintentos):
+        verificar(paso)
+        try:
+            with fase(nombre_fase):
+                return operacion(wsfev1), wsfev1
+        except Exception as error:
+            logger.warning("Error %s al %s (intento %s): %s", type(error).__name__, paso, intento + 1, error)
+            if not (isinstance(error, TypeError) or _es_error_de_conexion(error)):
+                raise
+            if intento == max_reintentos - 1 or not puede_reintentar(paso):
+                raise ConnectionError(f"Fallo de conexión al {paso} después de {intento + 1} intentos: {error}")
+            logger.info("Forzando reconexión para %s (intento %s)...", paso, intento + 1)
+            wsfev1 = conector.conectar(credenciales, production=True, force_reconnect=True)
+
+
+def _armar_respuesta(datos_factura: Dict[str, Any], resultado: str, cae: str, vencimiento_cae: str,
+                     numero_comprobante: int) -> Dict[str, Any]:
+    """JSON de respuesta que coincide con el modelo factura_response_model."""
+    return {
+        "tipo_documento": datos_factura.get("tipo_documento"),
+        "documento": datos_factura.get("documento"),
+        "tipo_afip": datos_factura.get("tipo_afip"),
+        "punto_venta": datos_factura.get("punto_venta"),
+        "total": float(datos_factura.get("total", 0.0)),
+        "exento": float(datos_factura.get("exento", 0.0)),
+        "neto": float(datos_factura.get("neto", 0.0)),
+        "neto105": float(datos_factura.get("neto105", 0.0)),
+        "iva": float(datos_factura.get("iva", 0.0)),
+        "iva105": float(datos_factura.get("iva105", 0.0)),
+        "resultado": resultado,
+        "cae": cae,
+        "vencimiento_cae": vencimiento_cae,
+        "numero_comprobante": int(numero_comprobante),
+        "fecha_comprobante": datetime.date.today().strftime("%Y-%m-%d"),
+        "asociado_tipo_afip": datos_factura.get("asociado_tipo_afip"),
+        "asociado_punto_venta": datos_factura.get("asociado_punto_venta"),
+        "asociado_numero_comprobante": datos_factura.get("asociado_numero_comprobante"),
+        "asociado_fecha_comprobante": datos_factura.get("asociado_fecha_comprobante"),
+        "id_condicion_iva": datos_factura.get("id_condicion_iva")
+    }
+
+
+def facturar(credenciales: Dict[str, str], datos_factura: Dict[str, Any], production: bool = True,
+             conector: Optional[AfipConnector] = None) -> Dict[str, Any]:
+    """
+    Emite facturas electrónicas con CAE AFIP utilizando un conector dinámico.
+
+    Si no se indica `conector` se usa la instancia única del proceso; el gateway
+    AFIP pasa uno propio por CUIT para no invalidar la sesión de otros tenants.
+    """
+    if conector is None:
+        conector = afip_conector
+    logger.debug("Iniciando facturación para CUIT: %s", credenciales.get('cuit'))
+
+    wsfev1 = _conectar_con_reintentos(conector, credenciales)
+    # Solicitudes de CAE que salieron sin que llegara su respuesta.
+    envios_sin_respuesta = 0
+
     try:
         tipo_cbte = datos_factura.get("tipo_afip")
         punto_vta = datos_factura.get("punto_venta")
-        asoc_tipo = datos_factura.get("asociado_tipo_afip")
-        asoc_punto_vta = datos_factura.get("asociado_punto_venta")
-        asoc_nro = datos_factura.get("asociado_numero_comprobante")
-        asoc_fecha = datos_factura.get("asociado_fecha_comprobante")
-        es_nota = tipo_cbte in [3, 8, 13, 2, 7, 12]
         
         # Intentar obtener último comprobante con manejo robusto de errores
         max_reintentos_operacion = 2
         for intento_op in range(max_reintentos_operacion):
+            verificar("consultar el último comprobante")
             try:
-                ultimo_cbte = wsfev1.CompUltimoAutorizado(tipo_cbte, punto_vta)
+                with fase("ultimo_cbte"):
+                    ultimo_cbte = wsfev1.CompUltimoAutorizado(tipo_cbte, punto_vta)
                 break
             except TypeError as conn_error:
                 # Algunos errores (p. ej. en pyafipws) lanzan TypeError al indexar excepciones internas.
                 error_msg = str(conn_error)
                 error_type = type(conn_error).__name__
-                logger.warning(f"TypeError tratado como error de conexión al consultar último comprobante (intento {intento_op + 1}): {error_msg}")
-                if intento_op < max_reintentos_operacion - 1:
-                    logger.info(f"Forzando reconexión debido a TypeError (intento {intento_op + 1})...")
-                    wsfev1 = afip_conector.conectar(credenciales, production=True, force_reconnect=True)
+                logger.warning("TypeError tratado como error de conexión al consultar último comprobante (intento %s): %s", intento_op + 1, error_msg)
+                if intento_op < max_reintentos_operacion - 1 and puede_reintentar("el último comprobante"):
+                    logger.info("Forzando reconexión debido a TypeError (intento %s)...", intento_op + 1)
+                    wsfev1 = conector.conectar(credenciales, production=True, force_reconnect=True)
                     continue
                 else:
                     raise ConnectionError(f"Fallo de conexión por TypeError después de {max_reintentos_operacion} intentos: {error_msg}")
@@ -61,21 +151,15 @@ def facturar(credenciales: Dict[str, str], datos_factura: Dict[str, Any], produc
                 error_msg = str(conn_error)
                 error_type = type(conn_error).__name__
                 
-                logger.warning(f"Error {error_type} al consultar último comprobante (intento {intento_op + 1}): {error_msg}")
+                logger.warning("Error %s al consultar último comprobante (intento %s): %s", error_type, intento_op + 1, error_msg)
                 
                 # Detectar errores de conexión/SSL
-                is_connection_error = (
-                    isinstance(conn_error, (ConnectionResetError, ConnectionError)) or
-                    "Connection reset by peer" in error_msg or
-                    "SSL" in error_msg or
-                    "ssl" in error_msg.lower() or
-                    "not subscriptable" in error_msg
-                )
+                is_connection_error = _es_error_de_conexion(conn_error)
                 
-                if is_connection_error and intento_op < max_reintentos_operacion - 1:
-                    logger.info(f"Detectado error de conexión. Intentando reconectar (intento {intento_op + 1})...")
+                if is_connection_error and intento_op < max_reintentos_operacion - 1 and puede_reintentar("el último comprobante"):
+                    logger.info("Detectado error de conexión. Intentando reconectar (intento %s)...", intento_op + 1)
                     # Forzar reconexión
-                    wsfev1 = afip_conector.conectar(credenciales, production=True, force_reconnect=True)
+                    wsfev1 = conector.conectar(credenciales, production=True, force_reconnect=True)
                 else:
                     # Si no es error de conexión o ya agotamos reintentos, re-lanzar
                     if is_connection_error:
@@ -84,99 +168,30 @@ def facturar(credenciales: Dict[str, str], datos_factura: Dict[str, Any], produc
                         raise conn_error
         
         siguiente_cbte = int(ultimo_cbte) + 1
-        logger.info(f"Último comprobante fue {ultimo_cbte}. Siguiente a emitir: {siguiente_cbte}.")
+        logger.info("Último comprobante fue %s. Siguiente a emitir: %s.", ultimo_cbte, siguiente_cbte)
 
-        total = float(datos_factura.get("total", 0.0))
-        
-        # Lógica de importes
-        imp_neto = float(datos_factura.get("neto", 0.0))
-        imp_iva = float(datos_factura.get("iva", 0.0))
-        imp_tot_conc = 0.0
-        imp_op_ex = 0.0
-
-        if tipo_cbte in [11, 12, 13]:
-            # Para Facturas C, el total va en el campo de Neto.
-            imp_neto = total
-            # Todos los otros campos de importes deben ser cero, como lo pide AFIP.
-            imp_iva = 0.0
-            imp_tot_conc = 0.0
- 
-
-        wsfev1.CrearFactura(
-            concepto=1,
-            tipo_doc=datos_factura.get("tipo_documento"),
-            nro_doc=datos_factura.get("documento"),
-            tipo_cbte=tipo_cbte,
-            punto_vta=punto_vta,
-            cbt_desde=siguiente_cbte,
-            cbt_hasta=siguiente_cbte,
-            imp_total=total,
-            imp_neto=imp_neto,
-            imp_iva=imp_iva,
-            imp_tot_conc=imp_tot_conc,
-            imp_op_ex=imp_op_ex,
-            fecha_cbte=datetime.date.today().strftime("%Y%m%d")
-        )
-        if es_nota:
-            if not (asoc_tipo and asoc_punto_vta is not None and asoc_nro and asoc_fecha):
-                raise ValueError("Faltan campos asociado_* para nota crédito/débito")
-            try:
-                asoc_pv_int = int(asoc_punto_vta)
-                asoc_nro_int = int(asoc_nro)
-            except Exception:
-                raise ValueError("Formato inválido en asociado_punto_venta o asociado_numero_comprobante")
-            fecha_asoc = str(asoc_fecha).replace("-", "")
-            wsfev1.AgregarCmpAsoc(asoc_tipo, asoc_pv_int, asoc_nro_int, fecha=fecha_asoc)
-
-        if imp_neto > 0 and not (tipo_cbte in [11, 12, 13]):
-            if imp_iva > 0:
-                logger.info(f"Agregando detalle de IVA (21%) sobre base {imp_neto}")
-                wsfev1.AgregarIva(5, round(imp_neto,2), round(imp_iva,2))
-            else:
-                logger.info(f"Agregando detalle de IVA (0%) sobre base {imp_neto}")
-                wsfev1.AgregarIva(3, round(imp_neto,2), 0.0)
+        _cargar_comprobante(wsfev1, datos_factura, siguiente_cbte)
 
         logger.info("Solicitando CAE a AFIP...")
 
         # Intentar solicitar CAE con manejo robusto de errores
         max_reintentos_cae = 2
         for intento_cae in range(max_reintentos_cae):
+            verificar("solicitar el CAE")
             try:
-                wsfev1.CAESolicitar()
+                with fase("cae"):
+                    envios_sin_respuesta += 1
+                    wsfev1.CAESolicitar()
+                    envios_sin_respuesta -= 1
                 break
             except TypeError as cae_error:
                 # Capturamos TypeError originados por la librería externa y los tratamos como errores de conexión
                 error_msg = str(cae_error)
-                logger.warning(f"TypeError tratado como error de conexión al solicitar CAE (intento {intento_cae + 1}): {error_msg}")
-                if intento_cae < max_reintentos_cae - 1:
-                    logger.info(f"Forzando reconexión por TypeError en CAE (intento {intento_cae + 1})...")
-                    wsfev1 = afip_conector.conectar(credenciales, production=True, force_reconnect=True)
-                    # Recrear factura
-                    wsfev1.CrearFactura(
-                        concepto=1,
-                        tipo_doc=datos_factura.get("tipo_documento"),
-                        nro_doc=datos_factura.get("documento"),
-                        tipo_cbte=tipo_cbte,
-                        punto_vta=punto_vta,
-                        cbt_desde=siguiente_cbte,
-                        cbt_hasta=siguiente_cbte,
-                        imp_total=total,
-                        imp_neto=imp_neto,
-                        imp_iva=imp_iva,
-                        imp_tot_conc=imp_tot_conc,
-                        imp_op_ex=imp_op_ex,
-                        fecha_cbte=datetime.date.today().strftime("%Y%m%d")
-                    )
-                    if es_nota:
-                        fecha_asoc = str(asoc_fecha).replace("-", "")
-                        wsfev1.AgregarCmpAsoc(asoc_tipo, int(asoc_punto_vta), int(asoc_nro), fecha=fecha_asoc)
-                    if imp_neto > 0 and not (tipo_cbte in [11, 12, 13]):
-                        if imp_iva > 0:
-                            logger.info("Reagregando IVA 21% después de reconexión por TypeError")
-                            wsfev1.AgregarIva(5, round(imp_neto,2), round(imp_iva,2))
-                        else:
-                            logger.info("Reagregando IVA 0% después de reconexión por TypeError")
-                            wsfev1.AgregarIva(3, round(imp_neto,2), 0.0)
+                logger.warning("TypeError tratado como error de conexión al solicitar CAE (intento %s): %s", intento_cae + 1, error_msg)
+                if intento_cae < max_reintentos_cae - 1 and puede_reintentar("la solicitud de CAE"):
+                    logger.info("Forzando reconexión por TypeError en CAE (intento %s)...", intento_cae + 1)
+                    wsfev1 = conector.conectar(credenciales, production=True, force_reconnect=True)
+                    _cargar_comprobante(wsfev1, datos_factura, siguiente_cbte)
                     continue
                 else:
                     raise ConnectionError(f"Fallo de conexión por TypeError en CAE después de {max_reintentos_cae} intentos: {error_msg}")
@@ -185,51 +200,18 @@ def facturar(credenciales: Dict[str, str], datos_factura: Dict[str, Any], produc
                 error_msg = str(cae_error)
                 error_type = type(cae_error).__name__
                 
-                logger.warning(f"Error {error_type} al solicitar CAE (intento {intento_cae + 1}): {error_msg}")
+                logger.warning("Error %s al solicitar CAE (intento %s): %s", error_type, intento_cae + 1, error_msg)
                 
                 # Detectar errores de conexión/SSL
-                is_connection_error = (
-                    isinstance(cae_error, (ConnectionResetError, ConnectionError)) or
-                    "Connection reset by peer" in error_msg or
-                    "SSL" in error_msg or
-                    "ssl" in error_msg.lower() or
-                    "not subscriptable" in error_msg
-                )
+                is_connection_error = _es_error_de_conexion(cae_error)
                 
-                if is_connection_error and intento_cae < max_reintentos_cae - 1:
-                    logger.info(f"Detectado error de conexión en CAE. Reconectando y recreando factura (intento {intento_cae + 1})...")
+                if is_connection_error and intento_cae < max_reintentos_cae - 1 and puede_reintentar("la solicitud de CAE"):
+                    logger.info("Detectado error de conexión en CAE. Reconectando y recreando factura (intento %s)...", intento_cae + 1)
                     
                     # Forzar reconexión
-                    wsfev1 = afip_conector.conectar(credenciales, production=True, force_reconnect=True)
-                    
+                    wsfev1 = conector.conectar(credenciales, production=True, force_reconnect=True)
                     # Recrear la factura completa después de reconectar
-                    wsfev1.CrearFactura(
-                        concepto=1,
-                        tipo_doc=datos_factura.get("tipo_documento"),
-                        nro_doc=datos_factura.get("documento"),
-                        tipo_cbte=tipo_cbte,
-                        punto_vta=punto_vta,
-                        cbt_desde=siguiente_cbte,
-                        cbt_hasta=siguiente_cbte,
-                        imp_total=total,
-                        imp_neto=imp_neto,
-                        imp_iva=imp_iva,
-                        imp_tot_conc=imp_tot_conc,
-                        imp_op_ex=imp_op_ex,
-                        fecha_cbte=datetime.date.today().strftime("%Y%m%d")
-                    )
-                    if es_nota:
-                        fecha_asoc = str(asoc_fecha).replace("-", "")
-                        wsfev1.AgregarCmpAsoc(asoc_tipo, int(asoc_punto_vta), int(asoc_nro), fecha=fecha_asoc)
-                    
-                    # Reagregar IVA si corresponde
-                    if imp_neto > 0 and not (tipo_cbte in [11, 12, 13]):
-                        if imp_iva > 0:
-                            logger.info("Reagregando IVA 21% después de reconexión")
-                            wsfev1.AgregarIva(5, round(imp_neto,2), round(imp_iva,2))
-                        else:
-                            logger.info("Reagregando IVA 0% después de reconexión")
-                            wsfev1.AgregarIva(3, round(imp_neto,2), 0.0)
+                    _cargar_comprobante(wsfev1, datos_factura, siguiente_cbte)
                 else:
                     # Si no es error de conexión o ya agotamos reintentos, re-lanzar
                     if is_connection_error:
@@ -240,82 +222,240 @@ def facturar(credenciales: Dict[str, str], datos_factura: Dict[str, Any], produc
         if wsfev1.Resultado != "A":
             errores = ". ".join(filter(None, wsfev1.Observaciones + wsfev1.Errores))
             # Detectar error de token expirado y forzar limpieza de cache y reintento
-            error_str = str(errores).lower()
-            is_token_error = any(keyword in error_str for keyword in ["token", "validacion", "fechas", "gentime", "exptime"])
-            if is_token_error:
-                logger.warning(f"Error de token detectado en facturación: {errores}")
+            if _es_error_de_token(errores):
+                logger.warning("Error de token detectado en facturación: %s", errores)
+                if not puede_reintentar("la solicitud de CAE con un token nuevo"):
+                    raise PlazoAgotado(f"Plazo de la solicitud agotado; AFIP respondió: {errores}")
                 # Limpiar cache de tokens
-                try:
-                    import glob, os
-                    from app.config import CACHE
-                    cache_files = glob.glob(f"{CACHE}/*")
-                    for cache_file in cache_files:
-                        os.remove(cache_file)
-                    logger.info("Cache de tokens limpiado exitosamente. Reintentando facturación...")
-                except Exception as cache_err:
-                    logger.error(f"Error al limpiar cache de tokens: {cache_err}")
+                _limpiar_cache_tokens()
                 # Forzar reconexión y reintentar CAE
-                wsfev1 = afip_conector.conectar(credenciales, production=True, force_reconnect=True)
+                wsfev1 = conector.conectar(credenciales, production=True, force_reconnect=True)
                 # Recrear la factura
-                wsfev1.CrearFactura(
-                    concepto=1,
-                    tipo_doc=datos_factura.get("tipo_documento"),
-                    nro_doc=datos_factura.get("documento"),
-                    tipo_cbte=tipo_cbte,
-                    punto_vta=punto_vta,
-                    cbt_desde=siguiente_cbte,
-                    cbt_hasta=siguiente_cbte,
-                    imp_total=total,
-                    imp_neto=imp_neto,
-                    imp_iva=imp_iva,
-                    imp_tot_conc=imp_tot_conc,
-                    imp_op_ex=imp_op_ex,
-                    fecha_cbte=datetime.date.today().strftime("%Y%m%d")
-                )
-                if es_nota:
-                    fecha_asoc = str(asoc_fecha).replace("-", "")
-                    wsfev1.AgregarCmpAsoc(asoc_tipo, int(asoc_punto_vta), int(asoc_nro), fecha=fecha_asoc)
-                if imp_neto > 0 and not (tipo_cbte in [11, 12, 13]):
-                    if imp_iva > 0:
-                        logger.info("Reagregando IVA 21% después de limpieza de token")
-                        wsfev1.AgregarIva(5, round(imp_neto,2), round(imp_iva,2))
-                    else:
-                        logger.info("Reagregando IVA 0% después de limpieza de token")
-                        wsfev1.AgregarIva(3, round(imp_neto,2), 0.0)
+                _cargar_comprobante(wsfev1, datos_factura, siguiente_cbte)
                 # Reintentar CAE
-                wsfev1.CAESolicitar()
+                with fase("cae"):
+                    envios_sin_respuesta += 1
+                    wsfev1.CAESolicitar()
+                    envios_sin_respuesta -= 1
                 if wsfev1.Resultado != "A":
                     errores = ". ".join(filter(None, wsfev1.Observaciones + wsfev1.Errores))
                     raise RuntimeError(f"AFIP rechazó la factura tras reintento: {errores}")
             else:
                 raise RuntimeError(f"AFIP rechazó la factura: {errores}")
         
-        logger.info(f"¡Factura autorizada! Nro: {wsfev1.CbteNro}, CAE: {wsfev1.CAE}")
+        logger.info("¡Factura autorizada! Nro: %s, CAE: %s", wsfev1.CbteNro, wsfev1.CAE)
 
         # Retornar JSON completo que coincida con el modelo factura_response_model
-        return {
-            "tipo_documento": datos_factura.get("tipo_documento"),
-            "documento": datos_factura.get("documento"),
-            "tipo_afip": datos_factura.get("tipo_afip"),
-            "punto_venta": datos_factura.get("punto_venta"),
-            "total": float(datos_factura.get("total", 0.0)),
-            "exento": float(datos_factura.get("exento", 0.0)),
-            "neto": float(datos_factura.get("neto", 0.0)),
-            "neto105": float(datos_factura.get("neto105", 0.0)),
-            "iva": float(datos_factura.get("iva", 0.0)),
-            "iva105": float(datos_factura.get("iva105", 0.0)),
-            "resultado": wsfev1.Resultado,
-            "cae": wsfev1.CAE,
-            "vencimiento_cae": wsfev1.Vencimiento,
-            "numero_comprobante": int(wsfev1.CbteNro),
-            "fecha_comprobante": datetime.date.today().strftime("%Y-%m-%d"),
-            "asociado_tipo_afip": datos_factura.get("asociado_tipo_afip"),
-            "asociado_punto_venta": datos_factura.get("asociado_punto_venta"),
-            "asociado_numero_comprobante": datos_factura.get("asociado_numero_comprobante"),
-            "asociado_fecha_comprobante": datos_factura.get("asociado_fecha_comprobante"),
-            "id_condicion_iva": datos_factura.get("id_condicion_iva")
-        }
+        return _armar_respuesta(datos_factura, wsfev1.Resultado, wsfev1.CAE, wsfev1.Vencimiento, wsfev1.CbteNro)
 
     except Exception as e:
-        logger.error(f"Error durante el proceso de facturación: {e}", exc_info=True)
+        logger.error("Error durante el proceso de facturación: %s", e, exc_info=True)
+        if envios_sin_respuesta and not isinstance(e, EnvioIncierto):
+            # Un rechazo posterior (p. ej. número ya usado) tampoco descarta que el envío anterior tenga CAE.
+            raise EnvioIncierto(f"Sin respuesta de AFIP a la solicitud de CAE; verificar el comprobante "
+                                f"con FECompConsultar antes de reenviar: {e}") from e
         raise e
+
+
+def _cargar_comprobante(wsfev1, datos_factura: Dict[str, Any], numero: int) -> Dict[str, Any]:
+    """
+    Arma un comprobante en el objeto wsfev1 (importes, IVA y comprobantes
+    asociados) y devuelve el dict interno de pyafipws. Lo usan `facturar`, al
+    armarlo y al recrearlo tras una reconexión, y `facturar_lote`.
+    """
+    tipo_cbte = datos_factura.get("tipo_afip")
+    total = float(datos_factura.get("total", 0.0))
+    imp_neto = float(datos_factura.get("neto", 0.0))
+    imp_iva = float(datos_factura.get("iva", 0.0))
+    if tipo_cbte in [11, 12, 13]:
+        imp_neto = total
+        imp_iva = 0.0
+
+    wsfev1.CrearFactura(
+        concepto=1,
+        tipo_doc=datos_factura.get("tipo_documento"),
+        nro_doc=datos_factura.get("documento"),
+        tipo_cbte=tipo_cbte,
+        punto_vta=datos_factura.get("punto_venta"),
+        cbt_desde=numero,
+        cbt_hasta=numero,
+        imp_total=total,
+        imp_neto=imp_neto,
+        imp_iva=imp_iva,
+        imp_tot_conc=0.0,
+        imp_op_ex=0.0,
+        fecha_cbte=datetime.date.today().strftime("%Y%m%d")
+    )
+    if tipo_cbte in [3, 8, 13, 2, 7, 12]:
+        asoc_tipo = datos_factura.get("asociado_tipo_afip")
+        asoc_punto_vta = datos_factura.get("asociado_punto_venta")
+        asoc_nro = datos_factura.get("asociado_numero_comprobante")
+        asoc_fecha = datos_factura.get("asociado_fecha_comprobante")
+        if not (asoc_tipo and asoc_punto_vta is not None and asoc_nro and asoc_fecha):
+            raise ValueError("Faltan campos asociado_* para nota crédito/débito")
+        try:
+            asoc_pv_int = int(asoc_punto_vta)
+            asoc_nro_int = int(asoc_nro)
+        except Exception:
+            raise ValueError("Formato inválido en asociado_punto_venta o asociado_numero_comprobante")
+        wsfev1.AgregarCmpAsoc(asoc_tipo, asoc_pv_int, asoc_nro_int, fecha=str(asoc_fecha).replace("-", ""))
+
+    if imp_neto > 0 and not (tipo_cbte in [11, 12, 13]):
+        if imp_iva > 0:
+            logger.info("Agregando detalle de IVA (21%%) sobre base %s", imp_neto)
+            wsfev1.AgregarIva(5, round(imp_neto, 2), round(imp_iva, 2))
+        else:
+            logger.info("Agregando detalle de IVA (0%%) sobre base %s", imp_neto)
+            wsfev1.AgregarIva(3, round(imp_neto, 2), 0.0)
+    return wsfev1.factura
+
+
+def _detalle_fecae(f: Dict[str, Any]) -> Dict[str, Any]:
+    """Traduce el comprobante interno de pyafipws a un FECAEDetRequest."""
+    detalle = {
+        'Concepto': f.get('concepto'),
+        'DocTipo': f.get('tipo_doc'),
+        'DocNro': f.get('nro_doc'),
+        'CbteDesde': f.get('cbt_desde'),
+        'CbteHasta': f.get('cbt_hasta'),
+        'CbteFch': f.get('fecha_cbte'),
+        'ImpTotal': f.get('imp_total'),
+        'ImpTotConc': f.get('imp_tot_conc'),
+        'ImpNeto': f.get('imp_neto'),
+        'ImpOpEx': f.get('imp_op_ex'),
+        'ImpTrib': f.get('imp_trib', 0.0),
+        'ImpIVA': f.get('imp_iva'),
+        'FchServDesde': f.get('fecha_serv_desde'),
+        'FchServHasta': f.get('fecha_serv_hasta'),
+        'FchVtoPago': f.get('fecha_venc_pago'),
+        'MonId': f.get('moneda_id', 'PES'),
+        'MonCotiz': f.get('moneda_ctz', '1.000'),
+    }
+    if f.get('cbtes_asoc'):
+        detalle['CbtesAsoc'] = [{'CbteAsoc': {
+            'Tipo': asoc.get('tipo'),
+            'PtoVta': asoc.get('pto_vta'),
+            'Nro': asoc.get('nro'),
+            'Cuit': asoc.get('cuit'),
+            'CbteFch': asoc.get('fecha'),
+        }} for asoc in f['cbtes_asoc']]
+    if f.get('iva'):
+        detalle['Iva'] = [{'AlicIva': {
+            'Id': iva.get('iva_id'),
+            'BaseImp': iva.get('base_imp'),
+            'Importe': iva.get('importe'),
+        }} for iva in f['iva']]
+    return detalle
+
+
+def _mensajes_afip(lista, clave: str) -> str:
+    return ". ".join(f"{m[clave].get('Code')}: {m[clave].get('Msg')}" for m in (lista or []) if clave in m)
+
+
+def facturar_lote(credenciales: Dict[str, str], lote: List[Dict[str, Any]],
+                  conector: Optional[AfipConnector] = None) -> List[Any]:
+    """
+    Emite varios comprobantes del mismo CUIT, tipo y punto de venta en un único
+    FECAESolicitar con números consecutivos.
+
+    Devuelve, en el mismo orden que `lote`, la respuesta de cada comprobante o
+    la excepción que le corresponde. Como AFIP exige numeración correlativa,
+    los comprobantes posteriores al primer rechazo se reemiten individualmente
+    con `facturar`.
+    """
+    if len(lote) == 1:
+        return [facturar(credenciales, lote[0], conector=conector)]
+    if conector is None:
+        conector = afip_conector
+
+    wsfev1 = _conectar_con_reintentos(conector, credenciales)
+    tipo_cbte = lote[0].get("tipo_afip")
+    punto_vta = lote[0].get("punto_venta")
+
+    ultimo_cbte, wsfev1 = _llamar_con_reconexion(
+        conector, credenciales, wsfev1, lambda cliente: int(cliente.CompUltimoAutorizado(tipo_cbte, punto_vta)),
+        "consultar el último comprobante", "ultimo_cbte")
+
+    resultados: List[Any] = [None] * len(lote)
+    detalles, indices = [], []
+    for indice, datos_factura in enumerate(lote):
+        try:
+            factura = _cargar_comprobante(wsfev1, datos_factura, ultimo_cbte + len(detalles) + 1)
+        except ValueError as e:
+            resultados[indice] = e
+            continue
+        detalles.append({'FECAEDetRequest': _detalle_fecae(factura)})
+        indices.append(indice)
+
+    if not detalles:
+        return resultados
+
+    logger.info("Solicitando CAE a AFIP para un lote de %s comprobantes (tipo %s, PV %s) desde el %s",
+                len(detalles), tipo_cbte, punto_vta, ultimo_cbte + 1)
+    # Solicitudes de CAE del lote que salieron sin que llegara su respuesta.
+    envios_sin_respuesta = 0
+
+    def solicitar(cliente) -> Dict[str, Any]:
+        nonlocal envios_sin_respuesta
+        envios_sin_respuesta += 1
+        # El Auth se arma con el cliente de cada intento: tras reconectar lleva el TA nuevo.
+        respuesta = cliente.client.FECAESolicitar(
+            Auth={'Token': cliente.Token, 'Sign': cliente.Sign, 'Cuit': cliente.Cuit},
+            FeCAEReq={
+                'FeCabReq': {'CantReg': len(detalles), 'PtoVta': punto_vta, 'CbteTipo': tipo_cbte},
+                'FeDetReq': detalles,
+            })['FECAESolicitarResult']
+        envios_sin_respuesta -= 1
+        return respuesta
+
+    def solicitar_cae(wsfev1):
+        try:
+            return _llamar_con_reconexion(conector, credenciales, wsfev1, solicitar,
+                                          "solicitar el CAE del lote", "cae")
+        except Exception as e:
+            if not envios_sin_respuesta:
+                raise
+            raise EnvioIncierto(f"Sin respuesta de AFIP a la solicitud de CAE del lote; verificar los "
+                                f"comprobantes con FECompConsultar antes de reenviar: {e}") from e
+
+    resultado, wsfev1 = solicitar_cae(wsfev1)
+    respuestas_det = resultado.get('FeDetResp') or []
+    errores = _mensajes_afip(resultado.get('Errors'), 'Err')
+    if len(respuestas_det) != len(detalles) and _es_error_de_token(errores):
+        # TA vencido o inválido: el lote entero se rechazó sin numerar; mismo tratamiento que `facturar`.
+        logger.warning("Error de token detectado en el lote: %s", errores)
+        if not puede_reintentar("la solicitud de CAE del lote con un token nuevo"):
+            raise PlazoAgotado(f"Plazo de la solicitud agotado; AFIP respondió: {errores}")
+        _limpiar_cache_tokens()
+        wsfev1 = conector.conectar(credenciales, production=True, force_reconnect=True)
+        resultado, wsfev1 = solicitar_cae(wsfev1)
+        respuestas_det = resultado.get('FeDetResp') or []
+        errores = _mensajes_afip(resultado.get('Errors'), 'Err')
+    # Si un envío anterior quedó sin respuesta, un rechazo puede deberse a que ese
+    # envío ya numeró los comprobantes: no se reemiten.
+    rechazo = EnvioIncierto if envios_sin_respuesta else RuntimeError
+    if len(respuestas_det) != len(detalles):
+        raise rechazo(f"AFIP rechazó el lote: {errores or 'respuesta sin detalle por comprobante'}")
+
+    hubo_rechazo = False
+    for indice, det in zip(indices, respuestas_det):
+        det = det['FECAEDetResponse']
+        datos_factura = lote[indice]
+        if det.get('Resultado') == 'A':
+            resultados[indice] = _armar_respuesta(datos_factura, 'A', str(det.get('CAE')),
+                                                  str(det.get('CAEFchVto')), det.get('CbteDesde'))
+        elif not hubo_rechazo or envios_sin_respuesta:
+            hubo_rechazo = True
+            errores = ". ".join(filter(None, [_mensajes_afip(det.get('Observaciones'), 'Obs'),
+                                              _mensajes_afip(resultado.get('Errors'), 'Err')]))
+            resultados[indice] = rechazo(f"AFIP rechazó la factura: {errores}")
+        else:
+            # La numeración se cortó en el rechazo anterior: emitir por separado.
+            try:
+                resultados[indice] = facturar(credenciales, datos_factura, conector=conector)
+            except Exception as e:
+                resultados[indice] = e
+
+    logger.info("Lote autorizado: %s de %s comprobantes con CAE",
+                sum(isinstance(r, dict) for r in resultados), len(lote))
+    return resultados
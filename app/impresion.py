@@ -0,0 +1,128 @@
+# app/impresion.py
+"""
+Generación de PDF de comprobantes en un pool de procesos.
+
+Armar un PDF con su QR es trabajo de CPU: en los hilos del worker competiría
+por el GIL con las emisiones. Los PDF se generan en un ProcessPoolExecutor
+(un proceso por CPU o AFIP_PDF_PROCESOS) creado al primer uso en cada worker.
+Cada proceso cachea las plantillas por emisor (ver `app/comprobante_pdf.py`).
+Si un proceso muere (p. ej. por falta de memoria) el pool queda roto: se
+descarta y la próxima solicitud crea uno nuevo.
+
+Para lotes, el zip se arma y se envía a medida que los PDF salen del pool,
+con una ventana acotada de trabajos en curso: la memoria no crece con la
+cantidad de comprobantes.
+"""
+import multiprocessing
+import os
+import threading
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from app.comprobante_pdf import nombre_archivo, renderizar
+from app.config import AFIP_PDF_PROCESOS
+from app.logger_setup import logger
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pid_pool: Optional[int] = None
+_lock = threading.Lock()
+
+
+def _obtener_pool() -> ProcessPoolExecutor:
+    global _pool, _pid_pool
+    with _lock:
+        if _pool is None or _pid_pool != os.getpid():
+            procesos = AFIP_PDF_PROCESOS or os.cpu_count() or 1
+            # "spawn": el worker ya tiene hilos (logging, outbox); no forkearlo.
+            _pool = ProcessPoolExecutor(max_workers=procesos, mp_context=multiprocessing.get_context("spawn"))
+            _pid_pool = os.getpid()
+            logger.info("Pool de impresión de PDF iniciado con %s procesos", procesos)
+        return _pool
+
+
+def _descartar_pool(pool: ProcessPoolExecutor) -> None:
+    """Descarta un pool roto para que `_obtener_pool` cree otro."""
+    global _pool
+    with _lock:
+        if _pool is pool:
+            _pool = None
+    logger.warning("Pool de impresión de PDF roto; se crea uno nuevo en la próxima solicitud")
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _renderizar_con_nombre(emisor: Dict[str, Any], comprobante: Dict[str, Any]) -> Tuple[str, bytes]:
+    return nombre_archivo(emisor, comprobante), renderizar(emisor, comprobante)
+
+
+def renderizar_uno(emisor: Dict[str, Any], comprobante: Dict[str, Any]) -> Tuple[str, bytes]:
+    """Nombre de archivo y PDF de un comprobante."""
+    pool = _obtener_pool()
+    try:
+        return pool.submit(_renderizar_con_nombre, emisor, comprobante).result()
+    except BrokenProcessPool:
+        _descartar_pool(pool)
+        raise
+
+
+def renderizar_en_orden(emisor: Dict[str, Any], comprobantes: Iterable[Dict[str, Any]],
+                        ventana: Optional[int] = None) -> Iterator[Tuple[str, bytes]]:
+    """
+    Genera los PDF en el pool y los devuelve en el orden de entrada, con a lo
+    sumo `ventana` trabajos pendientes a la vez.
+    """
+    pool = _obtener_pool()
+    ventana = ventana or pool._max_workers * 4
+    pendientes: deque = deque()
+    try:
+        for comprobante in comprobantes:
+            pendientes.append(pool.submit(_renderizar_con_nombre, emisor, comprobante))
+            if len(pendientes) >= ventana:
+                yield pendientes.popleft().result()
+        while pendientes:
+            yield pendientes.popleft().result()
+    except BrokenProcessPool:
+        _descartar_pool(pool)
+        raise
+    finally:
+        # El cliente cortó la descarga: no seguir generando lo que nadie va a leer.
+        for futuro in pendientes:
+            futuro.cancel()
+
+
+class _SalidaZip:
+    """Destino no posicionable para ZipFile: acumula lo escrito hasta que se lo vacía."""
+
+    def __init__(self):
+        self._partes: List[bytes] = []
+
+    def write(self, datos) -> int:
+        self._partes.append(bytes(datos))
+        return len(datos)
+
+    def flush(self) -> None:
+        pass
+
+    def vaciar(self) -> bytes:
+        datos = b"".join(self._partes)
+        self._partes.clear()
+        return datos
+
+
+def zip_en_flujo(emisor: Dict[str, Any], comprobantes: List[Dict[str, Any]]) -> Iterator[bytes]:
+    """Zip con un PDF por comprobante, entregado en partes a medida que se genera."""
+    salida = _SalidaZip()
+    vistos: Dict[str, int] = {}
+    # Los PDF ya vienen comprimidos: guardarlos sin volver a comprimir.
+    with zipfile.ZipFile(salida, mode="w", compression=zipfile.ZIP_STORED) as archivo_zip:
+        for nombre, pdf in renderizar_en_orden(emisor, comprobantes):
+            if nombre in vistos:
+                vistos[nombre] += 1
+                nombre = nombre.replace(".pdf", f"_{vistos[nombre]}.pdf")
+            else:
+                vistos[nombre] = 0
+            archivo_zip.writestr(nombre, pdf)
+            yield salida.vaciar()
+    yield salida.vaciar()
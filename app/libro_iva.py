@@ -0,0 +1,316 @@
+# app/libro_iva.py
+"""
+Totales del libro IVA ventas por CUIT, mantenidos en forma incremental.
+
+Cada comprobante autorizado se anota una sola vez (clave CUIT, tipo, punto
+de venta y número) y en la misma transacción suma sus importes a dos
+agregados: diario y mensual, por CUIT, tipo de comprobante y punto de venta.
+Las notas de crédito restan. Los importes se guardan en centavos para que
+las sumas no acumulen error de redondeo.
+
+Un período se responde con, a lo sumo, los días sueltos de los meses
+incompletos de los extremos más un registro mensual por cada mes completo:
+el costo no depende de la cantidad de comprobantes.
+
+Los comprobantes anotados guardan además los datos de la respuesta de
+`facturar()`; `app/exportacion.py` los recorre para exportarlos.
+
+Si los agregados quedan desfasados (restauración de un backup, cambio de
+reglas), se recalculan desde los comprobantes anotados:
+
+    python -m app.libro_iva reconstruir [--cuit CUIT]
+"""
+import argparse
+import calendar
+import datetime
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from app.config import AFIP_LIBRO_IVA_HABILITADO, AFIP_LIBRO_IVA_DB
+from app.logger_setup import logger
+
+IMPORTES = ("neto", "neto105", "iva", "iva105", "exento", "total")
+# Notas de crédito (A, B, C y sus equivalentes MiPyME): restan en el libro.
+NOTAS_CREDITO = {3, 8, 13, 203, 208, 213}
+PERIODOS = ("dia", "mes")
+# Resto de la respuesta de facturar() que se guarda con cada comprobante.
+DATOS = (("tipo_documento", "INTEGER"), ("documento", "TEXT"), ("resultado", "TEXT"), ("vencimiento_cae", "TEXT"),
+         ("asociado_tipo_afip", "INTEGER"), ("asociado_punto_venta", "INTEGER"),
+         ("asociado_numero_comprobante", "INTEGER"), ("asociado_fecha_comprobante", "TEXT"),
+         ("id_condicion_iva", "INTEGER"), ("qr", "TEXT"))
+
+_COLUMNAS = ", ".join(IMPORTES)
+_SUMAS = ", ".join(f"SUM(signo * {importe})" for importe in IMPORTES)
+_COLUMNAS_DATOS = ", ".join(columna for columna, _ in DATOS)
+_ACUMULAR = ", ".join(f"{importe} = {importe} + excluded.{importe}" for importe in IMPORTES)
+# Columnas que escribe `anotar`, en el orden de sus parámetros.
+_COLUMNAS_ANOTAR = ("cuit", "tipo_afip", "punto_venta", "numero", "fecha", "signo", *IMPORTES,
+                    "cae", "anotado", *(columna for columna, _ in DATOS))
+
+
+def _marcadores(cantidad: int) -> str:
+    return ", ".join("?" * cantidad)
+
+
+def _centavos(valor: Any) -> int:
+    return int(round(float(valor or 0.0) * 100))
+
+
+def _fecha(valor: Any) -> datetime.date:
+    try:
+        return datetime.date.fromisoformat(str(valor))
+    except ValueError:
+        raise ValueError(f"Fecha inválida: {valor} (formato AAAA-MM-DD)")
+
+
+def _tramos(desde: datetime.date, hasta: datetime.date) -> List[Tuple[str, str, str]]:
+    """
+    Divide el período en tramos de días sueltos y de meses completos:
+    (tabla, desde, hasta) con las claves de esa tabla (fecha o mes).
+    """
+    tramos = []
+    actual = desde
+    while actual <= hasta:
+        fin_mes = actual.replace(day=calendar.monthrange(actual.year, actual.month)[1])
+        if actual.day == 1 and fin_mes <= hasta:
+            # Meses completos consecutivos en un solo tramo mensual.
+            ultimo = fin_mes
+            while True:
+                siguiente = ultimo + datetime.timedelta(days=1)
+                fin_siguiente = siguiente.replace(day=calendar.monthrange(siguiente.year, siguiente.month)[1])
+                if fin_siguiente > hasta:
+                    break
+                ultimo = fin_siguiente
+            tramos.append(("mensual", actual.strftime("%Y-%m"), ultimo.strftime("%Y-%m")))
+            actual = ultimo + datetime.timedelta(days=1)
+        else:
+            ultimo = min(fin_mes, hasta)
+            tramos.append(("diario", actual.isoformat(), ultimo.isoformat()))
+            actual = ultimo + datetime.timedelta(days=1)
+    return tramos
+
+
+class LibroIva:
+    def __init__(self, ruta: str):
+        self.ruta = ruta
+        self._local = threading.local()
+        # Conexión descartable, igual que en el outbox: no heredar handles tras el fork.
+        db = sqlite3.connect(self.ruta, timeout=5)
+        try:
+            db.execute("CREATE TABLE IF NOT EXISTS comprobantes ("
+                       "cuit TEXT NOT NULL, tipo_afip INTEGER NOT NULL, punto_venta INTEGER NOT NULL, "
+                       "numero INTEGER NOT NULL, fecha TEXT NOT NULL, signo INTEGER NOT NULL, "
+                       "neto INTEGER NOT NULL, neto105 INTEGER NOT NULL, iva INTEGER NOT NULL, "
+                       "iva105 INTEGER NOT NULL, exento INTEGER NOT NULL, total INTEGER NOT NULL, "
+                       "cae TEXT, anotado REAL NOT NULL, "
+                       "PRIMARY KEY (cuit, tipo_afip, punto_venta, numero))")
+            existentes = {fila[1] for fila in db.execute("PRAGMA table_info(comprobantes)")}
+            for columna, tipo in DATOS:
+                if columna not in existentes:
+                    db.execute(f"ALTER TABLE comprobantes ADD COLUMN {columna} {tipo}")
+            db.execute("CREATE INDEX IF NOT EXISTS comprobantes_fecha "
+                       "ON comprobantes (cuit, fecha, tipo_afip, punto_venta, numero)")
+            for tabla, periodo in (("diario", "fecha"), ("mensual", "mes")):
+                db.execute(f"CREATE TABLE IF NOT EXISTS {tabla} ("
+                           f"cuit TEXT NOT NULL, {periodo} TEXT NOT NULL, tipo_afip INTEGER NOT NULL, "
+                           "punto_venta INTEGER NOT NULL, cantidad INTEGER NOT NULL, "
+                           "neto INTEGER NOT NULL, neto105 INTEGER NOT NULL, iva INTEGER NOT NULL, "
+                           "iva105 INTEGER NOT NULL, exento INTEGER NOT NULL, total INTEGER NOT NULL, "
+                           f"PRIMARY KEY (cuit, {periodo}, tipo_afip, punto_venta))")
+            db.commit()
+        finally:
+            db.close()
+
+    @contextmanager
+    def _transaccion(self, escritura: bool = True):
+        db = getattr(self._local, "db", None)
+        if db is None or getattr(self._local, "pid", None) != os.getpid():
+            db = sqlite3.connect(self.ruta, timeout=5, isolation_level=None)
+            self._local.db = db
+            self._local.pid = os.getpid()
+        # Las consultas leen una foto consistente sin bloquear a quienes anotan.
+        db.execute("BEGIN IMMEDIATE" if escritura else "BEGIN")
+        try:
+            yield db
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+
+    # --- Anotación ---
+
+    def anotar(self, cuit: str, comprobante: Dict[str, Any]) -> bool:
+        """
+        Anota un comprobante autorizado y actualiza los agregados. Devuelve
+        False si ya estaba anotado (reintentos, outbox), sin volver a sumarlo.
+        """
+        tipo_afip = int(comprobante["tipo_afip"])
+        punto_venta = int(comprobante["punto_venta"])
+        fecha = _fecha(comprobante.get("fecha_comprobante") or datetime.date.today().isoformat())
+        signo = -1 if tipo_afip in NOTAS_CREDITO else 1
+        importes = [_centavos(comprobante.get(importe)) for importe in IMPORTES]
+        with self._transaccion() as db:
+            nuevo = db.execute(
+                f"INSERT OR IGNORE INTO comprobantes ({', '.join(_COLUMNAS_ANOTAR)}) "
+                f"VALUES ({_marcadores(len(_COLUMNAS_ANOTAR))})",
+                (cuit, tipo_afip, punto_venta, int(comprobante["numero_comprobante"]), fecha.isoformat(), signo,
+                 *importes, comprobante.get("cae"), time.time(),
+                 *(comprobante.get(columna) for columna, _ in DATOS))).rowcount
+            if not nuevo:
+                return False
+            firmados = [signo * importe for importe in importes]
+            for tabla, periodo, clave in (("diario", "fecha", fecha.isoformat()), ("mensual", "mes", fecha.strftime("%Y-%m"))):
+                db.execute(f"INSERT INTO {tabla} (cuit, {periodo}, tipo_afip, punto_venta, cantidad, {_COLUMNAS}) "
+                           f"VALUES (?, ?, ?, ?, 1, {_marcadores(len(IMPORTES))}) "
+                           f"ON CONFLICT (cuit, {periodo}, tipo_afip, punto_venta) DO UPDATE SET "
+                           f"cantidad = cantidad + 1, {_ACUMULAR}",
+                           (cuit, clave, tipo_afip, punto_venta, *firmados))
+        return True
+
+    # --- Consulta ---
+
+    def consultar(self, cuit: str, desde: Any, hasta: Any, por: Optional[str] = None,
+                  tipo_afip: Optional[int] = None, punto_venta: Optional[int] = None) -> Dict[str, Any]:
+        """
+        Totales del período [desde, hasta] por tipo de comprobante y punto de
+        venta y, con `por` ("dia" o "mes"), además por día o mes.
+        """
+        desde, hasta = _fecha(desde), _fecha(hasta)
+        if desde > hasta:
+            raise ValueError("'desde' no puede ser posterior a 'hasta'")
+        if por and por not in PERIODOS:
+            raise ValueError(f"Agrupación inválida: {por} (valores admitidos: dia, mes)")
+        if por == "dia":
+            # Serie diaria: se lee directamente el agregado diario.
+            tramos = [("diario", desde.isoformat(), hasta.isoformat())]
+        else:
+            tramos = _tramos(desde, hasta)
+
+        filtros, parametros = "", []
+        if tipo_afip is not None:
+            filtros += " AND tipo_afip = ?"
+            parametros.append(tipo_afip)
+        if punto_venta is not None:
+            filtros += " AND punto_venta = ?"
+            parametros.append(punto_venta)
+
+        grupos: Dict[Tuple[Optional[str], int, int], List[int]] = {}
+        with self._transaccion(escritura=False) as db:
+            for tabla, inicio, fin in tramos:
+                if tabla == "diario":
+                    periodo = "fecha"
+                    # En la serie mensual, los días sueltos se agrupan por su mes.
+                    clave = {"dia": "fecha", "mes": "substr(fecha, 1, 7)"}.get(por, "NULL")
+                else:
+                    periodo = "mes"
+                    clave = "mes" if por == "mes" else "NULL"
+                filas = db.execute(
+                    f"SELECT {clave}, tipo_afip, punto_venta, SUM(cantidad), "
+                    + ", ".join(f"SUM({importe})" for importe in IMPORTES)
+                    + f" FROM {tabla} WHERE cuit = ? AND {periodo} BETWEEN ? AND ?{filtros} "
+                    f"GROUP BY 1, tipo_afip, punto_venta",
+                    (cuit, inicio, fin, *parametros)).fetchall()
+                for fila in filas:
+                    acumulado = grupos.setdefault(tuple(fila[:3]), [0] * (1 + len(IMPORTES)))
+                    for indice, valor in enumerate(fila[3:]):
+                        acumulado[indice] += valor or 0
+
+        detalle = [self._fila(valores, periodo=clave[0], tipo_afip=clave[1], punto_venta=clave[2])
+                   for clave, valores in sorted(grupos.items(), key=lambda item: (item[0][0] or "", item[0][1], item[0][2]))]
+        totales = [sum(valores[indice] for valores in grupos.values()) for indice in range(1 + len(IMPORTES))]
+        return {"cuit": cuit, "desde": desde.isoformat(), "hasta": hasta.isoformat(), "por": por,
+                "totales": self._fila(totales), "detalle": detalle}
+
+    @staticmethod
+    def _fila(valores: List[int], **claves: Any) -> Dict[str, Any]:
+        fila = {clave: valor for clave, valor in claves.items() if valor is not None}
+        fila["cantidad"] = valores[0]
+        fila.update({importe: valor / 100 for importe, valor in zip(IMPORTES, valores[1:])})
+        return fila
+
+    def recorrer(self, cuit: str, desde: Any, hasta: Any, tipo_afip: Optional[int] = None,
+                 punto_venta: Optional[int] = None, tamano: int = 10000) -> Iterator[List[Dict[str, Any]]]:
+        """
+        Comprobantes anotados del período en bloques de a lo sumo `tamano`, con
+        la forma de la respuesta de facturar(). Cada bloque es una consulta
+        corta que sigue desde el último comprobante leído, así una exportación
+        larga no retiene el archivo mientras otros procesos anotan.
+        """
+        desde, hasta = _fecha(desde), _fecha(hasta)
+        filtros, parametros = "", []
+        if tipo_afip is not None:
+            filtros += " AND tipo_afip = ?"
+            parametros.append(tipo_afip)
+        if punto_venta is not None:
+            filtros += " AND punto_venta = ?"
+            parametros.append(punto_venta)
+        # El límite inferior va como clave completa para que el índice salte directo al bloque.
+        ultimo = (desde.isoformat(), -1, -1, -1)
+        while True:
+            with self._transaccion(escritura=False) as db:
+                filas = db.execute(
+                    f"SELECT fecha, tipo_afip, punto_venta, numero, {_COLUMNAS}, cae, {_COLUMNAS_DATOS} "
+                    "FROM comprobantes WHERE cuit = ? AND (fecha, tipo_afip, punto_venta, numero) > (?, ?, ?, ?) "
+                    f"AND fecha <= ?{filtros} ORDER BY fecha, tipo_afip, punto_venta, numero LIMIT ?",
+                    (cuit, *ultimo, hasta.isoformat(), *parametros, tamano)).fetchall()
+            if not filas:
+                return
+            yield [self._comprobante(fila) for fila in filas]
+            ultimo = tuple(filas[-1][:4])
+
+    @staticmethod
+    def _comprobante(fila: Tuple[Any, ...]) -> Dict[str, Any]:
+        fecha, tipo_afip, punto_venta, numero = fila[:4]
+        importes = fila[4:4 + len(IMPORTES)]
+        comprobante = {"tipo_afip": tipo_afip, "punto_venta": punto_venta, "numero_comprobante": numero,
+                       "fecha_comprobante": fecha, "cae": fila[4 + len(IMPORTES)]}
+        comprobante.update({importe: valor / 100 for importe, valor in zip(IMPORTES, importes)})
+        comprobante.update(zip((columna for columna, _ in DATOS), fila[5 + len(IMPORTES):]))
+        return comprobante
+
+    # --- Reconstrucción ---
+
+    def reconstruir(self, cuit: Optional[str] = None) -> int:
+        """
+        Recalcula los agregados diarios y mensuales desde los comprobantes
+        anotados (de un CUIT o de todos). Devuelve la cantidad de comprobantes.
+        """
+        filtro, parametros = ("WHERE cuit = ?", (cuit,)) if cuit else ("", ())
+        with self._transaccion() as db:
+            for tabla, periodo, expresion in (("diario", "fecha", "fecha"), ("mensual", "mes", "substr(fecha, 1, 7)")):
+                db.execute(f"DELETE FROM {tabla} {filtro}", parametros)
+                db.execute(f"INSERT INTO {tabla} (cuit, {periodo}, tipo_afip, punto_venta, cantidad, {_COLUMNAS}) "
+                           f"SELECT cuit, {expresion}, tipo_afip, punto_venta, COUNT(*), {_SUMAS} "
+                           f"FROM comprobantes {filtro} GROUP BY cuit, {expresion}, tipo_afip, punto_venta", parametros)
+            cantidad = db.execute(f"SELECT COUNT(*) FROM comprobantes {filtro}", parametros).fetchone()[0]
+        logger.info("Libro IVA reconstruido para %s: %s comprobantes", cuit or "todos los CUIT", cantidad)
+        return cantidad
+
+
+def _crear_libro() -> Optional[LibroIva]:
+    if not AFIP_LIBRO_IVA_HABILITADO:
+        return None
+    try:
+        return LibroIva(AFIP_LIBRO_IVA_DB)
+    except Exception as e:
+        logger.error("No se pudo iniciar el libro IVA: %s", e)
+        return None
+
+
+# Instancia única del proceso; None si el libro IVA está deshabilitado.
+libro_iva = _crear_libro()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mantenimiento del libro IVA ventas")
+    subcomandos = parser.add_subparsers(dest="comando", required=True)
+    reconstruccion = subcomandos.add_parser("reconstruir", help="Recalcula los agregados desde los comprobantes anotados")
+    reconstruccion.add_argument("--cuit", help="Solo este CUIT (por omisión, todos)")
+    argumentos = parser.parse_args()
+    # El comando se usa aunque el servicio no tenga el libro habilitado.
+    total = (libro_iva or LibroIva(AFIP_LIBRO_IVA_DB)).reconstruir(argumentos.cuit)
+    print(f"Agregados recalculados a partir de {total} comprobantes")
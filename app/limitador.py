@@ -0,0 +1,255 @@
+# app/limitador.py
+"""
+Limitación de tasa por tenant y control de admisión hacia AFIP.
+
+- Token bucket por CUIT y uno global, guardados en SQLite para que todos los
+  workers (o el gateway AFIP) compartan el mismo estado.
+- Sin token disponible (del CUIT o global) no se espera: se lanza
+  `LimiteExcedido` de inmediato, que las rutas traducen a 429 con Retry-After.
+- Cola justa ponderada (WFQ) entre tenants para repartir los turnos de
+  emisión: la ráfaga de fin de mes de un CUIT no acapara a los demás. Si la
+  cola de un tenant está llena o la espera de turno supera el máximo también
+  se responde 429.
+"""
+import math
+import sqlite3
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Dict, Optional
+
+from app.config import (AFIP_LIMITE_HABILITADO, AFIP_LIMITE_DB, AFIP_LIMITE_TASA_TENANT,
+                        AFIP_LIMITE_RAFAGA_TENANT, AFIP_LIMITE_TASA_GLOBAL, AFIP_LIMITE_RAFAGA_GLOBAL,
+                        AFIP_LIMITE_CONCURRENCIA, AFIP_LIMITE_COLA_TENANT, AFIP_LIMITE_ESPERA_MAX,
+                        AFIP_LIMITE_PESOS)
+from app.logger_setup import logger
+from app.perfilado import fase
+from app.plazos import acotar
+
+CLAVE_GLOBAL = "__global__"
+
+
+class LimiteExcedido(Exception):
+    """El tenant superó su tasa o su cola de espera; reintentar luego de `retry_after` segundos."""
+
+    def __init__(self, mensaje: str, retry_after: float):
+        super().__init__(mensaje)
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+
+
+def parsear_pesos(texto: str) -> Dict[str, float]:
+    pesos = {}
+    for item in filter(None, (p.strip() for p in texto.split(","))):
+        cuit, _, peso = item.partition(":")
+        try:
+            pesos[cuit.strip()] = float(peso)
+        except ValueError:
+            logger.warning("Peso inválido en AFIP_LIMITE_PESOS: %s", item)
+    return pesos
+
+
+class TokenBuckets:
+    """
+    Token buckets persistidos en SQLite. `reservar` descuenta un token aunque
+    el saldo quede negativo y devuelve cuántos segundos faltan para que ese
+    token exista, de modo que cada solicitud sabe cuándo puede avanzar.
+    """
+
+    def __init__(self, ruta: str):
+        self.ruta = ruta
+        self._local = threading.local()
+        # Conexión descartable: las conexiones por hilo se abren al primer uso,
+        # así un fork posterior (workers de gunicorn) no hereda un handle abierto.
+        db = sqlite3.connect(self.ruta, timeout=5)
+        try:
+            db.execute("CREATE TABLE IF NOT EXISTS buckets ("
+                       "clave TEXT PRIMARY KEY, tokens REAL NOT NULL, actualizado REAL NOT NULL)")
+            db.commit()
+        finally:
+            db.close()
+
+    @contextmanager
+    def _transaccion(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.ruta, timeout=5, isolation_level=None)
+            self._local.db = db
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+
+    def reservar(self, clave: str, tasa: float, capacidad: float) -> float:
+        ahora = time.time()
+        with self._transaccion() as db:
+            fila = db.execute("SELECT tokens, actualizado FROM buckets WHERE clave = ?", (clave,)).fetchone()
+            tokens = capacidad if fila is None else min(capacidad, fila[0] + (ahora - fila[1]) * tasa)
+            tokens -= 1
+            db.execute("INSERT OR REPLACE INTO buckets (clave, tokens, actualizado) VALUES (?, ?, ?)",
+                       (clave, tokens, ahora))
+        return 0.0 if tokens >= 0 else -tokens / tasa
+
+    def devolver(self, clave: str) -> None:
+        with self._transaccion() as db:
+            db.execute("UPDATE buckets SET tokens = tokens + 1 WHERE clave = ?", (clave,))
+
+
+class _Turno:
+    __slots__ = ("cuit", "fin_virtual", "concedido")
+
+    def __init__(self, cuit: str, fin_virtual: float):
+        self.cuit = cuit
+        self.fin_virtual = fin_virtual
+        self.concedido = False
+
+
+class ControlAdmision:
+    """
+    Reparte `concurrencia` turnos de emisión entre tenants con WFQ.
+
+    Los tokens se verifican antes de pedir turno y nunca se esperan: sin
+    token del CUIT o global se responde 429 con el tiempo que falta para el
+    próximo, así un tenant en ráfaga no retiene workers durmiendo. Solo se
+    espera (hasta `espera_max`) por un turno de concurrencia, que es lo que
+    la cola justa reparte entre los hilos del proceso (el gateway AFIP o un
+    worker con hilos).
+    """
+
+    def __init__(self, buckets: TokenBuckets, concurrencia: int = AFIP_LIMITE_CONCURRENCIA,
+                 cola_max: int = AFIP_LIMITE_COLA_TENANT, espera_max: float = AFIP_LIMITE_ESPERA_MAX,
+                 pesos: Optional[Dict[str, float]] = None,
+                 tasa_tenant: float = AFIP_LIMITE_TASA_TENANT, rafaga_tenant: float = AFIP_LIMITE_RAFAGA_TENANT,
+                 tasa_global: float = AFIP_LIMITE_TASA_GLOBAL, rafaga_global: float = AFIP_LIMITE_RAFAGA_GLOBAL):
+        self.buckets = buckets
+        self.concurrencia = concurrencia
+        self.cola_max = cola_max
+        self.espera_max = espera_max
+        self.pesos = pesos or {}
+        self.tasa_tenant = tasa_tenant
+        self.rafaga_tenant = rafaga_tenant
+        self.tasa_global = tasa_global
+        self.rafaga_global = rafaga_global
+        self._cond = threading.Condition()
+        self._colas: Dict[str, deque] = {}
+        self._ultimo_fin: Dict[str, float] = {}
+        self._tiempo_virtual = 0.0
+        self._en_curso = 0
+
+    def _encolar(self, cuit: str) -> _Turno:
+        cola = self._colas.setdefault(cuit, deque())
+        if len(cola) >= self.cola_max:
+            raise LimiteExcedido(f"Cola de emisión llena para CUIT {cuit}",
+                                 retry_after=len(cola) / self.tasa_tenant)
+        inicio = max(self._tiempo_virtual, self._ultimo_fin.get(cuit, 0.0))
+        turno = _Turno(cuit, inicio + 1.0 / self.pesos.get(cuit, 1.0))
+        self._ultimo_fin[cuit] = turno.fin_virtual
+        cola.append(turno)
+        return turno
+
+    def _despachar(self) -> None:
+        while self._en_curso < self.concurrencia:
+            candidatos = [cola[0] for cola in self._colas.values() if cola]
+            if not candidatos:
+                return
+            turno = min(candidatos, key=lambda t: t.fin_virtual)
+            cola = self._colas[turno.cuit]
+            cola.popleft()
+            if not cola:
+                del self._colas[turno.cuit]
+            turno.concedido = True
+            self._en_curso += 1
+            self._tiempo_virtual = max(self._tiempo_virtual, turno.fin_virtual - 1.0 / self.pesos.get(turno.cuit, 1.0))
+            self._cond.notify_all()
+
+    def _retirar(self, turno: _Turno) -> None:
+        cola = self._colas.get(turno.cuit)
+        if cola and turno in cola:
+            cola.remove(turno)
+        if cola is not None and not cola:
+            del self._colas[turno.cuit]
+
+    def _reservar_tokens(self, cuit: str) -> None:
+        """Descuenta un token del CUIT y uno global, o lanza `LimiteExcedido` sin esperar."""
+        espera = self.buckets.reservar(cuit, self.tasa_tenant, self.rafaga_tenant)
+        if espera > 0:
+            self.buckets.devolver(cuit)
+            raise LimiteExcedido(f"Tasa de emisión excedida para CUIT {cuit}", retry_after=espera)
+        espera = self.buckets.reservar(CLAVE_GLOBAL, self.tasa_global, self.rafaga_global)
+        if espera > 0:
+            self.buckets.devolver(CLAVE_GLOBAL)
+            self.buckets.devolver(cuit)
+            logger.info("Límite global de AFIP alcanzado; se rechaza CUIT %s por %.2fs", cuit, espera)
+            raise LimiteExcedido("Tasa global de emisión hacia AFIP excedida", retry_after=espera)
+
+    def devolver_tokens(self, cuit: str) -> None:
+        """Reintegra los tokens de una admisión que no llegó a llamar a AFIP."""
+        self.buckets.devolver(CLAVE_GLOBAL)
+        self.buckets.devolver(cuit)
+
+    def _esperar_turno(self, cuit: str) -> None:
+        # No esperar turno más allá del plazo de la solicitud.
+        espera_max = acotar(self.espera_max, "la admisión")
+        self._reservar_tokens(cuit)
+        limite = time.monotonic() + espera_max
+        with self._cond:
+            try:
+                turno = self._encolar(cuit)
+            except LimiteExcedido:
+                self.devolver_tokens(cuit)
+                raise
+            while True:
+                self._despachar()
+                if turno.concedido:
+                    return
+                ahora = time.monotonic()
+                if ahora >= limite:
+                    self._retirar(turno)
+                    self.devolver_tokens(cuit)
+                    raise LimiteExcedido(f"Tiempo de espera de turno agotado para CUIT {cuit}",
+                                         retry_after=self.espera_max)
+                self._cond.wait(limite - ahora)
+
+    def _liberar_turno(self) -> None:
+        with self._cond:
+            self._en_curso -= 1
+            self._despachar()
+            self._cond.notify_all()
+
+    def estado(self) -> Dict[str, Any]:
+        """Turnos en curso y en espera de este proceso."""
+        with self._cond:
+            en_cola = sum(len(cola) for cola in self._colas.values())
+            return {"en_curso": self._en_curso, "concurrencia": self.concurrencia, "en_cola": en_cola,
+                    "tenants_en_cola": len(self._colas), "saturado": self._en_curso >= self.concurrencia}
+
+    @contextmanager
+    def admitir(self, cuit: str):
+        """
+        Turno de emisión para el CUIT. Se pide antes del lock del conector
+        (ver `emitir_local`): la cola justa decide quién sigue aunque todos los
+        tenants compartan el conector del proceso.
+        """
+        with fase("admision"):
+            self._esperar_turno(cuit)
+        try:
+            yield
+        finally:
+            self._liberar_turno()
+
+
+def _crear_control() -> Optional[ControlAdmision]:
+    if not AFIP_LIMITE_HABILITADO:
+        return None
+    try:
+        return ControlAdmision(TokenBuckets(AFIP_LIMITE_DB), pesos=parsear_pesos(AFIP_LIMITE_PESOS))
+    except Exception as e:
+        logger.warning("No se pudo iniciar el limitador de tasa; se continúa sin límite. Error: %s", e)
+        return None
+
+
+# Instancia única del proceso; None si la limitación está deshabilitada.
+control_admision = _crear_control()
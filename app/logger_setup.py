@@ -1,6 +1,190 @@
+# app/logger_setup.py
+"""
+Configuración de logging del servicio.
+
+Los registros no se escriben desde el hilo de la solicitud: un QueueHandler
+arma el mensaje (y el texto de la excepción) y encola el registro, y un
+QueueListener en segundo plano aplica el formato (JSON o texto), la
+redacción de credenciales y escribe en stdout. Los mensajes repetitivos de
+nivel INFO/DEBUG se muestrean por plantilla.
+"""
+import atexit
+import copy
+import json
 import logging
+import logging.handlers
+import os
+import queue
+import re
+import sys
+import threading
+import time
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# "json" para logs estructurados, "texto" para el formato clásico.
+LOG_FORMATO = os.getenv("LOG_FORMATO", "json").lower()
+# Registros por segundo permitidos para una misma plantilla de mensaje
+# (solo INFO/DEBUG; 0 desactiva el muestreo).
+LOG_MUESTREO_POR_SEGUNDO = int(os.getenv("LOG_MUESTREO_POR_SEGUNDO", "20"))
+# Capacidad de la cola; si se llena se descartan registros antes que bloquear.
+LOG_COLA_MAX = int(os.getenv("LOG_COLA_MAX", "10000"))
+
+_REDACTADO = "[REDACTADO]"
+_PEM = re.compile(r"-----BEGIN [A-Z0-9 ]+-----.*?-----END [A-Z0-9 ]+-----", re.DOTALL)
+_CAMPOS_SENSIBLES = re.compile(
+    r"""(['"]?(?:clave_privada|certificado|private_key|api_key|token|sign)['"]?\s*[:=]\s*)(['"])(.*?)(?<!\\)\2""",
+    re.IGNORECASE | re.DOTALL,
+)
+_FORMATO_EXCEPCIONES = logging.Formatter()
+
+
+def redactar(texto: str) -> str:
+    """Oculta bloques PEM y valores de campos con credenciales."""
+    texto = _PEM.sub(_REDACTADO, texto)
+    return _CAMPOS_SENSIBLES.sub(lambda m: f"{m.group(1)}{m.group(2)}{_REDACTADO}{m.group(2)}", texto)
+
+
+class FiltroMuestreo(logging.Filter):
+    """
+    Limita cuántos registros INFO/DEBUG de una misma plantilla pasan por
+    segundo. Al volver a dejar pasar uno, informa cuántos se suprimieron.
+    """
+
+    # Segundos que se conserva una ventana con suprimidos sin informar.
+    RETENCION = 60
+
+    def __init__(self, por_segundo: int):
+        super().__init__()
+        self.por_segundo = por_segundo
+        self._ventanas = {}
+        self._ultima_poda = 0
+        self._lock = threading.Lock()
+
+    def _podar(self, segundo: int) -> None:
+        # Una clave por plantilla y lugar de llamada: descartar las ventanas
+        # vencidas para que el diccionario no crezca sin límite.
+        self._ultima_poda = segundo
+        self._ventanas = {clave: ventana for clave, ventana in self._ventanas.items()
+                          if ventana[0] == segundo or (ventana[2] and segundo - ventana[0] < self.RETENCION)}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.por_segundo <= 0 or record.levelno >= logging.WARNING:
+            return True
+        clave = (record.name, record.msg if isinstance(record.msg, str) else id(record.msg))
+        segundo = int(time.monotonic())
+        with self._lock:
+            if segundo != self._ultima_poda:
+                self._podar(segundo)
+            inicio, cantidad, suprimidos = self._ventanas.get(clave, (segundo, 0, 0))
+            if inicio != segundo:
+                inicio, cantidad = segundo, 0
+            if cantidad >= self.por_segundo:
+                self._ventanas[clave] = (inicio, cantidad, suprimidos + 1)
+                return False
+            self._ventanas[clave] = (inicio, cantidad + 1, 0)
+        if suprimidos:
+            record.suprimidos = suprimidos
+        return True
+
+
+class _QueueHandlerDiferido(logging.handlers.QueueHandler):
+    """
+    QueueHandler que deja el formato final (JSON o texto, redacción) al
+    listener. En el hilo que loguea solo se arma el mensaje con sus
+    argumentos y el texto de la excepción, como en `QueueHandler.prepare`:
+    los argumentos mutables se registran con el valor que tenían al loguear.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = record.exc_text or _FORMATO_EXCEPCIONES.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+
+class FormatoJSON(logging.Formatter):
+    _EXTRA = ("otelTraceID", "otelSpanID", "suprimidos")
+
+    def format(self, record: logging.LogRecord) -> str:
+        entrada = {
+            "timestamp": self.formatTime(record, "%Y-%m-%dT%H:%M:%S") + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": redactar(record.getMessage()),
+            "process": record.process,
+            "thread": record.threadName,
+        }
+        for campo in self._EXTRA:
+            valor = getattr(record, campo, None)
+            if valor not in (None, "0"):
+                entrada[campo] = valor
+        if record.exc_info or record.exc_text:
+            entrada["exception"] = redactar(record.exc_text or self.formatException(record.exc_info))
+        return json.dumps(entrada, ensure_ascii=False, default=str)
+
+
+class FormatoTexto(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        texto = redactar(super().format(record))
+        suprimidos = getattr(record, "suprimidos", None)
+        return f"{texto} (+{suprimidos} suprimidos)" if suprimidos else texto
+
+
+def configurar_logging() -> logging.Logger:
+    raiz = logging.getLogger()
+    if getattr(raiz, "_afip_configurado", False):
+        return raiz
+
+    salida = logging.StreamHandler(sys.stdout)
+    salida.setFormatter(FormatoJSON() if LOG_FORMATO == "json" else FormatoTexto("%(asctime)s %(message)s"))
+
+    cola = queue.Queue(LOG_COLA_MAX)
+    encolador = _QueueHandlerDiferido(cola)
+    encolador.addFilter(FiltroMuestreo(LOG_MUESTREO_POR_SEGUNDO))
+
+    listener = logging.handlers.QueueListener(cola, salida, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    for handler in list(raiz.handlers):
+        raiz.removeHandler(handler)
+    raiz.addHandler(encolador)
+    raiz.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
+    raiz._afip_configurado = True
+    raiz._afip_listener = listener
+
+    # pysimplesoap loguea en INFO cada POST con sus cabeceras; solo en DEBUG.
+    if raiz.level > logging.DEBUG:
+        logging.getLogger("pysimplesoap").setLevel(logging.WARNING)
+    return raiz
+
+
+def reiniciar_listener_tras_fork() -> None:
+    """
+    El hilo del listener no sobrevive a un fork: en el hijo se crea una cola
+    nueva (la heredada puede tener su lock tomado) y se reinicia el listener.
+    """
+    raiz = logging.getLogger()
+    listener = getattr(raiz, "_afip_listener", None)
+    if listener is None:
+        return
+    cola = queue.Queue(LOG_COLA_MAX)
+    for handler in raiz.handlers:
+        if isinstance(handler, _QueueHandlerDiferido):
+            handler.queue = cola
+    listener.queue = cola
+    listener._thread = None
+    listener.start()
 
-logging.basicConfig(format='%(asctime)s %(message)s')
 
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
\ No newline at end of file
+logger = configurar_logging()
+os.register_at_fork(after_in_child=reiniciar_listener_tras_fork)
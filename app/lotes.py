@@ -0,0 +1,115 @@
+# app/lotes.py
+"""
+Agrupador de solicitudes concurrentes en micro-lotes.
+
+La primera solicitud que llega para una clave (CUIT, tipo, punto de venta y
+credenciales) pasa a ser la líder: espera hasta AFIP_LOTE_VENTANA_MS o hasta
+completar AFIP_LOTE_MAX comprobantes, ejecuta el lote completo y reparte a
+cada solicitud su propio resultado. El lote corre con el plazo más amplio de
+sus solicitudes, no con el de la líder, así un líder apurado no hace fallar
+al resto. Las demás solo esperan su respuesta, nunca
+más allá de su propio plazo: si vence antes de que el lote salga hacia AFIP
+la solicitud se retira del lote (`PlazoAgotado`); si vence con el lote ya
+enviado, el resultado es incierto (`EnvioIncierto`), igual que en `facturar()`.
+"""
+import threading
+import time
+from typing import Any, Callable, Dict, Hashable, List, Optional, Set
+
+from app.config import AFIP_LOTE_HABILITADO, AFIP_LOTE_VENTANA_MS, AFIP_LOTE_MAX
+from app.logger_setup import logger
+from app.plazos import EnvioIncierto, PlazoAgotado, esperar, plazo_compartido, restante
+
+
+class _Grupo:
+    __slots__ = ("items", "vencimientos", "cerrado", "enviado", "retirados", "lleno", "listo", "resultados")
+
+    def __init__(self):
+        self.items: List[Any] = []
+        self.vencimientos: List[Optional[float]] = []
+        self.cerrado = False
+        self.enviado = False
+        self.retirados: Set[int] = set()
+        self.lleno = threading.Event()
+        self.listo = threading.Event()
+        self.resultados: List[Any] = []
+
+
+class Coalescedor:
+    def __init__(self, ventana_ms: float = AFIP_LOTE_VENTANA_MS, maximo: int = AFIP_LOTE_MAX):
+        self.ventana = ventana_ms / 1000.0
+        self.maximo = maximo
+        self._grupos: Dict[Hashable, _Grupo] = {}
+        self._lock = threading.Lock()
+
+    def _cerrar(self, clave: Hashable, grupo: _Grupo) -> None:
+        grupo.cerrado = True
+        if self._grupos.get(clave) is grupo:
+            del self._grupos[clave]
+
+    @staticmethod
+    def _plazo_del_lote(grupo: _Grupo, indices: List[int]) -> Optional[float]:
+        """Segundos hasta el vencimiento más lejano del lote; None si alguna solicitud no tiene plazo."""
+        vencimientos = [grupo.vencimientos[i] for i in indices]
+        if None in vencimientos:
+            return None
+        return max(vencimientos) - time.monotonic()
+
+    def enviar(self, clave: Hashable, item: Any, ejecutar: Callable[[List[Any]], List[Any]]) -> Any:
+        """
+        Suma `item` al lote abierto de `clave` y devuelve su resultado.
+        `ejecutar` recibe la lista de items y devuelve, en el mismo orden, el
+        resultado o la excepción de cada uno.
+        """
+        with self._lock:
+            grupo = self._grupos.get(clave)
+            lider = grupo is None
+            if lider:
+                grupo = _Grupo()
+                self._grupos[clave] = grupo
+            indice = len(grupo.items)
+            grupo.items.append(item)
+            segundos = restante()
+            grupo.vencimientos.append(None if segundos is None else time.monotonic() + segundos)
+            if len(grupo.items) >= self.maximo:
+                self._cerrar(clave, grupo)
+                grupo.lleno.set()
+
+        if lider:
+            grupo.lleno.wait(self.ventana)
+            with self._lock:
+                self._cerrar(clave, grupo)
+                grupo.enviado = True
+                indices = [i for i in range(len(grupo.items)) if i not in grupo.retirados]
+            grupo.resultados = [None] * len(grupo.items)
+            try:
+                with plazo_compartido(self._plazo_del_lote(grupo, indices)):
+                    resultados = ejecutar([grupo.items[i] for i in indices])
+                for i, resultado in zip(indices, resultados):
+                    grupo.resultados[i] = resultado
+            except Exception as e:
+                for i in indices:
+                    grupo.resultados[i] = e
+            finally:
+                grupo.listo.set()
+            if len(indices) > 1:
+                logger.info("Lote %s ejecutado con %s comprobantes", clave, len(indices))
+        else:
+            try:
+                esperar(grupo.listo.wait, f"el lote {clave}")
+            except PlazoAgotado:
+                with self._lock:
+                    if not grupo.enviado:
+                        grupo.retirados.add(indice)
+                        raise
+                raise EnvioIncierto(f"Plazo agotado con el lote {clave} ya enviado a AFIP; "
+                                    f"verificar el comprobante antes de reenviar") from None
+
+        resultado = grupo.resultados[indice]
+        if isinstance(resultado, Exception):
+            raise resultado
+        return resultado
+
+
+# Instancia única del proceso; None si los micro-lotes están deshabilitados.
+coalescedor: Optional[Coalescedor] = Coalescedor() if AFIP_LOTE_HABILITADO else None
@@ -0,0 +1,340 @@
+# app/outbox.py
+"""
+Outbox durable de comprobantes (store-and-forward).
+
+Durante una caída de AFIP `facturar()` agota sus reintentos y el cliente
+tiene que reenviar más tarde, normalmente todos a la vez. Con el outbox:
+
+- `/facturador/outbox` guarda el comprobante en SQLite y responde
+  "pendiente" con un id para consultar el estado;
+- un drenador en segundo plano (un hilo por proceso) toma los comprobantes
+  en orden de llegada por (CUIT, punto de venta), de a uno por clave, y los
+  emite a AFIP_OUTBOX_TASA comprobantes por segundo en total: el ritmo se
+  reserva en la misma base, así que no se multiplica por la cantidad de
+  workers;
+- los errores de conexión o autenticación se reintentan con backoff
+  exponencial sin alterar el orden de esa clave; los rechazos de AFIP y los
+  errores de datos quedan como "rechazado";
+- si la comunicación falla con la solicitud de CAE ya enviada, el
+  comprobante queda "incierto" y no se reenvía: AFIP pudo haberlo autorizado.
+
+El estado de un comprobante se consulta con el token que devuelve
+`encolar`, con la api_key del tenant registrado o con el token de
+administración.
+
+Las credenciales se guardan cifradas con la clave del registro de tenants:
+las completas si vienen en línea, o el id del tenant y su api_key si la
+solicitud referencia un tenant registrado.
+"""
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Optional
+
+from app.config import (AFIP_OUTBOX_HABILITADO, AFIP_OUTBOX_DB, AFIP_OUTBOX_TASA,
+                        AFIP_OUTBOX_INTERVALO, AFIP_OUTBOX_BACKOFF_MAX)
+from app.limitador import LimiteExcedido
+from app.logger_setup import logger
+from app.plazos import EnvioIncierto
+from app.tenants import AccesoDenegado, registro_tenants
+from app.webhooks import webhooks
+
+PENDIENTE = "pendiente"
+PROCESANDO = "procesando"
+EMITIDO = "emitido"
+RECHAZADO = "rechazado"
+# El proceso que lo emitía murió a mitad de camino o la respuesta de AFIP no
+# llegó: puede o no tener CAE.
+INCIERTO = "incierto"
+
+# Evento de webhook que se envía al llegar a cada estado final.
+EVENTOS = {EMITIDO: "factura.emitida", RECHAZADO: "factura.rechazada", INCIERTO: "factura.incierta"}
+
+# Segundos que un drenador retiene un comprobante tomado antes de darlo por perdido.
+DURACION_TOMA = 600
+BACKOFF_BASE = 2.0
+
+
+def _hash_token(token: str) -> str:
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+def _es_definitivo(error: Exception) -> bool:
+    """Errores que no se resuelven reintentando: datos inválidos, api_key revocada o rechazo de AFIP."""
+    return isinstance(error, (ValueError, AccesoDenegado)) or str(error).startswith("AFIP rechazó")
+
+
+class Outbox:
+    def __init__(self, ruta: str):
+        self.ruta = ruta
+        self._local = threading.local()
+        self._hay_trabajo = threading.Event()
+        self._hilo: Optional[threading.Thread] = None
+        self._pid_hilo: Optional[int] = None
+        self._lock = threading.Lock()
+        self._espera_ritmo: Optional[float] = None
+        # Segundos entre dos comprobantes, sumando todos los drenadores que usan la base.
+        self.pausa = 1.0 / AFIP_OUTBOX_TASA if AFIP_OUTBOX_TASA > 0 else 0.0
+        # Conexión descartable, igual que en el limitador: no heredar handles tras el fork.
+        db = sqlite3.connect(self.ruta, timeout=5)
+        try:
+            db.execute("CREATE TABLE IF NOT EXISTS outbox ("
+                       "id INTEGER PRIMARY KEY AUTOINCREMENT, cuit TEXT NOT NULL, punto_venta INTEGER, "
+                       "credenciales BLOB NOT NULL, cifradas INTEGER NOT NULL, datos TEXT NOT NULL, "
+                       "estado TEXT NOT NULL, intentos INTEGER NOT NULL DEFAULT 0, "
+                       "proximo_intento REAL NOT NULL, tomado_hasta REAL, "
+                       "resultado TEXT, error TEXT, creado REAL NOT NULL, actualizado REAL NOT NULL)")
+            db.execute("CREATE INDEX IF NOT EXISTS outbox_clave ON outbox (cuit, punto_venta, estado, id)")
+            db.execute("CREATE INDEX IF NOT EXISTS outbox_estado ON outbox (estado, creado)")
+            columnas = {fila[1] for fila in db.execute("PRAGMA table_info(outbox)")}
+            for columna in ("tenant_id", "token_hash"):
+                if columna not in columnas:
+                    db.execute(f"ALTER TABLE outbox ADD COLUMN {columna} TEXT")
+            # Próximo instante en el que algún drenador puede emitir (compartido entre procesos).
+            db.execute("CREATE TABLE IF NOT EXISTS ritmo (clave TEXT PRIMARY KEY, proximo REAL NOT NULL)")
+            db.commit()
+        finally:
+            db.close()
+
+    @contextmanager
+    def _transaccion(self):
+        db = getattr(self._local, "db", None)
+        if db is None or getattr(self._local, "pid", None) != os.getpid():
+            db = sqlite3.connect(self.ruta, timeout=5, isolation_level=None)
+            self._local.db = db
+            self._local.pid = os.getpid()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+
+    def encolar(self, credenciales: Dict[str, Any], datos_factura: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Persiste el comprobante y devuelve su estado inicial. Los datos
+        inválidos se rechazan con ValueError antes de tocar la base.
+        """
+        if not isinstance(credenciales, dict) or not isinstance(datos_factura, dict):
+            raise ValueError("'credenciales' y 'datos_factura' deben ser objetos JSON")
+        cuit = credenciales.get("cuit")
+        referencia = credenciales.get("tenant_id") or cuit
+        tenant_id = None
+        if credenciales.get("certificado") and credenciales.get("clave_privada"):
+            if not cuit:
+                # El outbox ordena y reparte el ritmo por CUIT: sin él no se puede encolar.
+                raise ValueError("Las credenciales en línea deben incluir el 'cuit' del emisor")
+            if registro_tenants is None:
+                raise ValueError("Para encolar con credenciales en línea se requiere AFIP_REGISTRO_CLAVE; "
+                                 "alternativamente registre el tenant en /tenants")
+            guardadas, cifradas = registro_tenants.cifrar(json.dumps(credenciales)), 1
+        elif referencia:
+            if registro_tenants is None:
+                raise ValueError("Certificado o clave privada no proporcionados y el registro de credenciales no está configurado")
+            tenant = registro_tenants.obtener(tenant_id=credenciales.get("tenant_id"),
+                                              cuit=None if credenciales.get("tenant_id") else cuit,
+                                              api_key=credenciales.get("api_key"))
+            cuit, tenant_id = tenant["cuit"], tenant["tenant_id"]
+            # La api_key viaja cifrada: el drenador vuelve a presentarla al emitir.
+            guardadas, cifradas = registro_tenants.cifrar(json.dumps({
+                "tenant_id": tenant["tenant_id"], "cuit": cuit, "api_key": credenciales.get("api_key")})), 1
+        else:
+            raise ValueError("Las credenciales deben incluir certificado y clave privada, o un tenant_id/cuit registrado")
+
+        token = secrets.token_urlsafe(24)
+        ahora = time.time()
+        with self._transaccion() as db:
+            cursor = db.execute(
+                "INSERT INTO outbox (cuit, punto_venta, credenciales, cifradas, datos, estado, "
+                "proximo_intento, creado, actualizado, tenant_id, token_hash) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (cuit, datos_factura.get("punto_venta"), guardadas, cifradas,
+                 json.dumps(datos_factura), PENDIENTE, ahora, ahora, ahora, tenant_id, _hash_token(token)))
+            id_outbox = cursor.lastrowid
+        logger.info("Comprobante %s encolado en el outbox para CUIT %s", id_outbox, cuit)
+        self.iniciar_drenador()
+        self._hay_trabajo.set()
+        # El token solo se informa aquí: se guarda su hash.
+        return {**self.consultar(id_outbox), "token": token}
+
+    def verificar_acceso(self, id_outbox: int, token: Optional[str] = None, api_key: Optional[str] = None) -> None:
+        """
+        Lanza `AccesoDenegado` salvo que `token` sea el que devolvió `encolar`
+        o `api_key` la del tenant registrado que encoló el comprobante.
+        """
+        with self._transaccion() as db:
+            fila = db.execute("SELECT tenant_id, token_hash FROM outbox WHERE id = ?", (id_outbox,)).fetchone()
+        if fila is not None:
+            tenant_id, token_hash = fila
+            if token and token_hash and hmac.compare_digest(token_hash, _hash_token(token)):
+                return
+            if api_key and tenant_id and registro_tenants is not None:
+                registro_tenants.verificar_api_key(tenant_id, api_key)
+                return
+        raise AccesoDenegado(f"Se requiere el token del comprobante {id_outbox}, la api_key de su tenant "
+                             "o el token de administración")
+
+    def estado(self) -> Dict[str, Any]:
+        """Comprobantes sin resolver por estado y antigüedad del pendiente más viejo."""
+        with self._transaccion() as db:
+            por_estado = dict(db.execute("SELECT estado, COUNT(*) FROM outbox WHERE estado IN (?, ?, ?) GROUP BY estado",
+                                         (PENDIENTE, PROCESANDO, INCIERTO)).fetchall())
+            mas_viejo = db.execute("SELECT MIN(creado) FROM outbox WHERE estado = ?", (PENDIENTE,)).fetchone()[0]
+        return {**{estado: por_estado.get(estado, 0) for estado in (PENDIENTE, PROCESANDO, INCIERTO)},
+                "antiguedad_max": round(time.time() - mas_viejo, 1) if mas_viejo else 0.0}
+
+    def consultar(self, id_outbox: int) -> Optional[Dict[str, Any]]:
+        with self._transaccion() as db:
+            fila = db.execute("SELECT id, cuit, punto_venta, estado, intentos, proximo_intento, resultado, "
+                              "error, creado, actualizado FROM outbox WHERE id = ?", (id_outbox,)).fetchone()
+        if fila is None:
+            return None
+        id_outbox, cuit, punto_venta, estado, intentos, proximo, resultado, error, creado, actualizado = fila
+        return {
+            "id": id_outbox,
+            "cuit": cuit,
+            "punto_venta": punto_venta,
+            "estado": estado,
+            "intentos": intentos,
+            "proximo_intento": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(proximo)) if estado == PENDIENTE else None,
+            "resultado": json.loads(resultado) if resultado else None,
+            "error": error,
+            "creado": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(creado)),
+            "actualizado": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(actualizado)),
+        }
+
+    def _tomar(self):
+        """
+        Toma el primer comprobante listo de alguna clave que no tenga otro en
+        curso, si el ritmo compartido lo permite; si no, deja en `_espera_ritmo`
+        los segundos que faltan para el próximo turno.
+        """
+        ahora = time.time()
+        self._espera_ritmo = None
+        with self._transaccion() as db:
+            vencidos = [id_outbox for (id_outbox,) in db.execute(
+                "SELECT id FROM outbox WHERE estado = ? AND tomado_hasta < ?", (PROCESANDO, ahora))]
+            db.executemany("UPDATE outbox SET estado = ?, error = ?, actualizado = ? WHERE id = ?",
+                           [(INCIERTO, "El proceso que lo emitía se interrumpió; verificar en AFIP antes de reenviar",
+                             ahora, id_outbox) for id_outbox in vencidos])
+            fila = db.execute(
+                "SELECT o.id, o.credenciales, o.cifradas, o.datos, o.intentos FROM outbox o "
+                "WHERE o.estado = ? AND o.proximo_intento <= ? AND o.id = ("
+                "  SELECT MIN(p.id) FROM outbox p WHERE p.cuit = o.cuit "
+                "  AND p.punto_venta IS o.punto_venta AND p.estado IN (?, ?)) "
+                "ORDER BY o.proximo_intento, o.id LIMIT 1",
+                (PENDIENTE, ahora, PENDIENTE, PROCESANDO)).fetchone()
+            if fila is not None:
+                (proximo,) = db.execute("SELECT proximo FROM ritmo WHERE clave = 'drenador'").fetchone() or (0.0,)
+                if proximo > ahora:
+                    self._espera_ritmo = proximo - ahora
+                    fila = None
+            if fila is not None:
+                db.execute("INSERT OR REPLACE INTO ritmo (clave, proximo) VALUES ('drenador', ?)",
+                           (ahora + self.pausa,))
+                db.execute("UPDATE outbox SET estado = ?, tomado_hasta = ?, actualizado = ? WHERE id = ?",
+                           (PROCESANDO, ahora + DURACION_TOMA, ahora, fila[0]))
+        for id_outbox in vencidos:
+            self._notificar(id_outbox)
+        return fila
+
+    def _finalizar(self, id_outbox: int, estado: str, resultado: Any = None, error: Optional[str] = None,
+                   proximo_intento: Optional[float] = None, intentos: Optional[int] = None) -> None:
+        ahora = time.time()
+        with self._transaccion() as db:
+            db.execute("UPDATE outbox SET estado = ?, resultado = ?, error = ?, proximo_intento = COALESCE(?, proximo_intento), "
+                       "intentos = COALESCE(?, intentos), tomado_hasta = NULL, actualizado = ? WHERE id = ?",
+                       (estado, json.dumps(resultado) if resultado is not None else None, error,
+                        proximo_intento, intentos, ahora, id_outbox))
+        if estado in EVENTOS:
+            self._notificar(id_outbox)
+
+    def _notificar(self, id_outbox: int) -> None:
+        """Envía el estado final del comprobante al webhook de su CUIT, si tiene uno."""
+        if webhooks is None:
+            return
+        try:
+            estado = self.consultar(id_outbox)
+            webhooks.notificar(estado["cuit"], EVENTOS[estado["estado"]], estado)
+        except Exception as e:
+            logger.error("No se pudo encolar el webhook del comprobante %s: %s", id_outbox, e)
+
+    def procesar_siguiente(self) -> bool:
+        """Emite un comprobante del outbox. Devuelve False si no había ninguno listo."""
+        from app.emision import emitir
+
+        fila = self._tomar()
+        if fila is None:
+            return False
+        id_outbox, guardadas, cifradas, datos, intentos = fila
+        try:
+            credenciales = json.loads(registro_tenants.descifrar(guardadas) if cifradas else guardadas)
+            resultado = emitir(credenciales, json.loads(datos))
+        except LimiteExcedido as e:
+            # No es un fallo del comprobante: esperar lo que pide el limitador.
+            self._finalizar(id_outbox, PENDIENTE, proximo_intento=time.time() + e.retry_after)
+        except EnvioIncierto as e:
+            # Reenviar pediría un número nuevo y podría duplicar el comprobante.
+            logger.error("Comprobante %s del outbox sin respuesta de AFIP tras enviarlo: %s", id_outbox, e)
+            self._finalizar(id_outbox, INCIERTO, error=f"{e}; verificar en AFIP antes de reenviar",
+                            intentos=intentos + 1)
+        except Exception as e:
+            if _es_definitivo(e):
+                logger.warning("Comprobante %s del outbox rechazado: %s", id_outbox, e)
+                self._finalizar(id_outbox, RECHAZADO, error=str(e), intentos=intentos + 1)
+            else:
+                espera = min(AFIP_OUTBOX_BACKOFF_MAX, BACKOFF_BASE ** (intentos + 1))
+                logger.warning("Comprobante %s del outbox falló (intento %s), reintento en %.0fs: %s",
+                               id_outbox, intentos + 1, espera, e)
+                self._finalizar(id_outbox, PENDIENTE, error=f"{type(e).__name__}: {e}",
+                                proximo_intento=time.time() + espera, intentos=intentos + 1)
+        else:
+            logger.info("Comprobante %s del outbox emitido con CAE %s", id_outbox, resultado.get("cae"))
+            self._finalizar(id_outbox, EMITIDO, resultado=resultado, intentos=intentos + 1)
+        return True
+
+    def _drenar(self) -> None:
+        while True:
+            self._hay_trabajo.clear()
+            try:
+                procesado = self.procesar_siguiente()
+            except Exception as e:
+                logger.error("Error en el drenador del outbox: %s", e, exc_info=True)
+                procesado = False
+            if procesado:
+                continue
+            if self._espera_ritmo is not None:
+                # Hay trabajo pero otro drenador usó el turno: esperar solo hasta el próximo.
+                time.sleep(min(self._espera_ritmo, AFIP_OUTBOX_INTERVALO))
+            else:
+                self._hay_trabajo.wait(AFIP_OUTBOX_INTERVALO)
+
+    def iniciar_drenador(self) -> None:
+        """Arranca el hilo drenador de este proceso (idempotente, seguro tras un fork)."""
+        with self._lock:
+            if self._hilo is not None and self._pid_hilo == os.getpid() and self._hilo.is_alive():
+                return
+            self._hilo = threading.Thread(target=self._drenar, name="afip-outbox", daemon=True)
+            self._pid_hilo = os.getpid()
+            self._hilo.start()
+        logger.info("Drenador del outbox iniciado (tasa=%s/s)", AFIP_OUTBOX_TASA)
+
+
+def _crear_outbox() -> Optional[Outbox]:
+    if not AFIP_OUTBOX_HABILITADO:
+        return None
+    try:
+        return Outbox(AFIP_OUTBOX_DB)
+    except Exception as e:
+        logger.error("No se pudo iniciar el outbox de comprobantes: %s", e)
+        return None
+
+
+# Instancia única del proceso; None si el outbox está deshabilitado.
+outbox = _crear_outbox()
@@ -0,0 +1,146 @@
+# app/perfilado.py
+"""
+Perfilado bajo demanda de las solicitudes de emisión.
+
+Una solicitud se perfila si trae la cabecera `X-Afip-Perfil` con el token
+configurado o si cae en la tasa de muestreo. En ese caso:
+- se ejecuta con cProfile y el resultado se guarda en AFIP_PERFIL_DIR en
+  formato pstats (`.prof`, legible con snakeviz, flameprof, gprof2dot, ...);
+- cada fase marcada con `fase(...)` (PEM, archivos temporales, WSAA, WSDL,
+  último comprobante, CAE) se mide y se devuelve en la cabecera `Server-Timing`.
+
+Sin token ni muestreo no se registra ningún hook y `fase()` solo consulta
+una ContextVar vacía.
+"""
+import cProfile
+import os
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+from flask import g, request
+
+from app.config import AFIP_PERFIL_TOKEN, AFIP_PERFIL_MUESTREO, AFIP_PERFIL_DIR
+from app.logger_setup import logger
+
+CABECERA_PERFIL = "X-Afip-Perfil"
+RUTAS_PERFILABLES = ("/facturador", "/emitir-nota-credito")
+
+# cProfile admite un único perfilador activo a la vez en el proceso.
+_lock_profiler = threading.Lock()
+
+
+class Perfil:
+    """Tiempos por fase de una solicitud y, opcionalmente, su cProfile."""
+
+    def __init__(self, con_cprofile: bool = True):
+        self.id = uuid.uuid4().hex[:12]
+        self.inicio = time.perf_counter()
+        self.fases: Dict[str, float] = {}
+        self.archivo: Optional[str] = None
+        self._profiler = None
+        if con_cprofile and _lock_profiler.acquire(blocking=False):
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+
+    def registrar(self, nombre: str, segundos: float) -> None:
+        self.fases[nombre] = self.fases.get(nombre, 0.0) + segundos
+
+    def finalizar(self, prefijo: str = "facturar") -> None:
+        self.registrar("total", time.perf_counter() - self.inicio)
+        if self._profiler is None:
+            return
+        self._profiler.disable()
+        try:
+            os.makedirs(AFIP_PERFIL_DIR, exist_ok=True)
+            self.archivo = os.path.join(AFIP_PERFIL_DIR, f"{prefijo}-{time.strftime('%Y%m%d-%H%M%S')}-{self.id}.prof")
+            self._profiler.dump_stats(self.archivo)
+        except OSError as e:
+            logger.warning("No se pudo escribir el perfil en %s: %s", AFIP_PERFIL_DIR, e)
+        finally:
+            self._profiler = None
+            _lock_profiler.release()
+
+    def server_timing(self) -> str:
+        return ", ".join(f"{nombre};dur={segundos * 1000:.1f}" for nombre, segundos in self.fases.items())
+
+
+_perfil_actual: ContextVar[Optional[Perfil]] = ContextVar("perfil_afip", default=None)
+
+
+def perfil_activo() -> Optional[Perfil]:
+    return _perfil_actual.get()
+
+
+@contextmanager
+def fase(nombre: str):
+    """Mide la duración de una fase si la solicitud actual se está perfilando."""
+    perfil = _perfil_actual.get()
+    if perfil is None:
+        yield
+        return
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        perfil.registrar(nombre, time.perf_counter() - inicio)
+
+
+@contextmanager
+def perfilar(prefijo: str = "facturar"):
+    """Perfila el bloque completo; lo usa el gateway AFIP del lado del servidor."""
+    perfil = Perfil()
+    token = _perfil_actual.set(perfil)
+    try:
+        yield perfil
+    finally:
+        _perfil_actual.reset(token)
+        perfil.finalizar(prefijo)
+
+
+def _debe_perfilar() -> bool:
+    if not request.path.endswith(RUTAS_PERFILABLES):
+        return False
+    if AFIP_PERFIL_TOKEN and request.headers.get(CABECERA_PERFIL) == AFIP_PERFIL_TOKEN:
+        return True
+    return AFIP_PERFIL_MUESTREO > 0 and random.random() < AFIP_PERFIL_MUESTREO
+
+
+def instalar_perfilado(app) -> None:
+    """Registra los hooks de perfilado en la app Flask si están configurados."""
+    if not (AFIP_PERFIL_TOKEN or AFIP_PERFIL_MUESTREO > 0):
+        return
+
+    @app.before_request
+    def _iniciar_perfil():
+        if _debe_perfilar():
+            perfil = Perfil()
+            g.perfil_afip = perfil
+            g.perfil_afip_token = _perfil_actual.set(perfil)
+
+    @app.after_request
+    def _cerrar_perfil(response):
+        perfil = g.pop("perfil_afip", None)
+        if perfil is not None:
+            _perfil_actual.reset(g.pop("perfil_afip_token"))
+            perfil.finalizar()
+            response.headers["Server-Timing"] = perfil.server_timing()
+            response.headers[CABECERA_PERFIL] = perfil.id
+            logger.info("Perfil %s de %s: %s (archivo: %s)", perfil.id, request.path,
+                        perfil.server_timing(), perfil.archivo)
+        return response
+
+    @app.teardown_request
+    def _descartar_perfil(_error):
+        # Si after_request no llegó a ejecutarse, liberar el perfilador igual y
+        # quitarlo del contexto: la próxima solicitud del hilo no debe heredarlo.
+        perfil = g.pop("perfil_afip", None)
+        if perfil is not None:
+            _perfil_actual.reset(g.pop("perfil_afip_token"))
+            perfil.finalizar()
+
+    logger.info("Perfilado bajo demanda habilitado (muestreo=%s, dir=%s)", AFIP_PERFIL_MUESTREO, AFIP_PERFIL_DIR)
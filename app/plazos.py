@@ -0,0 +1,147 @@
+# app/plazos.py
+"""
+Plazos de extremo a extremo para las emisiones.
+
+El cliente indica hasta cuándo va a esperar con `X-Request-Deadline`
+(timestamp Unix en segundos) o `X-Request-Timeout` (segundos). El plazo se
+guarda en una ContextVar y lo consultan:
+- el transporte SOAP, que acota los timeouts de conexión y lectura de cada
+  llamada a AFIP al tiempo restante;
+- `AfipConnector.conectar` y `facturar()`, que no inician un paso ni un
+  reintento que el tiempo restante no alcanza a cubrir;
+- el limitador de tasa, que no espera turno más allá del plazo;
+- el gateway AFIP, que recibe el tiempo restante junto con el comprobante.
+
+Cuando el plazo se agota se lanza `PlazoAgotado` y las rutas responden 504,
+liberando el worker en lugar de seguir trabajando para nadie. Si se agota (o
+se corta la conexión) con la solicitud de CAE ya enviada, `facturar()` lanza
+`EnvioIncierto`: AFIP pudo haber otorgado el CAE y reenviar duplicaría el
+comprobante.
+"""
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Optional
+
+from flask import g, request
+
+from app.config import AFIP_PLAZO_DEFECTO, AFIP_PLAZO_MINIMO_REINTENTO
+from app.logger_setup import logger
+
+CABECERA_DEADLINE = "X-Request-Deadline"
+CABECERA_TIMEOUT = "X-Request-Timeout"
+
+
+class PlazoAgotado(TimeoutError):
+    """El cliente ya no espera la respuesta: no tiene sentido seguir."""
+
+
+class EnvioIncierto(ConnectionError):
+    """Falló la comunicación después de enviar la solicitud de CAE: puede o no tener CAE."""
+
+
+# Instante (time.monotonic) en el que vence el plazo de la solicitud actual.
+_vencimiento: ContextVar[Optional[float]] = ContextVar("plazo_afip", default=None)
+
+
+def restante() -> Optional[float]:
+    """Segundos que quedan del plazo, o None si la solicitud no tiene plazo."""
+    vencimiento = _vencimiento.get()
+    return None if vencimiento is None else vencimiento - time.monotonic()
+
+
+def verificar(paso: str) -> None:
+    """Lanza `PlazoAgotado` si el plazo ya venció antes de iniciar `paso`."""
+    segundos = restante()
+    if segundos is not None and segundos <= 0:
+        raise PlazoAgotado(f"Plazo de la solicitud agotado antes de {paso}")
+
+
+def acotar(timeout: Optional[float], paso: str = "la llamada a AFIP") -> Optional[float]:
+    """Timeout a usar en una llamada: el configurado, sin superar el plazo restante."""
+    segundos = restante()
+    if segundos is None:
+        return timeout
+    if segundos <= 0:
+        raise PlazoAgotado(f"Plazo de la solicitud agotado antes de {paso}")
+    return segundos if timeout is None else min(timeout, segundos)
+
+
+def esperar(espera: Callable[[Optional[float]], bool], paso: str, timeout: Optional[float] = None) -> bool:
+    """
+    Ejecuta una espera bloqueante (`espera(segundos)`, con None para esperar
+    sin límite) acotada al plazo restante. Devuelve False si se cumplió
+    `timeout`; si lo que se cumplió fue el plazo, lanza `PlazoAgotado`.
+    """
+    segundos = acotar(timeout, paso)
+    if espera(segundos):
+        return True
+    if timeout is None or segundos < timeout:
+        raise PlazoAgotado(f"Plazo de la solicitud agotado esperando {paso}")
+    return False
+
+
+def puede_reintentar(paso: str) -> bool:
+    """Indica si el plazo restante alcanza para otro intento de `paso`."""
+    segundos = restante()
+    if segundos is None or segundos >= AFIP_PLAZO_MINIMO_REINTENTO:
+        return True
+    logger.warning("Se omite el reintento de %s: quedan %.1fs del plazo", paso, max(segundos, 0.0))
+    return False
+
+
+@contextmanager
+def plazo(segundos: Optional[float]):
+    """Aplica un plazo de `segundos` al bloque (None: sin plazo propio)."""
+    if segundos is None:
+        yield
+        return
+    vencimiento = time.monotonic() + segundos
+    actual = _vencimiento.get()
+    token = _vencimiento.set(vencimiento if actual is None else min(actual, vencimiento))
+    try:
+        yield
+    finally:
+        _vencimiento.reset(token)
+
+
+@contextmanager
+def plazo_compartido(segundos: Optional[float]):
+    """
+    Reemplaza el plazo del bloque por `segundos` (None: sin plazo), aunque sea
+    más largo que el actual. Para trabajo hecho en nombre de varias solicitudes,
+    como el lote que ejecuta el líder de un micro-lote.
+    """
+    token = _vencimiento.set(None if segundos is None else time.monotonic() + segundos)
+    try:
+        yield
+    finally:
+        _vencimiento.reset(token)
+
+
+def _plazo_de_solicitud() -> Optional[float]:
+    try:
+        if request.headers.get(CABECERA_DEADLINE):
+            return float(request.headers[CABECERA_DEADLINE]) - time.time()
+        if request.headers.get(CABECERA_TIMEOUT):
+            return float(request.headers[CABECERA_TIMEOUT])
+    except ValueError:
+        logger.warning("Cabecera de plazo inválida: %s / %s", request.headers.get(CABECERA_DEADLINE),
+                       request.headers.get(CABECERA_TIMEOUT))
+    return AFIP_PLAZO_DEFECTO or None
+
+
+def instalar_plazos(app) -> None:
+    """Registra los hooks que toman el plazo de las cabeceras de cada solicitud."""
+
+    @app.before_request
+    def _iniciar_plazo():
+        segundos = _plazo_de_solicitud()
+        if segundos is not None:
+            g.plazo_afip_token = _vencimiento.set(time.monotonic() + segundos)
+
+    @app.teardown_request
+    def _cerrar_plazo(_error):
+        token = g.pop("plazo_afip_token", None)
+        if token is not None:
+            _vencimiento.reset(token)
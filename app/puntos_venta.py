@@ -0,0 +1,165 @@
+# app/puntos_venta.py
+"""
+Reparto automático de comprobantes entre puntos de venta.
+
+AFIP numera en forma correlativa por (tipo, punto de venta), así que un solo
+punto de venta limita a un tenant a una solicitud de CAE en curso. Un CUIT
+puede registrar varios puntos de venta; las solicitudes que no indican
+`punto_venta` se reparten entre ellos:
+
+- cada punto de venta es un carril con su propio conector AFIP (y por lo
+  tanto su propio lock y numeración), de modo que los carriles emiten en
+  paralelo y cada uno conserva su orden;
+- con afinidad "documento" cada receptor va siempre al mismo punto de venta;
+  `fijos` asigna puntos de venta a receptores puntuales;
+- sin afinidad se elige el carril con menos emisiones en curso en el proceso.
+
+El `punto_venta` y el `numero_comprobante` de la respuesta son los del carril usado.
+"""
+import json
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.afip_connector import AfipConnector
+from app.config import AFIP_PV_DB
+from app.logger_setup import logger
+
+AFINIDADES = ("", "documento")
+# Segundos que se conserva en memoria la configuración de cada CUIT.
+TTL_CONFIGURACION = 60
+
+
+class RepartoPuntosVenta:
+    def __init__(self, ruta: str):
+        self.ruta = ruta
+        self._lock = threading.Lock()
+        self._configuraciones: Dict[str, Tuple[float, Optional[Dict[str, Any]]]] = {}
+        self._en_curso: Dict[Tuple[str, int], int] = {}
+        self._turno: Dict[str, int] = {}
+        self._conectores: Dict[Tuple[str, int], AfipConnector] = {}
+        with self._conexion() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS reparto ("
+                       "cuit TEXT PRIMARY KEY, puntos_venta TEXT NOT NULL, afinidad TEXT NOT NULL, "
+                       "fijos TEXT NOT NULL, actualizado REAL NOT NULL)")
+
+    def _conexion(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.ruta, timeout=5)
+
+    # --- Configuración ---
+
+    def configurar(self, cuit: str, puntos_venta: List[int], afinidad: str = "",
+                   fijos: Optional[Dict[str, int]] = None) -> Dict[str, Any]:
+        """Registra o reemplaza los puntos de venta del CUIT."""
+        try:
+            puntos_venta = sorted({int(pv) for pv in puntos_venta or []})
+            fijos = {str(documento): int(pv) for documento, pv in (fijos or {}).items()}
+        except (TypeError, ValueError):
+            raise ValueError("Los puntos de venta deben ser números enteros")
+        if not puntos_venta or any(pv <= 0 for pv in puntos_venta):
+            raise ValueError("Debe indicar al menos un punto de venta válido")
+        if afinidad not in AFINIDADES:
+            raise ValueError(f"Afinidad inválida: {afinidad} (valores admitidos: 'documento' o vacío)")
+        if any(pv not in puntos_venta for pv in fijos.values()):
+            raise ValueError("Los puntos de venta fijos deben estar entre los registrados")
+        with self._conexion() as db:
+            db.execute("INSERT OR REPLACE INTO reparto VALUES (?, ?, ?, ?, ?)",
+                       (cuit, json.dumps(puntos_venta), afinidad, json.dumps(fijos), time.time()))
+        with self._lock:
+            self._configuraciones.pop(cuit, None)
+        logger.info("Puntos de venta de CUIT %s: %s (afinidad: %s)", cuit, puntos_venta, afinidad or "ninguna")
+        return self.describir(cuit)
+
+    def eliminar(self, cuit: str) -> bool:
+        with self._conexion() as db:
+            borrados = db.execute("DELETE FROM reparto WHERE cuit = ?", (cuit,)).rowcount
+        with self._lock:
+            self._configuraciones.pop(cuit, None)
+        return borrados > 0
+
+    def configuracion(self, cuit: str) -> Optional[Dict[str, Any]]:
+        ahora = time.monotonic()
+        with self._lock:
+            entrada = self._configuraciones.get(cuit)
+            if entrada and ahora - entrada[0] < TTL_CONFIGURACION:
+                return entrada[1]
+        with self._conexion() as db:
+            fila = db.execute("SELECT puntos_venta, afinidad, fijos FROM reparto WHERE cuit = ?", (cuit,)).fetchone()
+        configuracion = None
+        if fila:
+            configuracion = {"puntos_venta": json.loads(fila[0]), "afinidad": fila[1], "fijos": json.loads(fila[2])}
+        with self._lock:
+            self._configuraciones[cuit] = (ahora, configuracion)
+        return configuracion
+
+    def describir(self, cuit: str) -> Optional[Dict[str, Any]]:
+        configuracion = self.configuracion(cuit)
+        if configuracion is None:
+            return None
+        with self._lock:
+            en_curso = {str(pv): self._en_curso.get((cuit, pv), 0) for pv in configuracion["puntos_venta"]}
+        return {"cuit": cuit, **configuracion, "en_curso": en_curso}
+
+    # --- Reparto ---
+
+    def _elegir(self, cuit: str, configuracion: Dict[str, Any], datos_factura: Dict[str, Any]) -> int:
+        puntos_venta = configuracion["puntos_venta"]
+        documento = str(datos_factura.get("documento") or "")
+        if documento in configuracion["fijos"]:
+            return configuracion["fijos"][documento]
+        if configuracion["afinidad"] == "documento" and documento:
+            clave = f"{datos_factura.get('tipo_documento')}:{documento}".encode("utf-8")
+            return puntos_venta[zlib.crc32(clave) % len(puntos_venta)]
+        # Menos emisiones en curso; a igual carga, rotar a partir del último elegido.
+        turno = self._turno.get(cuit, 0)
+        self._turno[cuit] = turno + 1
+        orden = puntos_venta[turno % len(puntos_venta):] + puntos_venta[:turno % len(puntos_venta)]
+        return min(orden, key=lambda pv: self._en_curso.get((cuit, pv), 0))
+
+    @contextmanager
+    def carril(self, cuit: Optional[str], datos_factura: Dict[str, Any]):
+        """
+        Asigna el punto de venta si la solicitud no lo trae y cuenta la emisión
+        como en curso en ese carril. Devuelve los datos con `punto_venta`.
+        """
+        configuracion = self.configuracion(cuit) if cuit else None
+        if datos_factura.get("punto_venta") or configuracion is None:
+            if not datos_factura.get("punto_venta"):
+                raise ValueError("El punto_venta es obligatorio si el CUIT no tiene puntos de venta registrados")
+            yield datos_factura
+            return
+
+        with self._lock:
+            punto_venta = self._elegir(cuit, configuracion, datos_factura)
+            self._en_curso[(cuit, punto_venta)] = self._en_curso.get((cuit, punto_venta), 0) + 1
+        try:
+            yield {**datos_factura, "punto_venta": punto_venta}
+        finally:
+            with self._lock:
+                self._en_curso[(cuit, punto_venta)] -= 1
+
+    def conector(self, cuit: Optional[str], punto_venta: Any) -> Optional[AfipConnector]:
+        """Conector propio del carril, o None si el CUIT no reparte entre puntos de venta."""
+        configuracion = self.configuracion(cuit) if cuit else None
+        if configuracion is None or punto_venta not in configuracion["puntos_venta"]:
+            return None
+        with self._lock:
+            clave = (cuit, punto_venta)
+            if clave not in self._conectores:
+                self._conectores[clave] = AfipConnector()
+            return self._conectores[clave]
+
+
+def _crear_reparto() -> Optional[RepartoPuntosVenta]:
+    try:
+        return RepartoPuntosVenta(AFIP_PV_DB)
+    except Exception as e:
+        logger.warning("No se pudo iniciar el reparto entre puntos de venta: %s", e)
+        return None
+
+
+# Instancia única del proceso (o del gateway AFIP cuando está habilitado).
+reparto_pv = _crear_reparto()
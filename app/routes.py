@@ -1,9 +1,22 @@
 import json
-from flask import request
+import os
+from flask import Response, request, stream_with_context
 from flask_restx import Namespace, Resource, fields
 from app.logger_setup import logger
-from app.factura_electronica import facturar
+from app.emision import emitir
+from app.limitador import LimiteExcedido
 from app.otel_setup import get_tracer
+from app.perfilado import instalar_perfilado
+from app.plazos import PlazoAgotado, instalar_plazos
+from app.config import AFIP_ADMIN_TOKEN, AFIP_PDF_MAX_LOTE
+from app.tenants import AccesoDenegado, registro_tenants
+from app.outbox import outbox
+from app.webhooks import webhooks
+from app.puntos_venta import reparto_pv
+from app.impresion import renderizar_uno, zip_en_flujo
+from app.libro_iva import libro_iva
+from app.salud import sondeador
+from app.exportacion import FORMATOS, exportar, nombre_archivo as nombre_exportacion
 from typing import Dict
 
 # Crear namespace para Flask-RESTX
@@ -13,16 +26,34 @@ afipws_ns = Namespace('afipws', description='Operaciones de facturación AFIP')
 _afip_config = {}
 
 credenciales_model = afipws_ns.model('Credenciales', {
-    'cuit': fields.String(required=True, description='CUIT del emisor de la factura', example='20123456789'),
-    'certificado': fields.String(required=True, description='Contenido del archivo de certificado (.crt) en formato string'),
-    'clave_privada': fields.String(required=True, description='Contenido del archivo de clave privada (.key) en formato string')
+    'cuit': fields.String(description='CUIT del emisor de la factura', example='20123456789'),
+    'tenant_id': fields.String(description='Tenant registrado en /tenants; reemplaza a certificado y clave_privada'),
+    'api_key': fields.String(description='Api key del tenant registrado; obligatoria si se lo referencia por tenant_id o cuit'),
+    'certificado': fields.String(description='Contenido del archivo de certificado (.crt) en formato string; opcional si el tenant está registrado'),
+    'clave_privada': fields.String(description='Contenido del archivo de clave privada (.key) en formato string; opcional si el tenant está registrado')
 })  
 
+tenant_model = afipws_ns.model('Tenant', {
+    'tenant_id': fields.String(description='Identificador del tenant (default: el CUIT)'),
+    'cuit': fields.String(required=True, description='CUIT del emisor', example='20123456789'),
+    'certificado': fields.String(required=True, description='Certificado (.crt) en formato PEM'),
+    'clave_privada': fields.String(required=True, description='Clave privada (.key) en formato PEM')
+})
+
+tenant_response_model = afipws_ns.model('TenantResponse', {
+    'tenant_id': fields.String(description='Identificador del tenant'),
+    'cuit': fields.String(description='CUIT del emisor'),
+    'vencimiento_certificado': fields.String(description='Fecha de vencimiento del certificado'),
+    'dias_para_vencimiento': fields.Integer(description='Días que faltan para que venza el certificado'),
+    'actualizado': fields.String(description='Fecha de la última carga de credenciales'),
+    'api_key': fields.String(description='Api key para emitir como el tenant; solo se informa al generarla')
+})
+
 
 # Modelos para Swagger
 factura_data_model = afipws_ns.model('DatosFactura', {
     'tipo_afip': fields.Integer(required=True, description='Tipo de comprobante AFIP', example=1),
-    'punto_venta': fields.Integer(required=True, description='Punto de venta', example=1),
+    'punto_venta': fields.Integer(description='Punto de venta; si se omite se asigna uno de los registrados para el CUIT', example=1),
     'tipo_documento': fields.Integer(required=True, description='Tipo de documento del receptor', example=80),
     'documento': fields.String(required=True, description='Número de documento del receptor', example='20123456789'),
     'total': fields.Float(required=True, description='Importe total', example=1210.0),
@@ -70,7 +101,140 @@ factura_response_model = afipws_ns.model('FacturaResponse', {
     'asociado_punto_venta': fields.Integer(description='Punto de venta del comprobante asociado'),
     'asociado_numero_comprobante': fields.Integer(description='Número de comprobante asociado'),
     'asociado_fecha_comprobante': fields.String(description='Fecha del comprobante asociado'),
-    'id_condicion_iva': fields.Integer(description='ID de condición IVA del receptor')
+    'id_condicion_iva': fields.Integer(description='ID de condición IVA del receptor'),
+    'qr': fields.String(description='URL del código QR de AFIP (RG 4291) del comprobante')
+})
+
+outbox_response_model = afipws_ns.model('OutboxResponse', {
+    'id': fields.Integer(description='Identificador del comprobante en el outbox'),
+    'cuit': fields.String(description='CUIT del emisor'),
+    'punto_venta': fields.Integer(description='Punto de venta'),
+    'estado': fields.String(description='pendiente, procesando, emitido, rechazado o incierto'),
+    'intentos': fields.Integer(description='Intentos de emisión realizados'),
+    'proximo_intento': fields.String(description='Fecha del próximo intento si está pendiente'),
+    'token': fields.String(description='Token para consultar el estado con X-Outbox-Token; solo se informa al encolar'),
+    'resultado': fields.Nested(factura_response_model, allow_null=True, description='Comprobante autorizado (estado emitido)'),
+    'error': fields.String(description='Último error de emisión'),
+    'creado': fields.String(description='Fecha de recepción'),
+    'actualizado': fields.String(description='Fecha del último cambio de estado')
+})
+
+puntos_venta_model = afipws_ns.model('PuntosVenta', {
+    'puntos_venta': fields.List(fields.Integer, required=True, description='Puntos de venta entre los que se reparten las emisiones', example=[1, 2, 3]),
+    'afinidad': fields.String(description="'documento' para enviar siempre cada receptor al mismo punto de venta", enum=['', 'documento']),
+    'fijos': fields.Raw(description='Punto de venta fijo por documento del receptor, p. ej. {"30711111111": 2}')
+})
+
+puntos_venta_response_model = afipws_ns.inherit('PuntosVentaResponse', puntos_venta_model, {
+    'cuit': fields.String(description='CUIT del emisor'),
+    'en_curso': fields.Raw(description='Emisiones en curso por punto de venta en este proceso')
+})
+
+webhook_model = afipws_ns.model('Webhook', {
+    'url': fields.String(required=True, description='URL que recibe los resultados (POST JSON)', example='https://erp.example.com/afip/webhook'),
+    'secreto': fields.String(description='Secreto HMAC-SHA256 para la cabecera X-Afip-Firma; si se omite se genera uno')
+})
+
+webhook_response_model = afipws_ns.model('WebhookResponse', {
+    'cuit': fields.String(description='CUIT del emisor'),
+    'url': fields.String(description='URL registrada'),
+    'secreto': fields.String(description='Secreto de firma (solo se devuelve al registrar)')
+})
+
+webhook_fallido_model = afipws_ns.model('WebhookFallido', {
+    'id': fields.Integer(description='Identificador del evento'),
+    'cuit': fields.String(description='CUIT del emisor'),
+    'tipo': fields.String(description='Tipo de evento'),
+    'intentos': fields.Integer(description='Intentos de entrega realizados'),
+    'error': fields.String(description='Último error de entrega'),
+    'creado': fields.String(description='Fecha del evento'),
+    'actualizado': fields.String(description='Fecha del último intento')
+})
+
+emisor_model = afipws_ns.model('Emisor', {
+    'razon_social': fields.String(required=True, description='Razón social del emisor'),
+    'cuit': fields.String(required=True, description='CUIT del emisor'),
+    'domicilio': fields.String(description='Domicilio comercial'),
+    'condicion_iva': fields.String(description='Condición frente al IVA', example='IVA Responsable Inscripto'),
+    'ingresos_brutos': fields.String(description='Número de Ingresos Brutos'),
+    'inicio_actividades': fields.String(description='Fecha de inicio de actividades'),
+    'logo': fields.String(description='Logo PNG o JPEG en base64')
+})
+
+comprobantes_pdf_model = afipws_ns.model('ComprobantesPdf', {
+    'emisor': fields.Nested(emisor_model, required=True),
+    'comprobantes': fields.List(fields.Nested(factura_response_model), required=True,
+                                description='Comprobantes autorizados, tal como los devuelve /facturador')
+})
+
+pdf_parser = afipws_ns.parser()
+pdf_parser.add_argument('formato', type=str, required=False, choices=('pdf', 'zip'), help='pdf (un comprobante) o zip', location='args')
+
+libro_iva_parser = afipws_ns.parser()
+libro_iva_parser.add_argument('desde', type=str, required=True, help='Fecha inicial AAAA-MM-DD (inclusive)', location='args')
+libro_iva_parser.add_argument('hasta', type=str, required=True, help='Fecha final AAAA-MM-DD (inclusive)', location='args')
+libro_iva_parser.add_argument('por', type=str, required=False, choices=('dia', 'mes'), help='Desglose por día o por mes', location='args')
+libro_iva_parser.add_argument('tipo_afip', type=int, required=False, help='Solo este tipo de comprobante', location='args')
+libro_iva_parser.add_argument('punto_venta', type=int, required=False, help='Solo este punto de venta', location='args')
+
+exportacion_parser = afipws_ns.parser()
+exportacion_parser.add_argument('desde', type=str, required=True, help='Fecha inicial AAAA-MM-DD (inclusive)', location='args')
+exportacion_parser.add_argument('hasta', type=str, required=True, help='Fecha final AAAA-MM-DD (inclusive)', location='args')
+exportacion_parser.add_argument('formato', type=str, required=False, choices=tuple(FORMATOS), default='csv', help='csv o parquet', location='args')
+exportacion_parser.add_argument('tipo_afip', type=int, required=False, help='Solo este tipo de comprobante', location='args')
+exportacion_parser.add_argument('punto_venta', type=int, required=False, help='Solo este punto de venta', location='args')
+
+libro_iva_totales_model = afipws_ns.model('LibroIvaTotales', {
+    'cantidad': fields.Integer(description='Comprobantes (las notas de crédito también suman uno)'),
+    'neto': fields.Float(description='Neto gravado 21% (las notas de crédito restan)'),
+    'neto105': fields.Float(description='Neto gravado 10.5%'),
+    'iva': fields.Float(description='IVA 21%'),
+    'iva105': fields.Float(description='IVA 10.5%'),
+    'exento': fields.Float(description='Importe exento'),
+    'total': fields.Float(description='Importe total')
+})
+
+libro_iva_detalle_model = afipws_ns.inherit('LibroIvaDetalle', libro_iva_totales_model, {
+    'periodo': fields.String(description="Día (AAAA-MM-DD) o mes (AAAA-MM) si se pidió desglose con 'por'"),
+    'tipo_afip': fields.Integer(description='Tipo de comprobante AFIP'),
+    'punto_venta': fields.Integer(description='Punto de venta')
+})
+
+libro_iva_response_model = afipws_ns.model('LibroIvaResponse', {
+    'cuit': fields.String(description='CUIT del emisor'),
+    'desde': fields.String(description='Fecha inicial'),
+    'hasta': fields.String(description='Fecha final'),
+    'por': fields.String(description='Desglose solicitado'),
+    'totales': fields.Nested(libro_iva_totales_model, description='Totales del período'),
+    'detalle': fields.List(fields.Nested(libro_iva_detalle_model), description='Totales por período, tipo y punto de venta')
+})
+
+vivo_response_model = afipws_ns.model('VivoResponse', {
+    'estado': fields.String(description='Siempre "vivo" si el worker atiende', example='vivo'),
+    'pid': fields.Integer(description='Proceso que respondió')
+})
+
+ta_model = afipws_ns.model('EstadoTa', {
+    'cuit': fields.String(description='CUIT del tenant'),
+    'entorno': fields.String(description='produccion u homologacion'),
+    'vencimiento': fields.String(description='Vencimiento del TA'),
+    'restante': fields.Integer(description='Segundos de vigencia restantes'),
+    'estado': fields.String(description='vigente, por_vencer o vencido')
+})
+
+listo_response_model = afipws_ns.model('ListoResponse', {
+    'listo': fields.Boolean(description='La réplica puede recibir emisiones'),
+    'motivos': fields.List(fields.String, description='Por qué no está lista'),
+    'degradado': fields.Boolean(description='AFIP con el circuito abierto o sin sondeo reciente; la réplica sigue lista'),
+    'avisos': fields.List(fields.String, description='Detalle del estado degradado'),
+    'generado': fields.String(description='Momento del último sondeo'),
+    'afip': fields.Raw(description='FEDummy por entorno: servidores, latencia y estado del circuito'),
+    'tas': fields.List(fields.Nested(ta_model), description='Vigencia del TA de cada tenant con conector activo'),
+    'gateway': fields.Raw(description='Disponibilidad del gateway AFIP, si está habilitado'),
+    'admision': fields.Raw(description='Turnos en curso y en cola del limitador'),
+    'transporte': fields.Raw(description='Conexiones SOAP ociosas por host'),
+    'outbox': fields.Raw(description='Comprobantes sin resolver del outbox'),
+    'webhooks': fields.Raw(description='Eventos sin entregar')
 })
 
 test_response_model = afipws_ns.model('TestResponse', {
@@ -88,6 +252,41 @@ consulta_response_model = afipws_ns.model('ConsultaResponse', {
 })
 
 
+@afipws_ns.errorhandler(LimiteExcedido)
+def handle_limite_excedido(error):
+    """Traduce el rechazo del limitador de tasa en un 429 con Retry-After."""
+    logger.warning('Solicitud rechazada por límite de tasa: %s', error)
+    return {'message': str(error)}, 429, {'Retry-After': str(error.retry_after)}
+
+
+@afipws_ns.errorhandler(AccesoDenegado)
+def handle_acceso_denegado(error):
+    """La solicitud referencia un tenant registrado sin su api_key válida."""
+    logger.warning('Acceso denegado: %s', error)
+    return {'message': str(error)}, 401
+
+
+@afipws_ns.errorhandler(PlazoAgotado)
+def handle_plazo_agotado(error):
+    """El plazo indicado por el cliente venció antes de terminar la emisión."""
+    logger.warning('Solicitud abandonada por plazo agotado: %s', error)
+    return {'message': str(error)}, 504
+
+
+def _verificar_admin(requiere_registro: bool = True):
+    """Exige el token de administración y, si corresponde, el registro de tenants habilitado."""
+    if not AFIP_ADMIN_TOKEN or request.headers.get('X-Admin-Token') != AFIP_ADMIN_TOKEN:
+        afipws_ns.abort(403, "Token de administración inválido")
+    if requiere_registro and registro_tenants is None:
+        afipws_ns.abort(503, "El registro de credenciales no está configurado (AFIP_REGISTRO_CLAVE)")
+
+
+def _verificar_webhooks():
+    _verificar_admin(requiere_registro=False)
+    if webhooks is None:
+        afipws_ns.abort(503, "Los webhooks no están habilitados (AFIP_WEBHOOK_HABILITADO)")
+
+
 @afipws_ns.route('/test')
 class TestResource(Resource):
     @afipws_ns.doc('test_endpoint')
@@ -109,6 +308,27 @@ class TestResource(Resource):
 
 
 
+@afipws_ns.route('/salud/vivo')
+class VivoResource(Resource):
+    @afipws_ns.doc('sonda_vida')
+    @afipws_ns.marshal_with(vivo_response_model)
+    def get(self):
+        """Sonda de vida: responde sin consultar AFIP ni ningún almacenamiento."""
+        return {'estado': 'vivo', 'pid': os.getpid()}
+
+
+@afipws_ns.route('/salud/listo')
+class ListoResource(Resource):
+    @afipws_ns.doc('sonda_disponibilidad', responses={503: 'La réplica no está lista'})
+    @afipws_ns.marshal_with(listo_response_model)
+    def get(self):
+        """Sonda de disponibilidad: última foto del sondeo de fondo (no genera llamadas a AFIP)."""
+        if sondeador is None:
+            return {'listo': True, 'motivos': []}
+        foto = sondeador.foto()
+        return foto, 200 if foto['listo'] else 503
+
+
 @afipws_ns.route('/facturador')
 class FacturadorResource(Resource):
     @afipws_ns.doc('facturar')
@@ -130,26 +350,27 @@ class FacturadorResource(Resource):
             if not credenciales or not datos_factura:
                 afipws_ns.abort(400, "El JSON debe contener los objetos anidados 'credenciales' y 'datos_factura'")
             
-            logger.info(f"Facturando para CUIT: {credenciales.get('cuit')}...")
+            logger.info("Facturando para CUIT: %s...", credenciales.get('cuit') or credenciales.get('tenant_id'))
             
             # DEBUG: Logear los datos recibidos para análisis
-            logger.info(f"DATOS RECIBIDOS - Credenciales CUIT: {credenciales.get('cuit')}")
-            logger.info(f"DATOS RECIBIDOS - Datos factura: {datos_factura}")
+            logger.debug("DATOS RECIBIDOS - Datos factura: %s", datos_factura)
             
             # Obtener la configuración global de 'production'
             production = _afip_config.get('production', False)
             
             # ¡CAMBIO CLAVE! Pasamos las credenciales y los datos de la factura 
             # a la función de negocio para que ella los maneje.
-            result = facturar(credenciales, datos_factura)
+            result = emitir(credenciales, datos_factura)
             
             return result
             
+        except (LimiteExcedido, PlazoAgotado, AccesoDenegado):
+            raise
         except ValueError as e:
             # Errores del cliente (por ejemplo PEM inválido) devuelven 400 para facilitar diagnóstico
             error_type = type(e).__name__
             error_message = str(e)
-            logger.warning(f'Error de cliente: {error_type}: {error_message}')
+            logger.warning('Error de cliente: %s: %s', error_type, error_message)
             afipws_ns.abort(400, message=f"Error de entrada: {error_message}")
         except Exception as e:
             # --- BLOQUE DE DEPURACIÓN MEJORADO ---
@@ -157,9 +378,9 @@ class FacturadorResource(Resource):
             error_message = str(e)
             
             # Imprimimos todos los detalles en el log para la autopsia
-            logger.error(f'!!!!!!!! ERROR FATAL ENCONTRADO !!!!!!!!')
-            logger.error(f'TIPO DE EXCEPCIÓN: {error_type}')
-            logger.error(f'MENSAJE DE EXCEPCIÓN: {error_message}')
+            logger.error('!!!!!!!! ERROR FATAL ENCONTRADO !!!!!!!!')
+            logger.error('TIPO DE EXCEPCIÓN: %s', error_type)
+            logger.error('MENSAJE DE EXCEPCIÓN: %s', error_message)
             # Usamos exc_info=True para que el logger imprima el traceback completo
             logger.error('TRACEBACK COMPLETO:', exc_info=True)
             
@@ -168,7 +389,269 @@ class FacturadorResource(Resource):
             afipws_ns.abort(500, message=f"Error interno del servidor: {error_completo}")
             # ------------------------------------
 
-            
+
+
+@afipws_ns.route('/facturador/outbox')
+class OutboxResource(Resource):
+    @afipws_ns.doc('encolar_factura')
+    @afipws_ns.expect(factura_multitenant_model)
+    @afipws_ns.marshal_with(outbox_response_model, code=202)
+    def post(self):
+        """Guarda el comprobante en el outbox y responde 'pendiente'; se emite en segundo plano."""
+        if outbox is None:
+            afipws_ns.abort(503, "El outbox de comprobantes no está habilitado (AFIP_OUTBOX_HABILITADO)")
+        json_data = request.get_json()
+        if not json_data or not json_data.get('credenciales') or not json_data.get('datos_factura'):
+            afipws_ns.abort(400, "El JSON debe contener los objetos anidados 'credenciales' y 'datos_factura'")
+        try:
+            estado = outbox.encolar(json_data['credenciales'], json_data['datos_factura'])
+        except ValueError as e:
+            logger.warning('Error de cliente al encolar: %s', e)
+            afipws_ns.abort(400, message=f"Error de entrada: {e}")
+        return estado, 202
+
+
+@afipws_ns.route('/facturador/outbox/<int:id_outbox>')
+class OutboxEstadoResource(Resource):
+    @afipws_ns.doc('estado_outbox')
+    @afipws_ns.marshal_with(outbox_response_model)
+    def get(self, id_outbox):
+        """
+        Estado de un comprobante del outbox y, si ya se emitió, su CAE. Requiere
+        X-Outbox-Token (devuelto al encolar), X-Api-Key del tenant o X-Admin-Token.
+        """
+        if outbox is None:
+            afipws_ns.abort(503, "El outbox de comprobantes no está habilitado (AFIP_OUTBOX_HABILITADO)")
+        if not AFIP_ADMIN_TOKEN or request.headers.get('X-Admin-Token') != AFIP_ADMIN_TOKEN:
+            outbox.verificar_acceso(id_outbox, token=request.headers.get('X-Outbox-Token'),
+                                    api_key=request.headers.get('X-Api-Key'))
+        estado = outbox.consultar(id_outbox)
+        if estado is None:
+            afipws_ns.abort(404, f"Comprobante {id_outbox} no encontrado en el outbox")
+        return estado
+
+
+@afipws_ns.route('/tenants')
+class TenantsResource(Resource):
+    @afipws_ns.doc('listar_tenants')
+    @afipws_ns.marshal_list_with(tenant_response_model)
+    def get(self):
+        """Lista los tenants registrados (sin credenciales)."""
+        _verificar_admin()
+        return registro_tenants.listar()
+
+    @afipws_ns.doc('registrar_tenant')
+    @afipws_ns.expect(tenant_model)
+    @afipws_ns.marshal_with(tenant_response_model, code=201)
+    def post(self):
+        """Registra o reemplaza el certificado y la clave privada de un tenant."""
+        _verificar_admin()
+        payload = request.get_json() or {}
+        try:
+            tenant = registro_tenants.registrar(payload.get('cuit'), payload.get('certificado'),
+                                                payload.get('clave_privada'), payload.get('tenant_id'))
+        except ValueError as e:
+            logger.warning('Error de cliente al registrar tenant: %s', e)
+            afipws_ns.abort(400, message=f"Error de entrada: {e}")
+        return tenant, 201
+
+
+@afipws_ns.route('/tenants/<string:tenant_id>')
+class TenantResource(Resource):
+    @afipws_ns.doc('consultar_tenant')
+    @afipws_ns.marshal_with(tenant_response_model)
+    def get(self, tenant_id):
+        """Devuelve los datos del tenant y el vencimiento de su certificado."""
+        _verificar_admin()
+        tenant = registro_tenants.describir(tenant_id)
+        if tenant is None:
+            afipws_ns.abort(404, f"Tenant {tenant_id} no registrado")
+        return tenant
+
+    @afipws_ns.doc('eliminar_tenant')
+    def delete(self, tenant_id):
+        """Elimina las credenciales del tenant."""
+        _verificar_admin()
+        if not registro_tenants.eliminar(tenant_id):
+            afipws_ns.abort(404, f"Tenant {tenant_id} no registrado")
+        return '', 204
+
+
+@afipws_ns.route('/tenants/<string:tenant_id>/api-key')
+class TenantApiKeyResource(Resource):
+    @afipws_ns.doc('regenerar_api_key')
+    @afipws_ns.marshal_with(tenant_response_model, code=201)
+    def post(self, tenant_id):
+        """Genera una api_key nueva para el tenant; la anterior deja de valer."""
+        _verificar_admin()
+        tenant = registro_tenants.regenerar_api_key(tenant_id)
+        if tenant is None:
+            afipws_ns.abort(404, f"Tenant {tenant_id} no registrado")
+        return tenant, 201
+
+
+@afipws_ns.route('/tenants/<string:cuit>/puntos-venta')
+class PuntosVentaResource(Resource):
+    @afipws_ns.doc('configurar_puntos_venta')
+    @afipws_ns.expect(puntos_venta_model)
+    @afipws_ns.marshal_with(puntos_venta_response_model)
+    def put(self, cuit):
+        """Registra los puntos de venta entre los que se reparten las emisiones del CUIT."""
+        _verificar_admin(requiere_registro=False)
+        if reparto_pv is None:
+            afipws_ns.abort(503, "El reparto entre puntos de venta no está disponible")
+        payload = request.get_json() or {}
+        try:
+            return reparto_pv.configurar(cuit, payload.get('puntos_venta'), payload.get('afinidad') or '',
+                                         payload.get('fijos'))
+        except ValueError as e:
+            afipws_ns.abort(400, message=f"Error de entrada: {e}")
+
+    @afipws_ns.doc('consultar_puntos_venta')
+    @afipws_ns.marshal_with(puntos_venta_response_model)
+    def get(self, cuit):
+        """Puntos de venta registrados del CUIT y emisiones en curso por cada uno."""
+        _verificar_admin(requiere_registro=False)
+        configuracion = reparto_pv.describir(cuit) if reparto_pv else None
+        if configuracion is None:
+            afipws_ns.abort(404, f"El CUIT {cuit} no tiene puntos de venta registrados")
+        return configuracion
+
+    @afipws_ns.doc('eliminar_puntos_venta')
+    def delete(self, cuit):
+        """Deja de repartir las emisiones del CUIT."""
+        _verificar_admin(requiere_registro=False)
+        if reparto_pv is None or not reparto_pv.eliminar(cuit):
+            afipws_ns.abort(404, f"El CUIT {cuit} no tiene puntos de venta registrados")
+        return '', 204
+
+
+@afipws_ns.route('/webhooks/<string:cuit>')
+class WebhookResource(Resource):
+    @afipws_ns.doc('registrar_webhook')
+    @afipws_ns.expect(webhook_model)
+    @afipws_ns.marshal_with(webhook_response_model)
+    def put(self, cuit):
+        """Registra o reemplaza la URL de webhook del CUIT."""
+        _verificar_webhooks()
+        payload = request.get_json() or {}
+        try:
+            return webhooks.registrar_destino(cuit, payload.get('url'), payload.get('secreto'))
+        except ValueError as e:
+            afipws_ns.abort(400, message=f"Error de entrada: {e}")
+
+    @afipws_ns.doc('consultar_webhook')
+    @afipws_ns.marshal_with(webhook_response_model)
+    def get(self, cuit):
+        """Devuelve la URL de webhook del CUIT (sin el secreto)."""
+        _verificar_webhooks()
+        destino = webhooks.destino(cuit)
+        if destino is None:
+            afipws_ns.abort(404, f"El CUIT {cuit} no tiene webhook registrado")
+        return {'cuit': cuit, 'url': destino['url']}
+
+    @afipws_ns.doc('eliminar_webhook')
+    def delete(self, cuit):
+        """Elimina el webhook del CUIT."""
+        _verificar_webhooks()
+        if not webhooks.eliminar_destino(cuit):
+            afipws_ns.abort(404, f"El CUIT {cuit} no tiene webhook registrado")
+        return '', 204
+
+
+fallidos_parser = afipws_ns.parser()
+fallidos_parser.add_argument('cuit', type=str, required=False, help='Filtrar por CUIT', location='args')
+
+
+@afipws_ns.route('/webhooks/fallidos')
+class WebhookFallidosResource(Resource):
+    @afipws_ns.doc('listar_webhooks_fallidos')
+    @afipws_ns.expect(fallidos_parser)
+    @afipws_ns.marshal_list_with(webhook_fallido_model)
+    def get(self):
+        """Eventos que agotaron sus reintentos de entrega (dead-letter)."""
+        _verificar_webhooks()
+        return webhooks.fallidos(fallidos_parser.parse_args().get('cuit'))
+
+    @afipws_ns.doc('reintentar_webhooks_fallidos')
+    @afipws_ns.expect(fallidos_parser)
+    def post(self):
+        """Vuelve a encolar los eventos fallidos (opcionalmente de un CUIT)."""
+        _verificar_webhooks()
+        return {'reencolados': webhooks.reintentar_fallidos(fallidos_parser.parse_args().get('cuit'))}
+
+
+@afipws_ns.route('/libro-iva/<string:cuit>')
+class LibroIvaResource(Resource):
+    @afipws_ns.doc('consultar_libro_iva')
+    @afipws_ns.expect(libro_iva_parser)
+    @afipws_ns.marshal_with(libro_iva_response_model)
+    def get(self, cuit):
+        """Totales del libro IVA ventas del CUIT en un período, desde los agregados diarios y mensuales."""
+        _verificar_admin(requiere_registro=False)
+        if libro_iva is None:
+            afipws_ns.abort(503, "El libro IVA no está habilitado (AFIP_LIBRO_IVA_HABILITADO)")
+        args = libro_iva_parser.parse_args()
+        try:
+            return libro_iva.consultar(cuit, args['desde'], args['hasta'], por=args.get('por'),
+                                       tipo_afip=args.get('tipo_afip'), punto_venta=args.get('punto_venta'))
+        except ValueError as e:
+            afipws_ns.abort(400, message=str(e))
+
+
+@afipws_ns.route('/comprobantes/<string:cuit>/exportacion')
+class ExportacionResource(Resource):
+    @afipws_ns.doc('exportar_comprobantes', produces=[tipo for tipo, _ in FORMATOS.values()])
+    @afipws_ns.expect(exportacion_parser)
+    def get(self, cuit):
+        """Comprobantes autorizados del CUIT en CSV o Parquet, enviados a medida que se leen."""
+        _verificar_admin(requiere_registro=False)
+        if libro_iva is None:
+            afipws_ns.abort(503, "La exportación requiere el libro IVA habilitado (AFIP_LIBRO_IVA_HABILITADO)")
+        args = exportacion_parser.parse_args()
+        try:
+            partes = exportar(cuit, args['desde'], args['hasta'], args['formato'],
+                              tipo_afip=args.get('tipo_afip'), punto_venta=args.get('punto_venta'))
+        except ValueError as e:
+            afipws_ns.abort(400, message=str(e))
+        nombre = nombre_exportacion(cuit, args['desde'], args['hasta'], args['formato'])
+        return Response(stream_with_context(partes), mimetype=FORMATOS[args['formato']][0],
+                        headers={'Content-Disposition': f'attachment; filename="{nombre}"'})
+
+
+@afipws_ns.route('/comprobantes/pdf')
+class ComprobantesPdfResource(Resource):
+    @afipws_ns.doc('imprimir_comprobantes', produces=['application/pdf', 'application/zip'])
+    @afipws_ns.expect(comprobantes_pdf_model, pdf_parser)
+    def post(self):
+        """
+        PDF de un comprobante o zip con los PDF de varios, con el QR de AFIP.
+        Requiere X-Api-Key del tenant del CUIT emisor o X-Admin-Token.
+        """
+        json_data = request.get_json(silent=True) or {}
+        emisor = json_data.get('emisor')
+        comprobantes = json_data.get('comprobantes')
+        if not isinstance(emisor, dict) or not emisor.get('cuit') or not isinstance(comprobantes, list) or not comprobantes:
+            afipws_ns.abort(400, "El JSON debe contener 'emisor' (con 'cuit') y una lista no vacía de 'comprobantes'")
+        if not AFIP_ADMIN_TOKEN or request.headers.get('X-Admin-Token') != AFIP_ADMIN_TOKEN:
+            if registro_tenants is None:
+                raise AccesoDenegado("Se requiere el token de administración")
+            registro_tenants.verificar_api_key_de_cuit(str(emisor['cuit']), request.headers.get('X-Api-Key'))
+        if len(comprobantes) > AFIP_PDF_MAX_LOTE:
+            afipws_ns.abort(400, f"A lo sumo {AFIP_PDF_MAX_LOTE} comprobantes por solicitud")
+
+        formato = pdf_parser.parse_args().get('formato') or ('pdf' if len(comprobantes) == 1 else 'zip')
+        if formato == 'pdf':
+            if len(comprobantes) != 1:
+                afipws_ns.abort(400, "El formato pdf admite un solo comprobante")
+            nombre, pdf = renderizar_uno(emisor, comprobantes[0])
+            return Response(pdf, mimetype='application/pdf',
+                            headers={'Content-Disposition': f'inline; filename="{nombre}"'})
+
+        logger.info("Generando zip con %s comprobantes de CUIT %s", len(comprobantes), emisor.get('cuit'))
+        return Response(stream_with_context(zip_en_flujo(emisor, comprobantes)), mimetype='application/zip',
+                        headers={'Content-Disposition': f'attachment; filename="comprobantes_{emisor.get("cuit")}.zip"'})
+
 
 def register_routes(config: Dict, api):
     """Configura y registra las rutas con la API de Flask-RESTX."""
@@ -178,6 +661,21 @@ def register_routes(config: Dict, api):
     
     # Agregar namespace a la API
     api.add_namespace(afipws_ns)
+
+    # Perfilado bajo demanda de las emisiones (sin efecto si no está configurado)
+    if api.app is not None:
+        instalar_perfilado(api.app)
+        # Plazo de extremo a extremo (X-Request-Deadline / X-Request-Timeout)
+        instalar_plazos(api.app)
+
+    # El outbox y los webhooks retoman lo pendiente aunque no lleguen nuevas solicitudes
+    if outbox is not None:
+        outbox.iniciar_drenador()
+    if webhooks is not None:
+        webhooks.iniciar_despachador()
+    # Sondeo de fondo que alimenta /salud/listo
+    if sondeador is not None:
+        sondeador.iniciar()
 @afipws_ns.route('/facturador/emitir-nota-credito')
 class NotaCreditoResource(Resource):
     @afipws_ns.doc('emitir_nota_credito')
@@ -195,13 +693,15 @@ class NotaCreditoResource(Resource):
             faltan = [k for k in ['asociado_tipo_afip','asociado_punto_venta','asociado_numero_comprobante','asociado_fecha_comprobante'] if not datos.get(k)]
             if faltan:
                 afipws_ns.abort(400, f"Faltan campos asociado_*: {', '.join(faltan)}")
-            return facturar(credenciales, datos)
+            return emitir(credenciales, datos)
+        except (LimiteExcedido, PlazoAgotado, AccesoDenegado):
+            raise
         except ValueError as e:
             afipws_ns.abort(400, message=f"Error de entrada: {str(e)}")
         except Exception as e:
             error_type = type(e).__name__
-            logger.error(f'!!!!!!!! ERROR FATAL ENCONTRADO !!!!!!!!')
-            logger.error(f'TIPO DE EXCEPCIÓN: {error_type}')
-            logger.error(f'MENSAJE DE EXCEPCIÓN: {str(e)}')
+            logger.error('!!!!!!!! ERROR FATAL ENCONTRADO !!!!!!!!')
+            logger.error('TIPO DE EXCEPCIÓN: %s', error_type)
+            logger.error('MENSAJE DE EXCEPCIÓN: %s', str(e))
             logger.error('TRACEBACK COMPLETO:', exc_info=True)
             afipws_ns.abort(500, message=f"Error interno del servidor: {error_type}: {str(e)}")
@@ -0,0 +1,273 @@
+# app/salud.py
+"""
+Sondas de vida y de disponibilidad con resultados precalculados.
+
+`/salud/vivo` solo confirma que el worker atiende; es la que usa el
+healthcheck de docker-compose. `/salud/listo`, pensada para la readiness del
+balanceador, devuelve la última foto armada por un hilo de fondo (uno por
+worker) cada AFIP_SALUD_INTERVALO segundos:
+
+- con AFIP_SALUD_FEDUMMY, FEDummy de AFIP por entorno, con un circuito que se
+  abre tras AFIP_SALUD_FALLOS_MAX fallos seguidos. El resultado se guarda en SQLite y
+  lo comparten todos los workers del contenedor: el primero que toma el turno
+  sondea y los demás leen, de modo que hay un FEDummy por entorno e
+  intervalo sin importar cuántas veces se consulten las sondas;
+- vigencia del TA de cada tenant con conector activo (en este proceso y, si
+  está habilitado, en el gateway AFIP);
+- ocupación del limitador, del pool de conexiones SOAP, del outbox y de los
+  webhooks.
+
+La réplica no está lista si el gateway no responde o si el sondeo dejó de
+correr. El estado de AFIP (circuito abierto o sin resultado reciente) se
+informa como `degradado` con sus avisos, pero no la saca del balanceador:
+durante una caída de AFIP el outbox sigue aceptando comprobantes.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+from app.afip_connector import AfipConnector, WSFEv1
+from app.afip_gateway import gateway_cliente
+from app.config import (AFIP_SALUD_INTERVALO, AFIP_SALUD_FEDUMMY, AFIP_SALUD_ENTORNOS, AFIP_SALUD_TIMEOUT, AFIP_SALUD_FALLOS_MAX,
+                        AFIP_SALUD_TA_MARGEN, AFIP_SALUD_DB, AFIP_HTTP_POOL, CACHE,
+                        URL_WSFEv1_PROD, URL_WSFEv1_HOMO)
+from app.limitador import control_admision
+from app.logger_setup import logger
+from app.outbox import outbox
+from app.plazos import plazo
+from app.soap_transport import pool
+from app.webhooks import webhooks
+
+ENTORNOS = {"produccion": URL_WSFEv1_PROD, "homologacion": URL_WSFEv1_HOMO}
+# Sondeos perdidos tras los cuales un resultado (o la foto completa) se considera viejo.
+INTERVALOS_VIGENCIA = 3
+
+
+def _fecha(instante: Optional[float]) -> Optional[str]:
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(instante)) if instante else None
+
+
+def estado_tas() -> List[Dict[str, Any]]:
+    """Vigencia del TA por CUIT y entorno, de los conectores activos de este proceso."""
+    ahora = time.time()
+    vencimientos: Dict[tuple, float] = {}
+    for conector in AfipConnector.activos():
+        if conector.cuit is None or conector.vencimiento_ta is None:
+            continue
+        clave = (str(conector.cuit), "produccion" if conector.is_production else "homologacion")
+        # Con varios puntos de venta, el CUIT sigue operativo mientras uno tenga TA vigente.
+        vencimientos[clave] = max(vencimientos.get(clave, 0.0), conector.vencimiento_ta)
+    return [{
+        "cuit": cuit, "entorno": entorno, "vencimiento": _fecha(vencimiento),
+        "restante": int(vencimiento - ahora),
+        "estado": "vencido" if vencimiento <= ahora else
+                  "por_vencer" if vencimiento - ahora < AFIP_SALUD_TA_MARGEN else "vigente",
+    } for (cuit, entorno), vencimiento in sorted(vencimientos.items())]
+
+
+class Sondeador:
+    def __init__(self, ruta: str, entornos: List[str], intervalo: float = AFIP_SALUD_INTERVALO):
+        desconocidos = [entorno for entorno in entornos if entorno not in ENTORNOS]
+        if desconocidos:
+            raise ValueError(f"Entornos de sondeo desconocidos: {', '.join(desconocidos)}")
+        self.ruta = ruta
+        self.entornos = entornos
+        self.intervalo = intervalo
+        self._local = threading.local()
+        self._clientes: Dict[str, Any] = {}
+        self._foto: Optional[Dict[str, Any]] = None
+        self._hilo: Optional[threading.Thread] = None
+        self._pid_hilo: Optional[int] = None
+        self._lock = threading.Lock()
+        # Conexión descartable, igual que en el outbox: no heredar handles tras el fork.
+        db = sqlite3.connect(self.ruta, timeout=5)
+        try:
+            db.execute("CREATE TABLE IF NOT EXISTS sondeos ("
+                       "entorno TEXT PRIMARY KEY, resultado TEXT, actualizado REAL NOT NULL, tomado_hasta REAL)")
+            db.commit()
+        finally:
+            db.close()
+
+    @contextmanager
+    def _transaccion(self):
+        db = getattr(self._local, "db", None)
+        if db is None or getattr(self._local, "pid", None) != os.getpid():
+            db = sqlite3.connect(self.ruta, timeout=5, isolation_level=None)
+            self._local.db = db
+            self._local.pid = os.getpid()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+
+    # --- AFIP ---
+
+    def _tomar(self, entorno: str) -> Optional[Dict[str, Any]]:
+        """
+        Reserva el sondeo del entorno si el último resultado ya venció y ningún
+        otro worker lo está haciendo. Devuelve el resultado anterior (o {}),
+        o None si no corresponde sondear.
+        """
+        ahora = time.time()
+        with self._transaccion() as db:
+            fila = db.execute("SELECT resultado, actualizado, tomado_hasta FROM sondeos WHERE entorno = ?",
+                              (entorno,)).fetchone()
+            # Margen del 10%: que el ciclo de cada worker no pierda el turno por milisegundos.
+            if fila and (fila[1] + self.intervalo * 0.9 > ahora or (fila[2] or 0) > ahora):
+                return None
+            db.execute("INSERT INTO sondeos (entorno, actualizado, tomado_hasta) VALUES (?, 0, ?) "
+                       "ON CONFLICT (entorno) DO UPDATE SET tomado_hasta = excluded.tomado_hasta",
+                       (entorno, ahora + AFIP_SALUD_TIMEOUT + 5))
+        return json.loads(fila[0]) if fila and fila[0] else {}
+
+    def _fedummy(self, entorno: str) -> Dict[str, Any]:
+        inicio = time.monotonic()
+        try:
+            # El plazo acota cada llamada SOAP del transporte persistente.
+            with plazo(AFIP_SALUD_TIMEOUT):
+                wsfev1 = self._clientes.get(entorno)
+                if wsfev1 is None:
+                    wsfev1 = WSFEv1()
+                    wsfev1.Conectar(wsdl=ENTORNOS[entorno], cache=CACHE)
+                    self._clientes[entorno] = wsfev1
+                wsfev1.Dummy()
+            servidores = {"app": wsfev1.AppServerStatus, "db": wsfev1.DbServerStatus, "auth": wsfev1.AuthServerStatus}
+            ok = all(estado == "OK" for estado in servidores.values())
+            error = None if ok else (getattr(wsfev1, "Excepcion", "") or "FEDummy no informó todos los servidores OK")
+        except Exception as e:
+            # Recrear el cliente en el próximo sondeo.
+            self._clientes.pop(entorno, None)
+            servidores, ok, error = {}, False, f"{type(e).__name__}: {e}"
+        return {"ok": ok, "servidores": servidores, "error": error,
+                "latencia_ms": round((time.monotonic() - inicio) * 1000, 1)}
+
+    def _sondear_entorno(self, entorno: str) -> None:
+        anterior = self._tomar(entorno)
+        if anterior is None:
+            return
+        resultado = self._fedummy(entorno)
+        fallos = 0 if resultado["ok"] else anterior.get("fallos_consecutivos", 0) + 1
+        resultado.update(fallos_consecutivos=fallos, circuito="abierto" if fallos >= AFIP_SALUD_FALLOS_MAX else "cerrado")
+        if resultado["circuito"] != anterior.get("circuito", "cerrado"):
+            logger.warning("Circuito de AFIP %s %s: %s", entorno, resultado["circuito"], resultado["error"] or "FEDummy OK")
+        with self._transaccion() as db:
+            db.execute("UPDATE sondeos SET resultado = ?, actualizado = ?, tomado_hasta = NULL WHERE entorno = ?",
+                       (json.dumps(resultado), time.time(), entorno))
+
+    def _resultados_afip(self) -> Dict[str, Any]:
+        with self._transaccion() as db:
+            filas = db.execute("SELECT entorno, resultado, actualizado FROM sondeos").fetchall()
+        guardados = {entorno: (resultado, actualizado) for entorno, resultado, actualizado in filas}
+        ahora = time.time()
+        afip = {}
+        for entorno in self.entornos:
+            resultado, actualizado = guardados.get(entorno, (None, 0))
+            if not resultado:
+                afip[entorno] = {"ok": False, "circuito": "desconocido", "error": "Sin sondeos todavía"}
+                continue
+            afip[entorno] = {**json.loads(resultado), "sondeado": _fecha(actualizado),
+                             "vigente": ahora - actualizado <= self.intervalo * INTERVALOS_VIGENCIA}
+        return afip
+
+    # --- Foto completa ---
+
+    def sondear(self) -> Dict[str, Any]:
+        """Sondea lo que corresponda y arma la foto que devuelven las sondas."""
+        for entorno in self.entornos:
+            try:
+                self._sondear_entorno(entorno)
+            except Exception as e:
+                logger.warning("No se pudo sondear AFIP %s: %s", entorno, e)
+
+        foto: Dict[str, Any] = {"afip": self._resultados_afip(), "tas": estado_tas()}
+        if gateway_cliente is not None:
+            try:
+                estado_gateway = gateway_cliente.solicitar("estado")
+                foto["gateway"] = {"ok": True}
+                # Si el mismo tenant tiene TA aquí y en el gateway, se informa el más duradero.
+                tas = {(ta["cuit"], ta["entorno"]): ta for ta in estado_gateway.get("tas", [])}
+                for ta in foto["tas"]:
+                    clave = (ta["cuit"], ta["entorno"])
+                    if clave not in tas or ta["restante"] > tas[clave]["restante"]:
+                        tas[clave] = ta
+                foto["tas"] = [tas[clave] for clave in sorted(tas)]
+            except Exception as e:
+                foto["gateway"] = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+        if control_admision is not None:
+            foto["admision"] = control_admision.estado()
+        if AFIP_HTTP_POOL:
+            foto["transporte"] = pool.estado()
+        for nombre, componente in (("outbox", outbox), ("webhooks", webhooks)):
+            if componente is not None:
+                try:
+                    foto[nombre] = componente.estado()
+                except Exception as e:
+                    foto[nombre] = {"error": f"{type(e).__name__}: {e}"}
+
+        avisos = [f"AFIP {entorno}: circuito {resultado['circuito']}" for entorno, resultado in foto["afip"].items()
+                  if resultado["circuito"] != "cerrado"]
+        avisos += [f"AFIP {entorno}: sin sondeo reciente" for entorno, resultado in foto["afip"].items()
+                   if resultado["circuito"] == "cerrado" and not resultado.get("vigente")]
+        motivos = [] if foto.get("gateway", {"ok": True})["ok"] else ["Gateway AFIP sin respuesta"]
+        foto.update(listo=not motivos, motivos=motivos, degradado=bool(avisos), avisos=avisos, generado=time.time())
+        with self._lock:
+            self._foto = foto
+        return foto
+
+    def foto(self) -> Dict[str, Any]:
+        """Última foto, sin sondear nada. Si el sondeo dejó de correr, no está lista."""
+        self.iniciar()
+        with self._lock:
+            foto = self._foto
+        if foto is None:
+            return {"listo": False, "motivos": ["Primer sondeo en curso"], "generado": None}
+        foto = dict(foto)
+        antiguedad = time.time() - foto["generado"]
+        if antiguedad > self.intervalo * INTERVALOS_VIGENCIA:
+            foto.update(listo=False, motivos=foto["motivos"] + [f"Sondeo detenido hace {int(antiguedad)}s"])
+        foto["generado"] = _fecha(foto["generado"])
+        return foto
+
+    # --- Hilo de sondeo ---
+
+    def _ciclo(self) -> None:
+        while True:
+            inicio = time.monotonic()
+            try:
+                self.sondear()
+            except Exception:
+                logger.error("Error inesperado en el sondeo de salud", exc_info=True)
+            time.sleep(max(self.intervalo - (time.monotonic() - inicio), 1.0))
+
+    def iniciar(self) -> None:
+        """Arranca el hilo de sondeo del proceso actual (idempotente, también tras un fork)."""
+        with self._lock:
+            if self._hilo is not None and self._hilo.is_alive() and self._pid_hilo == os.getpid():
+                return
+            self._hilo = threading.Thread(target=self._ciclo, name="afip-salud", daemon=True)
+            self._pid_hilo = os.getpid()
+            self._hilo.start()
+        logger.info("Sondeo de salud iniciado (entornos: %s, cada %ss)", ", ".join(self.entornos), self.intervalo)
+
+
+def _crear_sondeador() -> Optional[Sondeador]:
+    if AFIP_SALUD_INTERVALO <= 0:
+        return None
+    try:
+        entornos = [entorno.strip() for entorno in AFIP_SALUD_ENTORNOS.split(",") if entorno.strip()] \
+            if AFIP_SALUD_FEDUMMY else []
+        return Sondeador(AFIP_SALUD_DB, entornos)
+    except Exception as e:
+        logger.error("No se pudo iniciar el sondeo de salud: %s", e)
+        return None
+
+
+# Instancia única del proceso; None si el sondeo está deshabilitado.
+sondeador = _crear_sondeador()
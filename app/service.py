@@ -39,10 +39,11 @@ def read_file_content(file_path: str, file_type: str) -> str:
     """Lee el contenido de un archivo de forma segura."""
     try:
         content = Path(file_path).read_text()
-        logger.info(f'Contenido del archivo {file_type}:\n{content}')
+        # Nunca loguear el contenido: es material criptográfico.
+        logger.info('Archivo %s leído (%s bytes)', file_type, len(content))
         return content
     except Exception as e:
-        logger.error(f'Error al leer el archivo {file_type}: {e}')
+        logger.error('Error al leer el archivo %s: %s', file_type, e)
         raise RuntimeError(f'Error al leer el archivo {file_type}') from e
 
 def create_app(config: Dict[str, Any] = None) -> Flask:
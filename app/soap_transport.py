@@ -0,0 +1,250 @@
+# app/soap_transport.py
+"""
+Transporte HTTPS con conexiones persistentes para pysimplesoap.
+
+pysimplesoap crea un transporte nuevo en cada `Conectar`, por lo que cada
+reconexión paga un handshake TCP + TLS completo contra WSAA y WSFEv1. Este
+transporte comparte un pool de conexiones keep-alive por host entre todas las
+instancias y reutiliza la sesión TLS al abrir conexiones nuevas.
+"""
+import http.client
+import select
+import socket
+import ssl
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, Optional, Tuple
+from urllib.parse import urlsplit
+
+from pysimplesoap import transport as pss_transport
+
+from app.config import (AFIP_HTTP_POOL_SIZE, AFIP_HTTP_IDLE_TIMEOUT,
+                        AFIP_HTTP_CONNECT_TIMEOUT, AFIP_HTTP_READ_TIMEOUT)
+from app.logger_setup import logger
+from app.plazos import PlazoAgotado, acotar, restante
+
+NOMBRE_TRANSPORTE = "afip_pool"
+
+# Errores que indican que el servidor cerró una conexión ociosa del pool.
+_ERRORES_CONEXION_VENCIDA = (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError)
+# Operaciones SOAP de solo lectura (o prefijos): reenviarlas no tiene efectos en AFIP.
+_OPERACIONES_LECTURA = ("FEDummy", "FECompUltimoAutorizado", "FECompConsultar", "FECompTotXRequest", "FEParamGet")
+
+
+def _es_reenviable(method: str, headers: Optional[Dict[str, str]]) -> bool:
+    """
+    GET (WSDL) y operaciones de consulta. FECAESolicitar o loginCms no: si
+    AFIP llegó a leer el pedido, reenviarlo duplicaría el comprobante o el TA.
+    """
+    if method.upper() == "GET":
+        return True
+    accion = next((v for k, v in (headers or {}).items() if k.lower() == "soapaction"), "")
+    return accion.strip('"').rsplit("/", 1)[-1].startswith(_OPERACIONES_LECTURA)
+
+
+def _conexion_caida(conexion: http.client.HTTPConnection) -> bool:
+    """Una conexión ociosa con datos para leer (o EOF) fue cerrada por el servidor."""
+    if conexion.sock is None:
+        return True
+    try:
+        legibles, _, _ = select.select([conexion.sock], [], [], 0)
+    except (OSError, ValueError):
+        return True
+    return bool(legibles)
+
+
+def crear_contexto_ssl(cacert: Optional[str] = None) -> ssl.SSLContext:
+    """
+    Contexto TLSv1.2 para AFIP. Sin `cacert` no se valida el certificado del
+    servidor, igual que el transporte httplib2 de pysimplesoap.
+    """
+    context = ssl.create_default_context(cafile=cacert)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.maximum_version = ssl.TLSVersion.TLSv1_2
+    if cacert is None:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+class _ConexionHTTPS(http.client.HTTPSConnection):
+    """HTTPSConnection con timeouts de conexión/lectura separados y reanudación TLS."""
+
+    def __init__(self, host, port, context, connect_timeout, read_timeout, pool):
+        super().__init__(host, port, timeout=connect_timeout, context=context)
+        self.read_timeout = read_timeout
+        self.pool = pool
+        self.ultimo_uso = time.monotonic()
+
+    def connect(self):
+        sock = socket.create_connection((self.host, self.port), self.timeout, self.source_address)
+        sock.settimeout(self.read_timeout)
+        clave = (self.host, self.port)
+        sesion = self.pool.sesion_tls(clave)
+        self.sock = self._context.wrap_socket(sock, server_hostname=self.host, session=sesion)
+        if self.sock.session_reused:
+            logger.debug("Sesión TLS reutilizada con %s", self.host)
+        self.pool.guardar_sesion_tls(clave, self.sock.session)
+
+
+class PoolConexiones:
+    """Conexiones ociosas por (host, puerto), compartidas entre transportes."""
+
+    def __init__(self, tamano: int = AFIP_HTTP_POOL_SIZE, idle_timeout: float = AFIP_HTTP_IDLE_TIMEOUT):
+        self.tamano = tamano
+        self.idle_timeout = idle_timeout
+        self._ociosas: Dict[Tuple[str, int], deque] = {}
+        self._sesiones: Dict[Tuple[str, int], ssl.SSLSession] = {}
+        self._lock = threading.Lock()
+
+    def sesion_tls(self, clave):
+        with self._lock:
+            return self._sesiones.get(clave)
+
+    def guardar_sesion_tls(self, clave, sesion):
+        if sesion is not None:
+            with self._lock:
+                self._sesiones[clave] = sesion
+
+    def obtener(self, clave) -> Optional[_ConexionHTTPS]:
+        ahora = time.monotonic()
+        vencidas = []
+        conexion = None
+        with self._lock:
+            ociosas = self._ociosas.get(clave)
+            while ociosas:
+                candidata = ociosas.pop()
+                if ahora - candidata.ultimo_uso <= self.idle_timeout:
+                    conexion = candidata
+                    break
+                vencidas.append(candidata)
+        for vencida in vencidas:
+            vencida.close()
+        return conexion
+
+    def devolver(self, clave, conexion: _ConexionHTTPS) -> None:
+        conexion.ultimo_uso = time.monotonic()
+        with self._lock:
+            ociosas = self._ociosas.setdefault(clave, deque())
+            if len(ociosas) < self.tamano:
+                ociosas.append(conexion)
+                return
+        conexion.close()
+
+    def estado(self) -> Dict[str, Any]:
+        """Conexiones ociosas por host frente al máximo por host."""
+        with self._lock:
+            ociosas = {f"{host}:{puerto}": len(cola) for (host, puerto), cola in self._ociosas.items()}
+        return {"tamano": self.tamano, "ociosas": ociosas}
+
+    def cerrar_todas(self) -> None:
+        with self._lock:
+            ociosas = [c for cola in self._ociosas.values() for c in cola]
+            self._ociosas.clear()
+        for conexion in ociosas:
+            conexion.close()
+
+
+class _Respuesta(dict):
+    """Cabeceras de la respuesta con `status`, como la Response de httplib2."""
+
+    def __init__(self, respuesta: http.client.HTTPResponse):
+        super().__init__((k.lower(), v) for k, v in respuesta.getheaders())
+        self.status = respuesta.status
+        self["status"] = str(respuesta.status)
+
+
+class PooledHTTPSTransport(pss_transport.TransportBase):
+    """Transporte de pysimplesoap respaldado por el pool compartido."""
+    _wrapper_version = "afip_pool (http.client keep-alive)"
+    _wrapper_name = NOMBRE_TRANSPORTE
+
+    _contextos: Dict[Optional[str], ssl.SSLContext] = {}
+
+    def __init__(self, timeout=None, proxy=None, cacert=None, sessions=False):
+        if proxy:
+            raise RuntimeError("proxy is not supported with afip_pool transport")
+        self.connect_timeout = AFIP_HTTP_CONNECT_TIMEOUT
+        self.read_timeout = AFIP_HTTP_READ_TIMEOUT or timeout
+        if cacert not in self._contextos:
+            self._contextos[cacert] = crear_contexto_ssl(cacert)
+        self.context = self._contextos[cacert]
+
+    def _nueva_conexion(self, host, port, read_timeout) -> _ConexionHTTPS:
+        return _ConexionHTTPS(host, port, self.context, acotar(self.connect_timeout), read_timeout, pool)
+
+    @staticmethod
+    def _verificar_plazo(error: Exception, host: str) -> None:
+        """Un timeout causado por el plazo de la solicitud se informa como `PlazoAgotado`."""
+        segundos = restante()
+        if isinstance(error, socket.timeout) and segundos is not None and segundos <= 0:
+            raise PlazoAgotado(f"Plazo de la solicitud agotado esperando a {host}") from error
+
+    def request(self, url, method="GET", body=None, headers=None):
+        partes = urlsplit(url)
+        if partes.scheme != "https":
+            raise RuntimeError(f"afip_pool transport only supports https URLs: {url}")
+        host, port = partes.hostname, partes.port or 443
+        ruta = partes.path + (f"?{partes.query}" if partes.query else "")
+        clave = (host, port)
+        # Cada llamada espera a lo sumo lo que le queda al plazo de la solicitud.
+        read_timeout = acotar(self.read_timeout, f"la llamada a {host}")
+
+        conexion = pool.obtener(clave)
+        while conexion is not None and _conexion_caida(conexion):
+            # Cerrada por el servidor mientras estaba ociosa: se descarta antes de enviar nada.
+            conexion.close()
+            conexion = pool.obtener(clave)
+        reutilizada = conexion is not None
+        if conexion is None:
+            conexion = self._nueva_conexion(host, port, read_timeout)
+        else:
+            conexion.sock.settimeout(read_timeout)
+
+        try:
+            conexion.request(method, ruta, body=body, headers=headers or {})
+            respuesta = conexion.getresponse()
+        except _ERRORES_CONEXION_VENCIDA:
+            conexion.close()
+            # No se sabe si AFIP leyó el pedido: solo se reenvían las consultas.
+            if not reutilizada or not _es_reenviable(method, headers):
+                raise
+            logger.debug("Conexión persistente con %s cerrada por el servidor; reabriendo", host)
+            conexion = self._nueva_conexion(host, port, read_timeout)
+            conexion.request(method, ruta, body=body, headers=headers or {})
+            respuesta = conexion.getresponse()
+        except Exception as e:
+            conexion.close()
+            self._verificar_plazo(e, host)
+            raise
+
+        try:
+            contenido = respuesta.read()
+        except Exception as e:
+            conexion.close()
+            self._verificar_plazo(e, host)
+            raise
+        if respuesta.will_close:
+            conexion.close()
+        else:
+            pool.devolver(clave, conexion)
+        return _Respuesta(respuesta), contenido
+
+    def close(self):
+        # Las conexiones pertenecen al pool compartido, no al transporte.
+        pass
+
+
+# Pool único del proceso (o del gateway AFIP cuando está habilitado).
+pool = PoolConexiones()
+
+
+def instalar_transporte() -> None:
+    """Registra el transporte y lo deja como predeterminado de pysimplesoap."""
+    pss_transport._http_connectors[NOMBRE_TRANSPORTE] = PooledHTTPSTransport
+    for facilidad in ("cacert", "timeout"):
+        pss_transport._http_facilities.setdefault(facilidad, []).append(NOMBRE_TRANSPORTE)
+    pss_transport.set_http_wrapper(NOMBRE_TRANSPORTE)
+    logger.info(f"Transporte SOAP con conexiones persistentes habilitado "
+                f"(pool={AFIP_HTTP_POOL_SIZE}, idle={AFIP_HTTP_IDLE_TIMEOUT}s)")
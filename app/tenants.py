@@ -0,0 +1,294 @@
+# app/tenants.py
+"""
+Registro de credenciales AFIP por tenant.
+
+Las credenciales se suben una vez por el endpoint de administración y se
+guardan cifradas (Fernet) en SQLite. Las solicitudes de emisión pueden
+entonces referenciar al tenant por `tenant_id` o por `cuit` en lugar de
+enviar certificado y clave privada en cada payload, acompañados de la
+`api_key` que se entrega al registrarlo: el CUIT es público y no alcanza
+para emitir en nombre del tenant. De la api_key solo se guarda su SHA-256.
+Cada CUIT pertenece a un único tenant, así referenciarlo por CUIT siempre
+resuelve al mismo.
+
+El certificado y la clave se validan al registrarlos; al emitir solo se
+descifran la primera vez que un proceso los necesita y quedan en memoria
+durante AFIP_REGISTRO_CACHE_TTL segundos.
+"""
+import datetime
+import hashlib
+import hmac
+import secrets
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from cryptography import x509
+from cryptography.fernet import Fernet
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.serialization import load_pem_private_key
+
+from app.config import AFIP_REGISTRO_CLAVE, AFIP_REGISTRO_DB, AFIP_REGISTRO_CACHE_TTL
+from app.logger_setup import logger
+
+# Días antes del vencimiento del certificado a partir de los cuales se advierte.
+DIAS_AVISO_VENCIMIENTO = 30
+
+
+class CredencialesTenant(dict):
+    """Credenciales resueltas desde el registro; ya validadas al registrarse."""
+
+
+class AccesoDenegado(Exception):
+    """La solicitud referencia un tenant registrado sin su api_key o con una inválida."""
+
+
+def _hash_api_key(api_key: str) -> str:
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+
+
+class RegistroTenants:
+    def __init__(self, ruta: str, clave: str):
+        self.ruta = ruta
+        self._fernet = Fernet(clave.encode("utf-8"))
+        self._cache: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+        with self._conexion() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS tenants ("
+                       "tenant_id TEXT PRIMARY KEY, cuit TEXT NOT NULL, "
+                       "certificado BLOB NOT NULL, clave_privada BLOB NOT NULL, "
+                       "vencimiento_certificado TEXT, actualizado REAL NOT NULL)")
+            try:
+                db.execute("CREATE UNIQUE INDEX IF NOT EXISTS tenants_cuit_unico ON tenants (cuit)")
+                db.execute("DROP INDEX IF EXISTS tenants_cuit")
+            except sqlite3.IntegrityError:
+                # Registro previo con un CUIT en varios tenants: se los referencia por tenant_id.
+                logger.warning("Hay CUIT registrados en más de un tenant; referenciarlos por tenant_id")
+                db.execute("CREATE INDEX IF NOT EXISTS tenants_cuit ON tenants (cuit)")
+            if "api_key_hash" not in {fila[1] for fila in db.execute("PRAGMA table_info(tenants)")}:
+                # Registros previos a la api_key: no se pueden referenciar hasta generar una.
+                db.execute("ALTER TABLE tenants ADD COLUMN api_key_hash TEXT")
+
+    def _conexion(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.ruta, timeout=5)
+
+    @staticmethod
+    def _validar(certificado: str, clave_privada: str) -> datetime.datetime:
+        try:
+            load_pem_private_key(clave_privada.encode("utf-8"), password=None, backend=default_backend())
+        except Exception:
+            raise ValueError("Clave privada en formato PEM inválida o no soportada")
+        try:
+            cert = x509.load_pem_x509_certificate(certificado.encode("utf-8"), default_backend())
+        except Exception:
+            raise ValueError("Certificado X.509 en formato PEM inválido")
+        return getattr(cert, "not_valid_after_utc", None) or cert.not_valid_after
+
+    def registrar(self, cuit: str, certificado: str, clave_privada: str,
+                  tenant_id: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Valida, cifra y guarda las credenciales de un tenant (alta o reemplazo).
+        En el alta (o si el tenant aún no tenía) genera su api_key y la
+        devuelve en `api_key`, la única vez que se informa; al reemplazar el
+        certificado se conserva la api_key vigente. Un CUIT ya registrado en
+        otro tenant se rechaza con ValueError.
+        """
+        if not cuit:
+            raise ValueError("El CUIT es obligatorio")
+        if not certificado or not clave_privada:
+            raise ValueError("Certificado o clave privada no proporcionados.")
+        tenant_id = tenant_id or cuit
+        vencimiento = self._validar(certificado, clave_privada)
+        api_key = None
+        with self._conexion() as db:
+            db.execute("BEGIN IMMEDIATE")
+            otro = db.execute("SELECT tenant_id FROM tenants WHERE cuit = ? AND tenant_id != ?",
+                              (cuit, tenant_id)).fetchone()
+            if otro:
+                raise ValueError(f"El CUIT {cuit} ya está registrado en el tenant {otro[0]}")
+            anterior = db.execute("SELECT cuit, api_key_hash FROM tenants WHERE tenant_id = ?", (tenant_id,)).fetchone()
+            api_key_hash = anterior[1] if anterior else None
+            if not api_key_hash:
+                api_key = secrets.token_urlsafe(32)
+                api_key_hash = _hash_api_key(api_key)
+            db.execute("INSERT OR REPLACE INTO tenants (tenant_id, cuit, certificado, clave_privada, "
+                       "vencimiento_certificado, actualizado, api_key_hash) VALUES (?, ?, ?, ?, ?, ?, ?)", (
+                           tenant_id, cuit,
+                           self._fernet.encrypt(certificado.encode("utf-8")),
+                           self._fernet.encrypt(clave_privada.encode("utf-8")),
+                           vencimiento.strftime("%Y-%m-%d"), time.time(), api_key_hash))
+        self._invalidar(tenant_id, cuit, anterior[0] if anterior else None)
+        logger.info("Credenciales registradas para tenant %s (CUIT %s, vence %s)",
+                    tenant_id, cuit, vencimiento.date())
+        tenant = self.describir(tenant_id)
+        if api_key:
+            tenant["api_key"] = api_key
+        return tenant
+
+    def regenerar_api_key(self, tenant_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Reemplaza la api_key del tenant y la devuelve en `api_key`. Este
+        proceso deja de aceptar la anterior de inmediato; los demás, al
+        vencer su caché (AFIP_REGISTRO_CACHE_TTL).
+        """
+        api_key = secrets.token_urlsafe(32)
+        with self._conexion() as db:
+            fila = db.execute("SELECT cuit FROM tenants WHERE tenant_id = ?", (tenant_id,)).fetchone()
+            if fila is None:
+                return None
+            db.execute("UPDATE tenants SET api_key_hash = ?, actualizado = ? WHERE tenant_id = ?",
+                       (_hash_api_key(api_key), time.time(), tenant_id))
+        self._invalidar(tenant_id, fila[0])
+        logger.info("Api key regenerada para tenant %s", tenant_id)
+        tenant = self.describir(tenant_id)
+        tenant["api_key"] = api_key
+        return tenant
+
+    def _invalidar(self, tenant_id: str, *cuits: Optional[str]) -> None:
+        # La caché se indexa por tenant_id o por CUIT según cómo se haya consultado.
+        with self._lock:
+            for clave in (tenant_id, *cuits):
+                if clave:
+                    self._cache.pop(clave, None)
+
+    def cifrar(self, texto: str) -> bytes:
+        return self._fernet.encrypt(texto.encode("utf-8"))
+
+    def descifrar(self, dato: bytes) -> str:
+        return self._fernet.decrypt(dato).decode("utf-8")
+
+    def eliminar(self, tenant_id: str) -> bool:
+        with self._conexion() as db:
+            fila = db.execute("SELECT cuit FROM tenants WHERE tenant_id = ?", (tenant_id,)).fetchone()
+            borrados = db.execute("DELETE FROM tenants WHERE tenant_id = ?", (tenant_id,)).rowcount
+        self._invalidar(tenant_id, fila[0] if fila else None)
+        return borrados > 0
+
+    @staticmethod
+    def _metadatos(fila) -> Dict[str, Any]:
+        tenant_id, cuit, vencimiento, actualizado = fila
+        dias = None
+        if vencimiento:
+            dias = (datetime.date.fromisoformat(vencimiento) - datetime.date.today()).days
+        return {
+            "tenant_id": tenant_id,
+            "cuit": cuit,
+            "vencimiento_certificado": vencimiento,
+            "dias_para_vencimiento": dias,
+            "actualizado": datetime.datetime.fromtimestamp(actualizado).isoformat(timespec="seconds"),
+        }
+
+    def describir(self, tenant_id: str) -> Optional[Dict[str, Any]]:
+        with self._conexion() as db:
+            fila = db.execute("SELECT tenant_id, cuit, vencimiento_certificado, actualizado "
+                              "FROM tenants WHERE tenant_id = ?", (tenant_id,)).fetchone()
+        return self._metadatos(fila) if fila else None
+
+    def listar(self) -> List[Dict[str, Any]]:
+        with self._conexion() as db:
+            filas = db.execute("SELECT tenant_id, cuit, vencimiento_certificado, actualizado "
+                               "FROM tenants ORDER BY tenant_id").fetchall()
+        return [self._metadatos(fila) for fila in filas]
+
+    @staticmethod
+    def _verificar_api_key(tenant_id: str, api_key_hash: Optional[str], api_key: Optional[str]) -> None:
+        if not api_key:
+            raise AccesoDenegado(f"Falta la api_key del tenant {tenant_id}")
+        if not api_key_hash:
+            raise AccesoDenegado(f"El tenant {tenant_id} no tiene api_key; genérela en /tenants/{tenant_id}/api-key")
+        if not hmac.compare_digest(api_key_hash, _hash_api_key(api_key)):
+            raise AccesoDenegado(f"Api key inválida para el tenant {tenant_id}")
+
+    def verificar_api_key(self, tenant_id: str, api_key: Optional[str]) -> None:
+        """Lanza `AccesoDenegado` si `api_key` no es la del tenant o el tenant ya no existe."""
+        with self._conexion() as db:
+            fila = db.execute("SELECT api_key_hash FROM tenants WHERE tenant_id = ?", (tenant_id,)).fetchone()
+        if fila is None:
+            raise AccesoDenegado(f"El tenant {tenant_id} no está registrado")
+        self._verificar_api_key(tenant_id, fila[0], api_key)
+
+    def verificar_api_key_de_cuit(self, cuit: str, api_key: Optional[str]) -> None:
+        """Lanza `AccesoDenegado` salvo que `api_key` sea la del tenant registrado con `cuit`."""
+        with self._conexion() as db:
+            filas = db.execute("SELECT api_key_hash FROM tenants WHERE cuit = ?", (cuit,)).fetchall()
+        if api_key and any(api_key_hash and hmac.compare_digest(api_key_hash, _hash_api_key(api_key))
+                           for api_key_hash, in filas):
+            return
+        raise AccesoDenegado(f"Se requiere la api_key del tenant de CUIT {cuit} o el token de administración")
+
+    def obtener(self, tenant_id: Optional[str] = None, cuit: Optional[str] = None,
+                api_key: Optional[str] = None) -> CredencialesTenant:
+        """
+        Devuelve las credenciales descifradas del tenant (por id o por CUIT)
+        si `api_key` es la suya; si no, lanza `AccesoDenegado`.
+        """
+        clave = tenant_id or cuit
+        ahora = time.monotonic()
+        with self._lock:
+            entrada = self._cache.get(clave)
+        if entrada and ahora - entrada[0] < AFIP_REGISTRO_CACHE_TTL:
+            self._verificar_api_key(entrada[1]["tenant_id"], entrada[2], api_key)
+            return entrada[1]
+
+        with self._conexion() as db:
+            columnas = "tenant_id, cuit, certificado, clave_privada, vencimiento_certificado, api_key_hash"
+            if tenant_id:
+                fila = db.execute(f"SELECT {columnas} FROM tenants WHERE tenant_id = ?", (tenant_id,)).fetchone()
+            else:
+                filas = db.execute(f"SELECT {columnas} FROM tenants WHERE cuit = ? LIMIT 2", (cuit,)).fetchall()
+                if len(filas) > 1:
+                    raise ValueError(f"El CUIT {cuit} está registrado en varios tenants; indicar tenant_id")
+                fila = filas[0] if filas else None
+        if fila is None:
+            raise ValueError(f"No hay credenciales registradas para el tenant {clave}")
+
+        tenant_id, cuit, certificado, clave_privada, vencimiento, api_key_hash = fila
+        self._verificar_api_key(tenant_id, api_key_hash, api_key)
+        if vencimiento:
+            dias = (datetime.date.fromisoformat(vencimiento) - datetime.date.today()).days
+            if dias < 0:
+                raise ValueError(f"El certificado del tenant {tenant_id} venció el {vencimiento}")
+            if dias <= DIAS_AVISO_VENCIMIENTO:
+                logger.warning("El certificado del tenant %s vence en %s días (%s)", tenant_id, dias, vencimiento)
+
+        credenciales = CredencialesTenant(
+            tenant_id=tenant_id,
+            cuit=cuit,
+            certificado=self._fernet.decrypt(certificado).decode("utf-8"),
+            clave_privada=self._fernet.decrypt(clave_privada).decode("utf-8"),
+        )
+        with self._lock:
+            self._cache[clave] = (ahora, credenciales, api_key_hash)
+        return credenciales
+
+
+def resolver_credenciales(credenciales: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Completa las credenciales de una solicitud. Si traen certificado y clave
+    en línea se usan tal cual; si no, se buscan en el registro por
+    `tenant_id` o `cuit` y se exige la `api_key` del tenant.
+    """
+    if credenciales.get("certificado") and credenciales.get("clave_privada"):
+        return credenciales
+    tenant_id, cuit = credenciales.get("tenant_id"), credenciales.get("cuit")
+    if not (tenant_id or cuit):
+        raise ValueError("Las credenciales deben incluir certificado y clave privada, o un tenant_id/cuit registrado")
+    if registro_tenants is None:
+        raise ValueError("Certificado o clave privada no proporcionados y el registro de credenciales no está configurado")
+    return registro_tenants.obtener(tenant_id=tenant_id, cuit=None if tenant_id else cuit,
+                                    api_key=credenciales.get("api_key"))
+
+
+def _crear_registro() -> Optional[RegistroTenants]:
+    if not AFIP_REGISTRO_CLAVE:
+        return None
+    try:
+        return RegistroTenants(AFIP_REGISTRO_DB, AFIP_REGISTRO_CLAVE)
+    except Exception as e:
+        logger.error("No se pudo iniciar el registro de credenciales: %s", e)
+        return None
+
+
+# Instancia única del proceso; None si no hay clave de cifrado configurada.
+registro_tenants = _crear_registro()
@@ -0,0 +1,299 @@
+# app/webhooks.py
+"""
+Entrega por webhook de los resultados de emisión.
+
+Cada CUIT puede registrar una URL; los resultados de los comprobantes que se
+emiten en segundo plano (outbox) se guardan como eventos en SQLite y un
+despachador por proceso los envía:
+
+- agrupados por destino, hasta AFIP_WEBHOOK_LOTE_MAX eventos por POST;
+- con un pool acotado de AFIP_WEBHOOK_HILOS hilos y conexiones keep-alive
+  (una `requests.Session` por hilo), sin un hilo por entrega;
+- firmados: `X-Afip-Firma: t=<timestamp>,v1=<hex>` con el HMAC-SHA256 del
+  texto `"<timestamp>.<cuerpo>"` usando el secreto del destino;
+- con reintentos y backoff exponencial; tras AFIP_WEBHOOK_INTENTOS_MAX
+  intentos el evento queda "fallido" (dead-letter) hasta que se reintente
+  manualmente.
+
+La entrega es "al menos una vez": el receptor debe descartar eventos
+repetidos por su `id`.
+"""
+import hashlib
+import hmac
+import json
+import os
+import random
+import secrets
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from app.config import (AFIP_WEBHOOK_HABILITADO, AFIP_WEBHOOK_DB, AFIP_WEBHOOK_HILOS,
+                        AFIP_WEBHOOK_LOTE_MAX, AFIP_WEBHOOK_TIMEOUT, AFIP_WEBHOOK_INTENTOS_MAX,
+                        AFIP_WEBHOOK_BACKOFF_MAX)
+from app.logger_setup import logger
+
+PENDIENTE = "pendiente"
+ENVIANDO = "enviando"
+ENTREGADO = "entregado"
+FALLIDO = "fallido"
+
+CABECERA_FIRMA = "X-Afip-Firma"
+# Segundos que un despachador retiene un lote antes de que otro pueda reenviarlo.
+DURACION_TOMA = 120
+# Segundos que se conserva en memoria la URL y el secreto de cada destino.
+TTL_DESTINOS = 60
+
+
+def firmar(secreto: str, timestamp: int, cuerpo: bytes) -> str:
+    """Valor de la cabecera X-Afip-Firma para `cuerpo`."""
+    mensaje = str(timestamp).encode("utf-8") + b"." + cuerpo
+    return f"t={timestamp},v1={hmac.new(secreto.encode('utf-8'), mensaje, hashlib.sha256).hexdigest()}"
+
+
+class Webhooks:
+    def __init__(self, ruta: str):
+        self.ruta = ruta
+        self._local = threading.local()
+        self._hay_trabajo = threading.Event()
+        self._destinos: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+        self._hilo: Optional[threading.Thread] = None
+        self._pid_hilo: Optional[int] = None
+        db = sqlite3.connect(self.ruta, timeout=5)
+        try:
+            db.execute("CREATE TABLE IF NOT EXISTS destinos ("
+                       "cuit TEXT PRIMARY KEY, url TEXT NOT NULL, secreto TEXT NOT NULL, actualizado REAL NOT NULL)")
+            db.execute("CREATE TABLE IF NOT EXISTS eventos ("
+                       "id INTEGER PRIMARY KEY AUTOINCREMENT, cuit TEXT NOT NULL, tipo TEXT NOT NULL, "
+                       "datos TEXT NOT NULL, estado TEXT NOT NULL, intentos INTEGER NOT NULL DEFAULT 0, "
+                       "proximo_intento REAL NOT NULL, tomado_hasta REAL, error TEXT, "
+                       "creado REAL NOT NULL, actualizado REAL NOT NULL)")
+            db.execute("CREATE INDEX IF NOT EXISTS eventos_estado ON eventos (estado, proximo_intento)")
+            db.commit()
+        finally:
+            db.close()
+
+    @contextmanager
+    def _transaccion(self):
+        db = getattr(self._local, "db", None)
+        if db is None or getattr(self._local, "pid", None) != os.getpid():
+            db = sqlite3.connect(self.ruta, timeout=5, isolation_level=None)
+            self._local.db = db
+            self._local.pid = os.getpid()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+
+    # --- Destinos ---
+
+    def registrar_destino(self, cuit: str, url: str, secreto: Optional[str] = None) -> Dict[str, Any]:
+        """Registra o reemplaza la URL del CUIT. Sin secreto se genera uno."""
+        if not cuit:
+            raise ValueError("El CUIT es obligatorio")
+        if not url or not url.startswith(("https://", "http://")):
+            raise ValueError("La URL del webhook debe comenzar con http:// o https://")
+        secreto = secreto or secrets.token_hex(32)
+        with self._transaccion() as db:
+            db.execute("INSERT OR REPLACE INTO destinos VALUES (?, ?, ?, ?)", (cuit, url, secreto, time.time()))
+        with self._lock:
+            self._destinos.pop(cuit, None)
+        logger.info("Webhook registrado para CUIT %s: %s", cuit, url)
+        return {"cuit": cuit, "url": url, "secreto": secreto}
+
+    def eliminar_destino(self, cuit: str) -> bool:
+        with self._transaccion() as db:
+            borrados = db.execute("DELETE FROM destinos WHERE cuit = ?", (cuit,)).rowcount
+        with self._lock:
+            self._destinos.pop(cuit, None)
+        return borrados > 0
+
+    def destino(self, cuit: str) -> Optional[Dict[str, Any]]:
+        ahora = time.monotonic()
+        with self._lock:
+            entrada = self._destinos.get(cuit)
+            if entrada and ahora - entrada[0] < TTL_DESTINOS:
+                return entrada[1]
+        with self._transaccion() as db:
+            fila = db.execute("SELECT url, secreto FROM destinos WHERE cuit = ?", (cuit,)).fetchone()
+        destino = {"cuit": cuit, "url": fila[0], "secreto": fila[1]} if fila else None
+        with self._lock:
+            self._destinos[cuit] = (ahora, destino)
+        return destino
+
+    # --- Eventos ---
+
+    def notificar(self, cuit: str, tipo: str, datos: Dict[str, Any]) -> Optional[int]:
+        """Encola un evento para el webhook del CUIT; no hace nada si no tiene uno registrado."""
+        if not cuit or self.destino(cuit) is None:
+            return None
+        ahora = time.time()
+        with self._transaccion() as db:
+            id_evento = db.execute(
+                "INSERT INTO eventos (cuit, tipo, datos, estado, proximo_intento, creado, actualizado) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (cuit, tipo, json.dumps(datos), PENDIENTE, ahora, ahora, ahora)).lastrowid
+        self.iniciar_despachador()
+        self._hay_trabajo.set()
+        return id_evento
+
+    def estado(self) -> Dict[str, int]:
+        """Eventos sin entregar por estado."""
+        with self._transaccion() as db:
+            por_estado = dict(db.execute("SELECT estado, COUNT(*) FROM eventos WHERE estado IN (?, ?, ?) GROUP BY estado",
+                                         (PENDIENTE, ENVIANDO, FALLIDO)).fetchall())
+        return {estado: por_estado.get(estado, 0) for estado in (PENDIENTE, ENVIANDO, FALLIDO)}
+
+    def fallidos(self, cuit: Optional[str] = None, limite: int = 100) -> List[Dict[str, Any]]:
+        consulta = "SELECT id, cuit, tipo, intentos, error, creado, actualizado FROM eventos WHERE estado = ?"
+        parametros: list = [FALLIDO]
+        if cuit:
+            consulta += " AND cuit = ?"
+            parametros.append(cuit)
+        with self._transaccion() as db:
+            filas = db.execute(consulta + " ORDER BY id LIMIT ?", (*parametros, limite)).fetchall()
+        return [{
+            "id": id_evento, "cuit": cuit_evento, "tipo": tipo, "intentos": intentos, "error": error,
+            "creado": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(creado)),
+            "actualizado": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(actualizado)),
+        } for id_evento, cuit_evento, tipo, intentos, error, creado, actualizado in filas]
+
+    def reintentar_fallidos(self, cuit: Optional[str] = None) -> int:
+        """Devuelve los eventos fallidos a la cola con los intentos en cero."""
+        consulta = "UPDATE eventos SET estado = ?, intentos = 0, proximo_intento = ?, actualizado = ? WHERE estado = ?"
+        ahora = time.time()
+        parametros: list = [PENDIENTE, ahora, ahora, FALLIDO]
+        if cuit:
+            consulta += " AND cuit = ?"
+            parametros.append(cuit)
+        with self._transaccion() as db:
+            cantidad = db.execute(consulta, parametros).rowcount
+        if cantidad:
+            self.iniciar_despachador()
+            self._hay_trabajo.set()
+        return cantidad
+
+    # --- Despacho ---
+
+    def _tomar_lotes(self) -> List[List[tuple]]:
+        """Toma eventos listos y los agrupa en lotes por CUIT."""
+        ahora = time.time()
+        with self._transaccion() as db:
+            db.execute("UPDATE eventos SET estado = ?, tomado_hasta = NULL WHERE estado = ? AND tomado_hasta < ?",
+                       (PENDIENTE, ENVIANDO, ahora))
+            filas = db.execute("SELECT id, cuit, tipo, datos, intentos, creado FROM eventos "
+                               "WHERE estado = ? AND proximo_intento <= ? ORDER BY id LIMIT ?",
+                               (PENDIENTE, ahora, AFIP_WEBHOOK_HILOS * AFIP_WEBHOOK_LOTE_MAX)).fetchall()
+            if filas:
+                db.executemany("UPDATE eventos SET estado = ?, tomado_hasta = ? WHERE id = ?",
+                               [(ENVIANDO, ahora + DURACION_TOMA, fila[0]) for fila in filas])
+        por_cuit: Dict[str, List[tuple]] = {}
+        for fila in filas:
+            por_cuit.setdefault(fila[1], []).append(fila)
+        return [eventos[i:i + AFIP_WEBHOOK_LOTE_MAX]
+                for eventos in por_cuit.values()
+                for i in range(0, len(eventos), AFIP_WEBHOOK_LOTE_MAX)]
+
+    def _sesion(self) -> requests.Session:
+        sesion = getattr(self._local, "sesion", None)
+        if sesion is None:
+            # Una sesión por hilo del pool: cada hilo reutiliza sus conexiones por host.
+            sesion = requests.Session()
+            adaptador = HTTPAdapter(pool_connections=16, pool_maxsize=1)
+            sesion.mount("https://", adaptador)
+            sesion.mount("http://", adaptador)
+            self._local.sesion = sesion
+        return sesion
+
+    def _enviar_lote(self, lote: List[tuple]) -> None:
+        cuit = lote[0][1]
+        ids = [fila[0] for fila in lote]
+        error = None
+        destino = self.destino(cuit)
+        if destino is None:
+            error = "El CUIT ya no tiene webhook registrado"
+        else:
+            cuerpo = json.dumps({"eventos": [{
+                "id": id_evento,
+                "tipo": tipo,
+                "cuit": cuit,
+                "creado": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(creado)),
+                "datos": json.loads(datos),
+            } for id_evento, _, tipo, datos, _, creado in lote]}).encode("utf-8")
+            timestamp = int(time.time())
+            try:
+                respuesta = self._sesion().post(destino["url"], data=cuerpo, timeout=AFIP_WEBHOOK_TIMEOUT, headers={
+                    "Content-Type": "application/json",
+                    CABECERA_FIRMA: firmar(destino["secreto"], timestamp, cuerpo),
+                })
+                if not 200 <= respuesta.status_code < 300:
+                    error = f"HTTP {respuesta.status_code}"
+            except requests.RequestException as e:
+                error = f"{type(e).__name__}: {e}"
+
+        ahora = time.time()
+        with self._transaccion() as db:
+            if error is None:
+                db.execute(f"UPDATE eventos SET estado = ?, intentos = intentos + 1, error = NULL, tomado_hasta = NULL, "
+                           f"actualizado = ? WHERE id IN ({','.join('?' * len(ids))})", (ENTREGADO, ahora, *ids))
+                return
+            for id_evento, _, _, _, intentos, _ in lote:
+                intentos += 1
+                if intentos >= AFIP_WEBHOOK_INTENTOS_MAX:
+                    estado, proximo = FALLIDO, ahora
+                else:
+                    estado = PENDIENTE
+                    espera = min(AFIP_WEBHOOK_BACKOFF_MAX, 2 ** intentos)
+                    proximo = ahora + espera * random.uniform(0.8, 1.2)
+                db.execute("UPDATE eventos SET estado = ?, intentos = ?, proximo_intento = ?, error = ?, "
+                           "tomado_hasta = NULL, actualizado = ? WHERE id = ?",
+                           (estado, intentos, proximo, error, ahora, id_evento))
+        logger.warning("Entrega de webhook a CUIT %s falló (%s eventos): %s", cuit, len(ids), error)
+
+    def _despachar(self) -> None:
+        with ThreadPoolExecutor(max_workers=AFIP_WEBHOOK_HILOS, thread_name_prefix="afip-webhook") as pool:
+            while True:
+                self._hay_trabajo.clear()
+                try:
+                    lotes = self._tomar_lotes()
+                except Exception as e:
+                    logger.error("Error tomando eventos de webhook: %s", e, exc_info=True)
+                    lotes = []
+                if lotes:
+                    wait([pool.submit(self._enviar_lote, lote) for lote in lotes])
+                else:
+                    self._hay_trabajo.wait(1.0)
+
+    def iniciar_despachador(self) -> None:
+        """Arranca el hilo despachador de este proceso (idempotente, seguro tras un fork)."""
+        with self._lock:
+            if self._hilo is not None and self._pid_hilo == os.getpid() and self._hilo.is_alive():
+                return
+            self._hilo = threading.Thread(target=self._despachar, name="afip-webhooks", daemon=True)
+            self._pid_hilo = os.getpid()
+            self._hilo.start()
+        logger.info("Despachador de webhooks iniciado (hilos=%s, lote=%s)", AFIP_WEBHOOK_HILOS, AFIP_WEBHOOK_LOTE_MAX)
+
+
+def _crear_webhooks() -> Optional[Webhooks]:
+    if not AFIP_WEBHOOK_HABILITADO:
+        return None
+    try:
+        return Webhooks(AFIP_WEBHOOK_DB)
+    except Exception as e:
+        logger.error("No se pudo iniciar la entrega de webhooks: %s", e)
+        return None
+
+
+# Instancia única del proceso; None si los webhooks están deshabilitados.
+webhooks = _crear_webhooks()
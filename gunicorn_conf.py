@@ -10,6 +10,28 @@ workers = 4
 # envíe a los logs del contenedor Docker.
 
 capture_output = True
-loglevel = "debug"
+loglevel = "info"
 accesslog = "-"  # Envía logs de acceso a stdout
-errorlog = "-"   # Envía logs de error a stderr
\ No newline at end of file
+errorlog = "-"   # Envía logs de error a stderr
+
+# --- Gateway AFIP ---
+# Con AFIP_GATEWAY_SOCKET definido y AFIP_GATEWAY_MODO=master, el master de
+# gunicorn lanza un único proceso gateway que concentra las sesiones con AFIP
+# de todos los workers, y lo relanza si muere (AFIP_GATEWAY_SUPERVISION).
+# En modo "sidecar" el gateway se ejecuta por separado.
+_supervisor = None
+
+
+def on_starting(server):
+    global _supervisor
+    from app.config import AFIP_GATEWAY_SOCKET, AFIP_GATEWAY_MODO
+    if AFIP_GATEWAY_SOCKET and AFIP_GATEWAY_MODO == "master":
+        from app.afip_gateway import SupervisorGateway
+        _supervisor = SupervisorGateway(AFIP_GATEWAY_SOCKET)
+        gateway = _supervisor.iniciar()
+        server.log.info(f"Gateway AFIP iniciado (pid {gateway.pid}) en {AFIP_GATEWAY_SOCKET}")
+
+
+def on_exit(server):
+    if _supervisor is not None:
+        _supervisor.detener()
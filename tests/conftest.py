@@ -0,0 +1,23 @@
+# tests/conftest.py
+"""
+Configuración común de las pruebas.
+
+Los módulos de `app` crean sus instancias únicas al importarse a partir de
+las variables de entorno: antes de importarlos se apuntan todas las bases
+SQLite a un directorio temporal y se fija una clave para el registro de
+tenants, así las pruebas no tocan los archivos de /tmp del servicio.
+"""
+import os
+import tempfile
+
+from cryptography.fernet import Fernet
+
+_DIRECTORIO = tempfile.mkdtemp(prefix="afip_pruebas_")
+
+for _variable, _archivo in (("AFIP_LIMITE_DB", "limites.sqlite"), ("AFIP_REGISTRO_DB", "tenants.sqlite"),
+                            ("AFIP_OUTBOX_DB", "outbox.sqlite"), ("AFIP_WEBHOOK_DB", "webhooks.sqlite"),
+                            ("AFIP_PV_DB", "puntos_venta.sqlite"), ("AFIP_LIBRO_IVA_DB", "libro_iva.sqlite"),
+                            ("AFIP_SALUD_DB", "salud.sqlite")):
+    os.environ[_variable] = os.path.join(_DIRECTORIO, _archivo)
+os.environ["AFIP_REGISTRO_CLAVE"] = Fernet.generate_key().decode("ascii")
+os.environ["AFIP_PERFIL_DIR"] = os.path.join(_DIRECTORIO, "perfiles")
@@ -0,0 +1,55 @@
+# tests/test_comprobante_pdf.py
+import base64
+import gc
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+from PIL import Image
+
+from app import impresion
+from app.comprobante_pdf import _Plantilla, datos_qr, renderizar
+
+COMPROBANTE = {"tipo_afip": 1, "punto_venta": 3, "numero_comprobante": 42, "total": 121.0,
+               "tipo_documento": 80, "documento": "20-12345678-9", "cae": "74123456789012",
+               "fecha_comprobante": "2026-10-19"}
+
+
+def test_qr_acepta_cuit_y_documento_con_guiones():
+    datos = datos_qr("30-71234567-1", COMPROBANTE)
+    assert datos["cuit"] == 30712345671
+    assert datos["nroDocRec"] == 20123456789
+    assert datos["codAut"] == 74123456789012
+
+
+def test_el_logo_temporal_se_borra_con_la_plantilla():
+    png = io.BytesIO()
+    Image.new("RGB", (4, 4)).save(png, format="PNG")
+    emisor = {"razon_social": "Prueba SA", "cuit": "30712345671", "logo": base64.b64encode(png.getvalue()).decode()}
+
+    assert renderizar(emisor, COMPROBANTE).startswith(b"%PDF")
+    plantilla = _Plantilla(emisor)
+    ruta = plantilla.logo
+    assert os.path.exists(ruta)
+    del plantilla
+    gc.collect()
+    assert not os.path.exists(ruta)
+
+
+class _PoolRoto(ProcessPoolExecutor):
+    """Pool cuyo proceso murió: todo trabajo falla con BrokenProcessPool."""
+
+    def submit(self, *args, **kwargs):
+        raise BrokenProcessPool("un proceso del pool terminó abruptamente")
+
+
+def test_el_pool_roto_se_recrea(monkeypatch):
+    pool_roto = _PoolRoto(max_workers=1)
+    monkeypatch.setattr(impresion, "_pool", pool_roto)
+    monkeypatch.setattr(impresion, "_pid_pool", os.getpid())
+
+    with pytest.raises(BrokenProcessPool):
+        impresion.renderizar_uno({"cuit": "20111111112"}, COMPROBANTE)
+    assert impresion._pool is None
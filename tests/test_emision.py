@@ -0,0 +1,94 @@
+# tests/test_emision.py
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("pyafipws")
+
+import app.emision as emision
+from app.limitador import ControlAdmision, TokenBuckets
+from app.lotes import Coalescedor
+
+A, B = "20111111112", "30222222223"
+
+
+class _Conector:
+    """Conector compartido por todos los tenants del proceso, como `afip_conector`."""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+
+
+@pytest.fixture
+def entorno(tmp_path, monkeypatch):
+    control = ControlAdmision(TokenBuckets(str(tmp_path / "limites.sqlite")), concurrencia=1, cola_max=20,
+                              espera_max=5, tasa_tenant=100, rafaga_tenant=100, tasa_global=100, rafaga_global=100)
+    for nombre, valor in (("control_admision", control), ("coalescedor", None), ("reparto_pv", None),
+                          ("libro_iva", None)):
+        monkeypatch.setattr(emision, nombre, valor)
+    orden, liberar = [], threading.Event()
+
+    def facturar(credenciales, datos_factura, conector=None):
+        orden.append((credenciales["cuit"], datos_factura["n"]))
+        if datos_factura["n"] == 0:
+            liberar.wait(5)
+        return {"cae": None}
+
+    monkeypatch.setattr(emision, "facturar", facturar)
+    return _Conector(), control, orden, liberar
+
+
+def _esperar_hasta(condicion, segundos: float = 5.0):
+    limite = time.monotonic() + segundos
+    while not condicion():
+        assert time.monotonic() < limite, "la condición no se cumplió a tiempo"
+        time.sleep(0.01)
+
+
+def _emitir(conector, cuit, n):
+    credenciales = {"cuit": cuit, "certificado": "CERT", "clave_privada": "CLAVE"}
+    return threading.Thread(target=emision.emitir_local, args=(credenciales, {"n": n}),
+                            kwargs={"conector": conector})
+
+
+def test_tenants_en_un_conector_compartido_se_turnan(entorno):
+    conector, control, orden, liberar = entorno
+    hilos = [_emitir(conector, A, 0)]
+    hilos[0].start()
+    _esperar_hasta(lambda: orden)
+    # Ráfaga de A mientras emite su primer comprobante; después llega B.
+    for n in range(1, 4):
+        hilos.append(_emitir(conector, A, n))
+        hilos[-1].start()
+    _esperar_hasta(lambda: control.estado()["en_cola"] == 3)
+    hilos.append(_emitir(conector, B, 1))
+    hilos[-1].start()
+    _esperar_hasta(lambda: control.estado()["en_cola"] == 4)
+
+    liberar.set()
+    for hilo in hilos:
+        hilo.join(5)
+    # La cola justa adelanta a B, que esperaba mientras A acaparaba el conector.
+    assert orden[:2] == [(A, 0), (B, 1)]
+    assert sorted(orden[2:]) == [(A, 1), (A, 2), (A, 3)]
+
+
+def test_el_micro_lote_no_mezcla_credenciales(entorno, monkeypatch):
+    conector, _, _, _ = entorno
+    monkeypatch.setattr(emision, "coalescedor", Coalescedor(ventana_ms=200, maximo=10))
+    lotes = []
+
+    def facturar_lote(credenciales, lote, conector=None):
+        lotes.append((credenciales["certificado"], [d["n"] for d in lote]))
+        return [{"cae": None} for _ in lote]
+
+    monkeypatch.setattr(emision, "facturar_lote", facturar_lote)
+    hilos = [threading.Thread(target=emision.emitir_local, kwargs={"conector": conector, "datos_factura": {"n": n},
+                              "credenciales": {"cuit": A, "certificado": certificado, "clave_privada": "CLAVE"}})
+             for n, certificado in enumerate(("CERT", "OTRO", "CERT"))]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join(5)
+    assert sorted((certificado, sorted(ns)) for certificado, ns in lotes) == [("CERT", [0, 2]), ("OTRO", [1])]
@@ -0,0 +1,52 @@
+# tests/test_exportacion.py
+import csv
+import io
+
+import pyarrow.parquet as pq
+import pytest
+
+import app.exportacion as exportacion
+from app.libro_iva import LibroIva
+
+CUIT = "30712345671"
+
+
+@pytest.fixture
+def libro(tmp_path, monkeypatch):
+    # Bloques chicos para que el archivo se arme en varias partes.
+    monkeypatch.setattr(exportacion, "AFIP_EXPORT_LOTE", 2)
+    libro = LibroIva(str(tmp_path / "libro_iva.sqlite"))
+    for numero in range(1, 6):
+        libro.anotar(CUIT, {"tipo_afip": 6, "punto_venta": 2, "numero_comprobante": numero,
+                            "fecha_comprobante": f"2026-05-0{numero}", "neto": 10.0 * numero, "iva": 2.1 * numero,
+                            "total": 12.1 * numero, "cae": f"7400000000{numero:04d}", "resultado": "A",
+                            "tipo_documento": 96, "documento": 12345678, "id_condicion_iva": 5})
+    return libro
+
+
+def test_csv_ida_y_vuelta(libro):
+    partes = list(exportacion.exportar(CUIT, "2026-05-01", "2026-05-31", libro=libro))
+    assert len(partes) > 2
+
+    filas = list(csv.DictReader(io.StringIO(b"".join(partes).decode("utf-8"))))
+    assert list(filas[0]) == [columna for columna, _ in exportacion.COLUMNAS]
+    assert [int(fila["numero_comprobante"]) for fila in filas] == [1, 2, 3, 4, 5]
+    assert float(filas[2]["total"]) == pytest.approx(36.3)
+    assert filas[0]["documento"] == "12345678" and filas[0]["qr"] == ""
+
+
+def test_parquet_ida_y_vuelta(libro):
+    datos = b"".join(exportacion.exportar(CUIT, "2026-05-01", "2026-05-31", formato="parquet", libro=libro))
+
+    archivo = pq.ParquetFile(io.BytesIO(datos))
+    assert archivo.metadata.num_row_groups == 3
+    tabla = archivo.read()
+    assert tabla.column_names == [columna for columna, _ in exportacion.COLUMNAS]
+    assert tabla.column("numero_comprobante").to_pylist() == [1, 2, 3, 4, 5]
+    assert tabla.column("documento").to_pylist()[0] == "12345678"
+    assert tabla.column("cae").to_pylist()[4] == "74000000000005"
+
+
+def test_periodo_sin_comprobantes(libro):
+    assert b"".join(exportacion.exportar(CUIT, "2026-06-01", "2026-06-30", libro=libro)).decode().strip() == \
+        ",".join(columna for columna, _ in exportacion.COLUMNAS)
@@ -0,0 +1,72 @@
+# tests/test_libro_iva.py
+import pytest
+
+from app.libro_iva import LibroIva
+
+CUIT = "30712345671"
+
+
+def _comprobante(numero: int, fecha: str, tipo_afip: int = 1, punto_venta: int = 1, neto: float = 100.0,
+                 iva: float = 21.0):
+    return {"tipo_afip": tipo_afip, "punto_venta": punto_venta, "numero_comprobante": numero,
+            "fecha_comprobante": fecha, "neto": neto, "iva": iva, "total": neto + iva, "cae": f"7400000000{numero:04d}",
+            "resultado": "A", "tipo_documento": 80, "documento": "20-12345678-9", "qr": "https://qr"}
+
+
+@pytest.fixture
+def libro(tmp_path):
+    return LibroIva(str(tmp_path / "libro_iva.sqlite"))
+
+
+def test_anotar_y_leer_los_comprobantes(libro):
+    assert libro.anotar(CUIT, _comprobante(1, "2026-03-10"))
+    assert libro.anotar(CUIT, _comprobante(2, "2026-03-11"))
+
+    bloques = list(libro.recorrer(CUIT, "2026-03-01", "2026-03-31", tamano=1))
+    assert [len(bloque) for bloque in bloques] == [1, 1]
+    primero = bloques[0][0]
+    assert primero["numero_comprobante"] == 1 and primero["cae"] == "74000000000001"
+    assert primero["total"] == 121.0 and primero["documento"] == "20-12345678-9" and primero["qr"] == "https://qr"
+
+    totales = libro.consultar(CUIT, "2026-03-01", "2026-03-31")["totales"]
+    assert totales["cantidad"] == 2 and totales["total"] == 242.0
+
+
+def test_anotar_dos_veces_no_suma_dos_veces(libro):
+    assert libro.anotar(CUIT, _comprobante(1, "2026-03-10"))
+    assert not libro.anotar(CUIT, _comprobante(1, "2026-03-10"))
+    assert libro.consultar(CUIT, "2026-03-10", "2026-03-10")["totales"]["cantidad"] == 1
+
+
+def test_totales_restan_notas_de_credito_y_combinan_dias_y_meses(libro):
+    libro.anotar(CUIT, _comprobante(1, "2026-01-31", neto=0.1, iva=0.02))
+    libro.anotar(CUIT, _comprobante(2, "2026-02-15", neto=0.2, iva=0.04))
+    libro.anotar(CUIT, _comprobante(1, "2026-02-20", tipo_afip=3, neto=100.0, iva=21.0))
+    libro.anotar(CUIT, _comprobante(3, "2026-03-01", neto=1000.0, iva=210.0))
+
+    # Enero suelto (un día), febrero completo (mensual) y marzo suelto.
+    resultado = libro.consultar(CUIT, "2026-01-31", "2026-03-01")
+    assert resultado["totales"]["cantidad"] == 4
+    assert resultado["totales"]["neto"] == pytest.approx(900.3)
+    assert resultado["totales"]["iva"] == pytest.approx(189.06)
+
+    por_mes = {fila["periodo"]: fila for fila in libro.consultar(CUIT, "2026-01-01", "2026-03-31", por="mes")["detalle"]
+               if fila["tipo_afip"] == 1}
+    assert sorted(por_mes) == ["2026-01", "2026-02", "2026-03"]
+    notas = libro.consultar(CUIT, "2026-02-01", "2026-02-28", tipo_afip=3)["totales"]
+    assert notas["cantidad"] == 1 and notas["total"] == -121.0
+
+
+def test_reconstruir_recupera_los_agregados(libro):
+    libro.anotar(CUIT, _comprobante(1, "2026-03-10"))
+    libro.anotar(CUIT, _comprobante(2, "2026-04-02"))
+    libro.anotar("20111111112", _comprobante(1, "2026-03-10"))
+    antes = libro.consultar(CUIT, "2026-03-01", "2026-04-30", por="dia")
+
+    with libro._transaccion() as db:
+        db.execute("DELETE FROM diario")
+        db.execute("UPDATE mensual SET total = 0")
+    assert libro.reconstruir(CUIT) == 2
+
+    assert libro.consultar(CUIT, "2026-03-01", "2026-04-30", por="dia") == antes
+    assert libro.consultar(CUIT, "2026-03-01", "2026-04-30")["totales"]["total"] == 242.0
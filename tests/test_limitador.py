@@ -0,0 +1,143 @@
+# tests/test_limitador.py
+import threading
+import time
+
+import pytest
+
+from app.limitador import CLAVE_GLOBAL, ControlAdmision, LimiteExcedido, TokenBuckets
+
+
+@pytest.fixture
+def buckets(tmp_path):
+    return TokenBuckets(str(tmp_path / "limites.sqlite"))
+
+
+def _control(buckets, **opciones):
+    parametros = dict(concurrencia=4, cola_max=20, espera_max=5, tasa_tenant=1, rafaga_tenant=3,
+                      tasa_global=100, rafaga_global=100)
+    parametros.update(opciones)
+    return ControlAdmision(buckets, **parametros)
+
+
+def test_sin_token_del_tenant_responde_429_sin_esperar(buckets):
+    control = _control(buckets)
+    for _ in range(3):
+        with control.admitir("20111111112"):
+            pass
+
+    inicio = time.monotonic()
+    with pytest.raises(LimiteExcedido) as excepcion:
+        with control.admitir("20111111112"):
+            pass
+    assert time.monotonic() - inicio < 0.5
+    assert excepcion.value.retry_after >= 1
+    # Otro tenant no se ve afectado por la ráfaga del primero.
+    with control.admitir("30222222223"):
+        pass
+
+
+def test_sin_token_global_devuelve_el_token_del_tenant(buckets):
+    control = _control(buckets, tasa_global=1, rafaga_global=1)
+    with control.admitir("20111111112"):
+        pass
+    with pytest.raises(LimiteExcedido):
+        with control.admitir("20111111112"):
+            pass
+    # El rechazo global no consumió el token del tenant: quedan 2 de la ráfaga.
+    assert buckets.reservar("20111111112", 1, 3) == 0
+    assert buckets.reservar("20111111112", 1, 3) == 0
+    assert buckets.reservar("20111111112", 1, 3) > 0
+    assert buckets.reservar(CLAVE_GLOBAL, 1, 1) > 0
+
+
+def test_espera_de_turno_agotada_devuelve_los_tokens(buckets):
+    control = _control(buckets, concurrencia=1, espera_max=0.2, rafaga_tenant=2)
+    ocupado, liberar = threading.Event(), threading.Event()
+
+    def ocupar():
+        with control.admitir("30222222223"):
+            ocupado.set()
+            liberar.wait(5)
+
+    hilo = threading.Thread(target=ocupar)
+    hilo.start()
+    ocupado.wait(5)
+    try:
+        with pytest.raises(LimiteExcedido, match="Tiempo de espera de turno agotado"):
+            with control.admitir("20111111112"):
+                pass
+        assert control.estado()["en_cola"] == 0
+    finally:
+        liberar.set()
+        hilo.join()
+    # Los dos tokens de la ráfaga siguen disponibles.
+    for _ in range(2):
+        with control.admitir("20111111112"):
+            pass
+
+
+def test_cola_llena_responde_429(buckets):
+    control = _control(buckets, concurrencia=1, cola_max=1, rafaga_tenant=10)
+    ocupado, liberar = threading.Event(), threading.Event()
+    errores = []
+
+    def ocupar():
+        with control.admitir("30222222223"):
+            ocupado.set()
+            liberar.wait(5)
+
+    def esperar():
+        try:
+            with control.admitir("20111111112"):
+                pass
+        except LimiteExcedido as e:
+            errores.append(e)
+
+    primero = threading.Thread(target=ocupar)
+    primero.start()
+    ocupado.wait(5)
+    segundo = threading.Thread(target=esperar)
+    segundo.start()
+    while control.estado()["en_cola"] < 1:
+        time.sleep(0.01)
+    try:
+        with pytest.raises(LimiteExcedido, match="Cola de emisión llena"):
+            with control.admitir("20111111112"):
+                pass
+    finally:
+        liberar.set()
+        primero.join()
+        segundo.join()
+    assert not errores
+
+
+def test_cola_justa_alterna_entre_tenants(buckets):
+    control = _control(buckets, concurrencia=1, rafaga_tenant=10)
+    orden = []
+    ocupado, liberar = threading.Event(), threading.Event()
+
+    def ocupar():
+        with control.admitir("99999999999"):
+            ocupado.set()
+            liberar.wait(5)
+
+    def emitir(cuit):
+        with control.admitir(cuit):
+            orden.append(cuit)
+
+    primero = threading.Thread(target=ocupar)
+    primero.start()
+    ocupado.wait(5)
+    # Un tenant en ráfaga encola cuatro solicitudes antes que el otro encole dos.
+    hilos = []
+    for cuit in ["20111111112"] * 4 + ["30222222223"] * 2:
+        hilo = threading.Thread(target=emitir, args=(cuit,))
+        hilo.start()
+        hilos.append(hilo)
+        while control.estado()["en_cola"] < len(hilos):
+            time.sleep(0.01)
+    liberar.set()
+    for hilo in [primero] + hilos:
+        hilo.join()
+    # El segundo tenant no espera a que termine la ráfaga del primero.
+    assert orden[:4].count("30222222223") == 2
@@ -0,0 +1,57 @@
+# tests/test_logger_setup.py
+import logging
+import queue
+import sys
+
+from app.logger_setup import FiltroMuestreo, FormatoJSON, _QueueHandlerDiferido
+
+
+def _registro(mensaje, *args, exc_info=None):
+    return logging.LogRecord("prueba", logging.INFO, __file__, 1, mensaje, args, exc_info)
+
+
+def test_los_argumentos_se_registran_con_su_valor_al_loguear():
+    cola = queue.Queue()
+    handler = _QueueHandlerDiferido(cola)
+    datos = {"estado": "pendiente"}
+    handler.handle(_registro("Comprobante %s", datos))
+    datos["estado"] = "emitido"
+
+    encolado = cola.get_nowait()
+    assert encolado.args is None
+    assert encolado.getMessage() == "Comprobante {'estado': 'pendiente'}"
+
+
+def test_la_excepcion_se_encola_como_texto():
+    cola = queue.Queue()
+    handler = _QueueHandlerDiferido(cola)
+    try:
+        raise ValueError("clave_privada='secreta'")
+    except ValueError:
+        handler.handle(_registro("Falló", exc_info=sys.exc_info()))
+
+    encolado = cola.get_nowait()
+    assert encolado.exc_info is None
+    salida = FormatoJSON().format(encolado)
+    assert "ValueError" in salida and "secreta" not in salida
+
+
+def test_el_muestreo_descarta_ventanas_vencidas(monkeypatch):
+    filtro = FiltroMuestreo(por_segundo=1)
+    reloj = [100.0]
+    monkeypatch.setattr("app.logger_setup.time.monotonic", lambda: reloj[0])
+    for indice in range(50):
+        assert filtro.filter(_registro(f"Plantilla {indice} %s", indice))
+    assert not filtro.filter(_registro("Plantilla 0 %s", 0))
+    assert len(filtro._ventanas) == 50
+
+    reloj[0] = 101.0
+    assert filtro.filter(_registro("Otra %s", 1))
+    # Solo queda la ventana con suprimidos pendientes de informar y la nueva.
+    assert len(filtro._ventanas) == 2
+    registro = _registro("Plantilla 0 %s", 0)
+    assert filtro.filter(registro) and registro.suprimidos == 1
+
+    reloj[0] = 200.0
+    assert filtro.filter(_registro("Otra %s", 1))
+    assert len(filtro._ventanas) == 1
@@ -0,0 +1,88 @@
+# tests/test_lotes.py
+import threading
+import time
+
+import pytest
+
+from app.lotes import Coalescedor
+from app.plazos import EnvioIncierto, PlazoAgotado, plazo, restante
+
+
+def _en_hilo(funcion):
+    resultado = {}
+
+    def correr():
+        try:
+            resultado["valor"] = funcion()
+        except Exception as e:
+            resultado["error"] = e
+
+    hilo = threading.Thread(target=correr)
+    hilo.start()
+    return hilo, resultado
+
+
+def _lider_en_espera(coalescedor, clave):
+    limite = time.monotonic() + 5
+    while clave not in coalescedor._grupos:
+        assert time.monotonic() < limite, "el líder no abrió el lote"
+        time.sleep(0.001)
+
+
+def test_el_seguidor_vencido_se_retira_del_lote():
+    coalescedor = Coalescedor(ventana_ms=300, maximo=10)
+    ejecutados = []
+
+    def ejecutar(items):
+        ejecutados.append(list(items))
+        return [f"cae-{item}" for item in items]
+
+    lider, resultado = _en_hilo(lambda: coalescedor.enviar("clave", "a", ejecutar))
+    _lider_en_espera(coalescedor, "clave")
+    with plazo(0.05), pytest.raises(PlazoAgotado):
+        coalescedor.enviar("clave", "b", ejecutar)
+    lider.join(5)
+
+    assert resultado["valor"] == "cae-a"
+    assert ejecutados == [["a"]]
+
+
+def test_el_seguidor_vencido_con_el_lote_enviado_queda_incierto():
+    coalescedor = Coalescedor(ventana_ms=50, maximo=2)
+    enviado, liberar = threading.Event(), threading.Event()
+
+    def ejecutar(items):
+        enviado.set()
+        liberar.wait(5)
+        return list(items)
+
+    lider, resultado = _en_hilo(lambda: coalescedor.enviar("clave", "a", ejecutar))
+    _lider_en_espera(coalescedor, "clave")
+    with plazo(0.2), pytest.raises(EnvioIncierto):
+        coalescedor.enviar("clave", "b", ejecutar)
+    assert enviado.is_set()
+    liberar.set()
+    lider.join(5)
+    assert resultado["valor"] == "a"
+
+
+def test_el_lote_corre_con_el_plazo_mas_amplio():
+    coalescedor = Coalescedor(ventana_ms=5000, maximo=2)
+    plazos_vistos = []
+
+    def ejecutar(items):
+        plazos_vistos.append(restante())
+        return list(items)
+
+    def lider():
+        with plazo(0.05):
+            return coalescedor.enviar("clave", "a", ejecutar)
+
+    hilo, resultado = _en_hilo(lider)
+    _lider_en_espera(coalescedor, "clave")
+    with plazo(30):
+        assert coalescedor.enviar("clave", "b", ejecutar) == "b"
+    hilo.join(5)
+
+    assert resultado["valor"] == "a"
+    assert plazos_vistos[0] > 1
@@ -0,0 +1,136 @@
+# tests/test_outbox.py
+import sys
+import types
+
+import pytest
+
+from app.outbox import EMITIDO, INCIERTO, PENDIENTE, RECHAZADO, Outbox
+from app.plazos import EnvioIncierto
+from app.tenants import AccesoDenegado
+
+CREDENCIALES = {"cuit": "20111111112", "certificado": "CERT", "clave_privada": "CLAVE"}
+
+
+def _factura(punto_venta: int = 1, total: float = 100.0):
+    return {"punto_venta": punto_venta, "tipo_afip": 6, "total": total}
+
+
+@pytest.fixture
+def emisiones(monkeypatch):
+    """Reemplaza `app.emision.emitir` por una cola de resultados o excepciones."""
+    respuestas, llamadas = [], []
+
+    def emitir(credenciales, datos_factura):
+        llamadas.append(datos_factura)
+        respuesta = respuestas.pop(0)
+        if isinstance(respuesta, Exception):
+            raise respuesta
+        return respuesta
+
+    monkeypatch.setitem(sys.modules, "app.emision", types.SimpleNamespace(emitir=emitir))
+    return respuestas, llamadas
+
+
+def _outbox(ruta: str, pausa: float = 0.0) -> Outbox:
+    caja = Outbox(ruta)
+    caja.pausa = pausa
+    # Sin hilo drenador: las pruebas procesan a mano.
+    caja.iniciar_drenador = lambda: None
+    return caja
+
+
+@pytest.fixture
+def caja(tmp_path):
+    return _outbox(str(tmp_path / "outbox.sqlite"))
+
+
+def test_emite_y_guarda_el_resultado(caja, emisiones):
+    respuestas, _ = emisiones
+    encolado = caja.encolar(CREDENCIALES, _factura())
+    assert encolado["estado"] == PENDIENTE and encolado["token"]
+
+    respuestas.append({"cae": "123", "numero_comprobante": 7})
+    assert caja.procesar_siguiente()
+
+    estado = caja.consultar(encolado["id"])
+    assert estado["estado"] == EMITIDO
+    assert estado["resultado"]["cae"] == "123"
+    assert "token" not in estado
+    assert not caja.procesar_siguiente()
+
+
+def test_error_de_conexion_reintenta_sin_adelantar_la_clave(caja, emisiones):
+    respuestas, llamadas = emisiones
+    primero = caja.encolar(CREDENCIALES, _factura(total=1))
+    segundo = caja.encolar(CREDENCIALES, _factura(total=2))
+
+    respuestas.append(ConnectionError("AFIP no responde"))
+    assert caja.procesar_siguiente()
+    estado = caja.consultar(primero["id"])
+    assert estado["estado"] == PENDIENTE and estado["intentos"] == 1
+
+    # El primero espera su backoff y el segundo no se emite antes que él.
+    assert not caja.procesar_siguiente()
+    assert caja.consultar(segundo["id"])["estado"] == PENDIENTE
+    assert len(llamadas) == 1
+
+
+def test_rechazo_de_afip_es_definitivo(caja, emisiones):
+    respuestas, _ = emisiones
+    encolado = caja.encolar(CREDENCIALES, _factura())
+
+    respuestas.append(RuntimeError("AFIP rechazó la factura: 10016"))
+    assert caja.procesar_siguiente()
+    estado = caja.consultar(encolado["id"])
+    assert estado["estado"] == RECHAZADO
+    assert "10016" in estado["error"]
+
+
+def test_envio_incierto_no_se_reenvia(caja, emisiones):
+    respuestas, llamadas = emisiones
+    encolado = caja.encolar(CREDENCIALES, _factura())
+
+    respuestas.append(EnvioIncierto("Sin respuesta de AFIP a la solicitud de CAE"))
+    assert caja.procesar_siguiente()
+    estado = caja.consultar(encolado["id"])
+    assert estado["estado"] == INCIERTO
+    assert "verificar en AFIP" in estado["error"]
+
+    assert not caja.procesar_siguiente()
+    assert len(llamadas) == 1
+
+
+def test_el_ritmo_se_comparte_entre_drenadores(tmp_path, emisiones):
+    respuestas, llamadas = emisiones
+    ruta = str(tmp_path / "outbox.sqlite")
+    uno, otro = _outbox(ruta, pausa=60), _outbox(ruta, pausa=60)
+    uno.encolar(CREDENCIALES, _factura(punto_venta=1))
+    pendiente = uno.encolar(CREDENCIALES, _factura(punto_venta=2))
+
+    respuestas.append({"cae": "1"})
+    assert uno.procesar_siguiente()
+    # Otra clave está lista, pero el turno ya lo usó el otro drenador.
+    assert not otro.procesar_siguiente()
+    assert 0 < otro._espera_ritmo <= 60
+    assert otro.consultar(pendiente["id"])["estado"] == PENDIENTE
+    assert len(llamadas) == 1
+
+
+def test_consultar_el_estado_exige_el_token(caja):
+    encolado = caja.encolar(CREDENCIALES, _factura())
+
+    caja.verificar_acceso(encolado["id"], token=encolado["token"])
+    with pytest.raises(AccesoDenegado):
+        caja.verificar_acceso(encolado["id"])
+    with pytest.raises(AccesoDenegado):
+        caja.verificar_acceso(encolado["id"], token="otro")
+    with pytest.raises(AccesoDenegado):
+        caja.verificar_acceso(encolado["id"] + 1, token=encolado["token"])
+
+
+def test_credenciales_en_linea_sin_cuit_se_rechazan(caja):
+    with pytest.raises(ValueError, match="cuit"):
+        caja.encolar({"certificado": "CERT", "clave_privada": "CLAVE"}, _factura())
+    with pytest.raises(ValueError, match="objetos JSON"):
+        caja.encolar(CREDENCIALES, [_factura()])
+    assert caja.estado()[PENDIENTE] == 0
@@ -0,0 +1,22 @@
+# tests/test_salud.py
+import time
+
+import pytest
+
+pytest.importorskip("pyafipws")
+
+from app.config import AFIP_SALUD_FALLOS_MAX
+from app.salud import Sondeador
+
+
+def test_circuito_abierto_degrada_sin_sacar_de_servicio(tmp_path, monkeypatch):
+    sondeador = Sondeador(str(tmp_path / "salud.sqlite"), ["produccion"], intervalo=0.001)
+    monkeypatch.setattr(sondeador, "_fedummy", lambda entorno: {"ok": False, "servidores": {},
+                                                                "error": "timeout", "latencia_ms": 1.0})
+    for _ in range(AFIP_SALUD_FALLOS_MAX):
+        time.sleep(0.01)
+        foto = sondeador.sondear()
+
+    assert foto["afip"]["produccion"]["circuito"] == "abierto"
+    assert foto["listo"] and foto["motivos"] == []
+    assert foto["degradado"] and foto["avisos"] == ["AFIP produccion: circuito abierto"]
@@ -0,0 +1,81 @@
+# tests/test_soap_transport.py
+import http.client
+import socket
+
+import pytest
+
+import app.soap_transport as soap_transport
+from app.soap_transport import PooledHTTPSTransport, _conexion_caida, _es_reenviable
+
+FECAE = {"SOAPAction": '"http://ar.gov.afip.dif.FEV1/FECAESolicitar"'}
+ULTIMO = {"SOAPAction": '"http://ar.gov.afip.dif.FEV1/FECompUltimoAutorizado"'}
+
+
+class _Conexion:
+    """Conexión que pierde la respuesta en su primer uso, como un keep-alive cortado."""
+
+    def __init__(self, enviados, falla=True):
+        self.enviados, self.falla = enviados, falla
+        self.sock = socket.socket()
+
+    def request(self, method, ruta, body=None, headers=None):
+        self.enviados.append(body)
+
+    def getresponse(self):
+        if self.falla:
+            raise http.client.RemoteDisconnected("Remote end closed connection without response")
+        return _RespuestaHTTP()
+
+    def close(self):
+        self.sock.close()
+
+
+class _RespuestaHTTP:
+    status, will_close = 200, True
+
+    def getheaders(self):
+        return []
+
+    def read(self):
+        return b"<ok/>"
+
+
+@pytest.fixture
+def transporte(monkeypatch):
+    enviados = []
+    monkeypatch.setattr(soap_transport.pool, "obtener", lambda clave: _Conexion(enviados))
+    monkeypatch.setattr(soap_transport, "_conexion_caida", lambda conexion: False)
+    monkeypatch.setattr(PooledHTTPSTransport, "_nueva_conexion",
+                        lambda self, host, port, timeout: _Conexion(enviados, falla=False))
+    return PooledHTTPSTransport(), enviados
+
+
+def test_fecaesolicitar_no_se_reenvia_tras_perder_la_respuesta(transporte):
+    transporte, enviados = transporte
+    with pytest.raises(http.client.RemoteDisconnected):
+        transporte.request("https://afip.test/wsfev1", "POST", body=b"cae", headers=FECAE)
+    assert enviados == [b"cae"]
+
+
+def test_las_consultas_se_reenvian_en_una_conexion_nueva(transporte):
+    transporte, enviados = transporte
+    respuesta, contenido = transporte.request("https://afip.test/wsfev1", "POST", body=b"ultimo", headers=ULTIMO)
+    assert respuesta.status == 200 and contenido == b"<ok/>"
+    assert enviados == [b"ultimo", b"ultimo"]
+
+
+def test_operaciones_reenviables():
+    assert _es_reenviable("GET", None)
+    assert _es_reenviable("POST", {"soapaction": '"http://ar.gov.afip.dif.FEV1/FEParamGetTiposCbte"'})
+    assert not _es_reenviable("POST", FECAE)
+    assert not _es_reenviable("POST", {"SOAPAction": '"loginCms"'})
+
+
+def test_detecta_conexion_cerrada_por_el_servidor():
+    local, remoto = socket.socketpair()
+    conexion = http.client.HTTPConnection("afip.test")
+    conexion.sock = local
+    assert not _conexion_caida(conexion)
+    remoto.close()
+    assert _conexion_caida(conexion)
+    local.close()
@@ -0,0 +1,116 @@
+# tests/test_tenants.py
+import datetime
+import sqlite3
+
+import pytest
+from cryptography import x509
+from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+
+from app.tenants import AccesoDenegado, RegistroTenants
+
+
+def _credenciales(dias: int = 365):
+    clave = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    nombre = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "prueba")])
+    ahora = datetime.datetime.now(datetime.timezone.utc)
+    certificado = (x509.CertificateBuilder().subject_name(nombre).issuer_name(nombre)
+                   .public_key(clave.public_key()).serial_number(x509.random_serial_number())
+                   .not_valid_before(ahora).not_valid_after(ahora + datetime.timedelta(days=dias))
+                   .sign(clave, hashes.SHA256()))
+    return (certificado.public_bytes(serialization.Encoding.PEM).decode("utf-8"),
+            clave.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                serialization.NoEncryption()).decode("utf-8"))
+
+
+@pytest.fixture(scope="module")
+def pem():
+    return _credenciales()
+
+
+@pytest.fixture
+def registro(tmp_path):
+    return RegistroTenants(str(tmp_path / "tenants.sqlite"), Fernet.generate_key().decode("ascii"))
+
+
+def test_referenciar_un_tenant_exige_su_api_key(registro, pem):
+    alta = registro.registrar("20111111112", *pem)
+    api_key = alta["api_key"]
+
+    for tenant_id, cuit in (("20111111112", None), (None, "20111111112")):
+        with pytest.raises(AccesoDenegado):
+            registro.obtener(tenant_id=tenant_id, cuit=cuit)
+        with pytest.raises(AccesoDenegado):
+            registro.obtener(tenant_id=tenant_id, cuit=cuit, api_key="otra")
+        credenciales = registro.obtener(tenant_id=tenant_id, cuit=cuit, api_key=api_key)
+        assert credenciales["certificado"] == pem[0]
+        # Con las credenciales en caché se sigue verificando la api_key.
+        with pytest.raises(AccesoDenegado):
+            registro.obtener(tenant_id=tenant_id, cuit=cuit)
+
+
+def test_reemplazar_el_certificado_conserva_la_api_key_y_renueva_la_cache_por_cuit(registro, pem):
+    api_key = registro.registrar("20111111112", *pem)["api_key"]
+    assert registro.obtener(cuit="20111111112", api_key=api_key)["certificado"] == pem[0]
+
+    nuevo = _credenciales()
+    reemplazo = registro.registrar("20111111112", *nuevo)
+    assert "api_key" not in reemplazo
+    assert registro.obtener(cuit="20111111112", api_key=api_key)["certificado"] == nuevo[0]
+    assert registro.obtener(tenant_id="20111111112", api_key=api_key)["certificado"] == nuevo[0]
+
+
+def test_regenerar_la_api_key_revoca_la_anterior(registro, pem):
+    anterior = registro.registrar("20111111112", *pem, tenant_id="acme")["api_key"]
+    registro.obtener(cuit="20111111112", api_key=anterior)
+
+    nueva = registro.regenerar_api_key("acme")["api_key"]
+    assert nueva != anterior
+    with pytest.raises(AccesoDenegado):
+        registro.obtener(cuit="20111111112", api_key=anterior)
+    assert registro.obtener(tenant_id="acme", api_key=nueva)["cuit"] == "20111111112"
+    assert registro.regenerar_api_key("inexistente") is None
+
+
+def test_eliminar_descarta_la_cache_por_cuit(registro, pem):
+    api_key = registro.registrar("20111111112", *pem, tenant_id="acme")["api_key"]
+    registro.obtener(cuit="20111111112", api_key=api_key)
+    assert registro.eliminar("acme")
+    with pytest.raises(ValueError, match="No hay credenciales"):
+        registro.obtener(cuit="20111111112", api_key=api_key)
+
+
+def test_la_api_key_autoriza_solo_el_cuit_de_su_tenant(registro, pem):
+    api_key = registro.registrar("20111111112", *pem)["api_key"]
+    otra = registro.registrar("30222222223", *pem)["api_key"]
+
+    registro.verificar_api_key_de_cuit("20111111112", api_key)
+    for cuit, clave in (("20111111112", otra), ("20111111112", None), ("27333333334", api_key)):
+        with pytest.raises(AccesoDenegado):
+            registro.verificar_api_key_de_cuit(cuit, clave)
+
+
+def test_un_cuit_pertenece_a_un_solo_tenant(registro, pem):
+    api_key = registro.registrar("20111111112", *pem, tenant_id="acme")["api_key"]
+    with pytest.raises(ValueError, match="ya está registrado en el tenant acme"):
+        registro.registrar("20111111112", *pem, tenant_id="otro")
+    assert registro.describir("otro") is None
+    assert registro.obtener(cuit="20111111112", api_key=api_key)["tenant_id"] == "acme"
+
+
+def test_cuit_repetido_de_un_registro_previo_exige_tenant_id(tmp_path, pem):
+    ruta = str(tmp_path / "tenants.sqlite")
+    clave = Fernet.generate_key().decode("ascii")
+    registro = RegistroTenants(ruta, clave)
+    api_key = registro.registrar("20111111112", *pem, tenant_id="acme")["api_key"]
+    with sqlite3.connect(ruta) as db:
+        db.execute("DROP INDEX tenants_cuit_unico")
+        db.execute("INSERT INTO tenants SELECT 'otro', cuit, certificado, clave_privada, vencimiento_certificado, "
+                   "actualizado, api_key_hash FROM tenants WHERE tenant_id = 'acme'")
+
+    registro = RegistroTenants(ruta, clave)
+    with pytest.raises(ValueError, match="indicar tenant_id"):
+        registro.obtener(cuit="20111111112", api_key=api_key)
+    assert registro.obtener(tenant_id="acme", api_key=api_key)["tenant_id"] == "acme"